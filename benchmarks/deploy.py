@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+End-to-end reconcile runs against the fake juju API server.
+
+A synthetic bundle is reconciled from an empty environment through
+the real client, connection pool, strategy and tactics, talking to
+benchmarks.fakejuju over a local websocket::
+
+    PYTHONPATH=.:charmgen python -m benchmarks.deploy 10 100 \\
+        --latency 0.02 --fail AddRelation=0.05
+
+Afterwards reality is re-read and diffed again, a converged run
+leaves nothing to do.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import tornado.ioloop
+from tornado import gen
+
+from benchmarks import synthetic
+from benchmarks.fakejuju import FakeJuju
+from cloudfoundry import model
+from cloudfoundry.client import PipelinedEnvironment
+
+
+@gen.coroutine
+def run(size, latency=0, failures=None, concurrency=4):
+    juju = FakeJuju(latency=latency, failures=failures)
+    port = juju.listen()
+
+    class Database(model.StateDatabase):
+        @classmethod
+        def get_env(cls, name=None, user=None, password=None):
+            env = PipelinedEnvironment('ws://127.0.0.1:%d' % port)
+            env.login(user=user, password=password)
+            return env
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db = Database({
+            'juju.environment': 'fake',
+            'credentials.password': juju.password,
+            'server.repository': os.path.join(tmpdir, 'build'),
+            'strategy.concurrency': concurrency,
+            'journal.path': os.path.join(tmpdir, 'journal.log'),
+            'journal.backups': 1})
+        yield db.refresh()
+        db.expected = synthetic.bundle(size)
+
+        start = time.time()
+        db.build_strategy()
+        strategy = db.strategy
+        db.execute_strategy()
+        yield db.exec_lock.wait()
+        wall = time.time() - start
+
+        yield db.refresh()
+        db.reconciled = None
+        db.build_strategy()
+        remaining = len(db.strategy)
+        # closing waits on the server, which needs the IOLoop
+        yield db.executor.submit(db.env.close)
+    finally:
+        juju.server.stop()
+        shutil.rmtree(tmpdir)
+
+    calls = sum(juju.calls.values())
+    raise gen.Return({
+        'size': size,
+        'tactics': len(strategy),
+        'failed': sum(1 for t in strategy if t.failure is not None),
+        'state': strategy.as_dict()['state'],
+        'wall': wall,
+        'api_calls': calls,
+        'calls_per_second': calls / wall if wall else 0,
+        'remaining': remaining,
+    })
+
+
+def _failure(value):
+    request, rate = value.split('=')
+    return request, float(rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('sizes', nargs='*', type=int, default=[10, 100])
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every API reply')
+    parser.add_argument('--fail', type=_failure, action='append',
+                        default=[], metavar='REQUEST=RATE',
+                        help='fraction of REQUEST calls to fail')
+    parser.add_argument('--concurrency', type=int, default=4)
+    args = parser.parse_args()
+
+    loop = tornado.ioloop.IOLoop.current()
+    for size in args.sizes:
+        result = loop.run_sync(lambda: run(
+            size, args.latency, dict(args.fail), args.concurrency))
+        print json.dumps(result, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
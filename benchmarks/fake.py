@@ -0,0 +1,42 @@
+"""
+In-process stand-in for a juju Environment.
+"""
+import copy
+import threading
+
+
+class FakeEnvironment(object):
+    """
+    Serves a canned status and records every mutating call.
+
+    Just enough of jujuclient's Environment (and the pool in front
+    of it) for StateDatabase and the tactics to run against.
+    """
+    healthy = True
+
+    def __init__(self, status):
+        self._status = status
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def status(self):
+        return copy.deepcopy(self._status)
+
+    def get_watch(self):
+        return iter(())
+
+    def check(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _record(self, name, *args):
+        with self._lock:
+            self.calls.append((name,) + args)
+        return {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args, **kw: self._record(name, *args)
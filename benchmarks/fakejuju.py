@@ -0,0 +1,388 @@
+"""
+A stand-in juju state server speaking enough of the websocket API
+for the reconciler, the tactics and hooks.common.deploy.
+
+It keeps services, units and relations in memory, answers
+FullStatus from them and feeds the changes to AllWatchers. Every
+request can be slowed down or made to fail::
+
+    juju = FakeJuju(latency=0.05, latencies={'ServiceDeploy': 0.5},
+                    failures={'AddRelation': 0.1})
+    port = juju.listen()
+    env = PipelinedEnvironment('ws://127.0.0.1:%d' % port)
+
+Local charms are uploaded over plain HTTP to /charms on the same
+port, so the client has to be pointed at a ws:// endpoint.
+"""
+import json
+import random
+import zipfile
+from cStringIO import StringIO
+
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.web
+import tornado.websocket
+import yaml
+from tornado import gen
+from tornado.concurrent import Future, chain_future
+
+
+class FakeError(Exception):
+    pass
+
+
+def _endpoint(endpoint, remote):
+    # bare service names relate on a relation named after the
+    # remote end, real juju would look the interface up instead
+    if ':' in endpoint:
+        return tuple(endpoint.split(':', 1))
+    return endpoint, remote.split(':')[0]
+
+
+def _typed(options):
+    # the client sends every option as a string, juju converts
+    # them by the charm's config schema which YAML approximates
+    return dict((k, yaml.safe_load(v) if isinstance(v, basestring) else v)
+                for k, v in (options or {}).items())
+
+
+class FakeJuju(object):
+    """
+    In-memory environment plus the server exposing it.
+
+    `latency` is added to every reply, `latencies` overrides it per
+    request type, and `failures` maps request types to the fraction
+    of calls answered with an error.
+    """
+    def __init__(self, latency=0, latencies=None, failures=None,
+                 password='secret', seed=0, io_loop=None):
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.failures = failures or {}
+        self.password = password
+        self.random = random.Random(seed)
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self.services = {}
+        # (service, relation name) pairs, keyed by "a:x b:y"
+        self.relations = {}
+        self.charms = {}
+        self.calls = {}
+        self.machines = 0
+        self.sockets = set()
+        self._watchers = {}
+        self._log = []
+        self._waiter = Future()
+
+    # Server
+
+    def application(self):
+        return tornado.web.Application([
+            (r"/charms", CharmsHandler, {'juju': self}),
+            (r"/", APIHandler, {'juju': self}),
+        ])
+
+    def listen(self, port=0, address='127.0.0.1'):
+        """Start serving, returns the port."""
+        self.server = tornado.httpserver.HTTPServer(
+            self.application(), io_loop=self.io_loop)
+        sockets = tornado.netutil.bind_sockets(port, address)
+        self.server.add_sockets(sockets)
+        return sockets[0].getsockname()[1]
+
+    def disconnect(self):
+        """Drop every client, like a restarting controller."""
+        for socket in list(self.sockets):
+            socket.close()
+
+    def dispatch(self, op):
+        """The response to one request, as a Future."""
+        request = op.get('Request')
+        future = Future()
+        try:
+            self.count(request)
+            handler = getattr(self, 'do_%s' % request, None)
+            if handler is None:
+                raise FakeError('unknown request %s' % request)
+            result = handler(op.get('Params') or {}, op)
+        except FakeError as e:
+            response = {'RequestId': op.get('RequestId'), 'Error': str(e)}
+        else:
+            if isinstance(result, Future):
+                # watchers answer once there is something to say
+                self.io_loop.add_future(
+                    result, lambda f: self._reply(future, op, f.result()))
+                return future
+            response = {'RequestId': op.get('RequestId'),
+                        'Response': result or {}}
+        self._later(request, future.set_result, response)
+        return future
+
+    def count(self, request):
+        """Count a call, raising FakeError if it should fail."""
+        self.calls[request] = self.calls.get(request, 0) + 1
+        if self.random.random() < self.failures.get(request, 0):
+            raise FakeError('injected failure')
+
+    def delay(self, request):
+        return self.latencies.get(request, self.latency)
+
+    def _reply(self, future, op, result):
+        self._later(op['Request'], future.set_result, {
+            'RequestId': op.get('RequestId'), 'Response': result})
+
+    def _later(self, request, fn, *args):
+        delay = self.delay(request)
+        if delay:
+            self.io_loop.add_timeout(self.io_loop.time() + delay, fn, *args)
+        else:
+            fn(*args)
+
+    # Watcher support
+
+    def _changed(self, *deltas):
+        self._log.extend(deltas)
+        waiter, self._waiter = self._waiter, Future()
+        waiter.set_result(None)
+
+    def _snapshot(self):
+        deltas = []
+        for name, service in sorted(self.services.items()):
+            deltas.append(self._service_delta(name))
+            for unit in sorted(service['Units']):
+                deltas.append(self._unit_delta(name, unit))
+        for key in sorted(self.relations):
+            deltas.append(['relation', 'change', {'Key': key}])
+        return deltas
+
+    def _service_delta(self, name, change='change'):
+        service = self.services.get(name, {})
+        return ['service', change, {
+            'Name': name, 'CharmURL': service.get('Charm'),
+            'Exposed': service.get('Exposed', False),
+            'Config': service.get('Config', {})}]
+
+    def _unit_delta(self, service_name, unit_name, change='change'):
+        unit = self.services.get(service_name, {}).get(
+            'Units', {}).get(unit_name, {})
+        return ['unit', change, {
+            'Name': unit_name, 'Service': service_name,
+            'MachineId': unit.get('Machine', ''),
+            'Status': unit.get('AgentState', '')}]
+
+    # API
+
+    def _service(self, name):
+        if name not in self.services:
+            raise FakeError('service "%s" not found' % name)
+        return self.services[name]
+
+    def _add_units(self, name, count):
+        service = self.services[name]
+        added = []
+        for i in range(count):
+            unit = '%s/%d' % (name, service['next_unit'])
+            service['next_unit'] += 1
+            self.machines += 1
+            service['Units'][unit] = {
+                'AgentState': 'started', 'Machine': str(self.machines),
+                'PublicAddress': '10.0.0.%d' % (self.machines % 250)}
+            added.append(unit)
+        return added
+
+    def do_Login(self, params, op):
+        if params.get('Password') != self.password:
+            raise FakeError('invalid entity name or password')
+
+    def do_EnvironmentInfo(self, params, op):
+        return {'Name': 'fake', 'ProviderType': 'fake',
+                'DefaultSeries': 'trusty'}
+
+    def do_FullStatus(self, params, op):
+        services = {}
+        for name, service in self.services.items():
+            services[name] = dict(
+                (k, v) for k, v in service.items() if k != 'next_unit')
+        return {'EnvironmentName': 'fake', 'Services': services,
+                'Machines': {}}
+
+    def do_AddCharm(self, params, op):
+        self.charms.setdefault(params['URL'], None)
+
+    def do_ServiceDeploy(self, params, op):
+        name = params['ServiceName']
+        if name in self.services:
+            raise FakeError('service already exists')
+        self.services[name] = {
+            'Charm': params['CharmURL'], 'Exposed': False,
+            'Config': _typed(params.get('Config')), 'Relations': {},
+            'Units': {}, 'next_unit': 0}
+        units = self._add_units(name, params.get('NumUnits', 1))
+        self._changed(self._service_delta(name),
+                      *[self._unit_delta(name, u) for u in units])
+
+    def do_ServiceDestroy(self, params, op):
+        name = params['ServiceName']
+        service = self._service(name)
+        for key in [k for k in self.relations
+                    if name in [s for s, _ in self.relations[k]]]:
+            self._remove_relation(key)
+        deltas = [self._unit_delta(name, u, 'remove')
+                  for u in service['Units']]
+        deltas.append(self._service_delta(name, 'remove'))
+        del self.services[name]
+        self._changed(*deltas)
+
+    def do_ServiceExpose(self, params, op):
+        self._service(params['ServiceName'])['Exposed'] = True
+        self._changed(self._service_delta(params['ServiceName']))
+
+    def do_ServiceUnexpose(self, params, op):
+        self._service(params['ServiceName'])['Exposed'] = False
+        self._changed(self._service_delta(params['ServiceName']))
+
+    def do_ServiceSet(self, params, op):
+        self._service(params['ServiceName'])['Config'].update(
+            _typed(params['Options']))
+        self._changed(self._service_delta(params['ServiceName']))
+
+    def do_ServiceSetCharm(self, params, op):
+        self._service(params['ServiceName'])['Charm'] = params['CharmUrl']
+        self._changed(self._service_delta(params['ServiceName']))
+
+    def do_AddServiceUnits(self, params, op):
+        name = params['ServiceName']
+        self._service(name)
+        units = self._add_units(name, params.get('NumUnits', 1))
+        self._changed(*[self._unit_delta(name, u) for u in units])
+        return {'Units': units}
+
+    def do_DestroyServiceUnits(self, params, op):
+        deltas = []
+        for unit in params['UnitNames']:
+            name = unit.split('/')[0]
+            if unit not in self._service(name)['Units']:
+                raise FakeError('unit "%s" not found' % unit)
+            deltas.append(self._unit_delta(name, unit, 'remove'))
+            del self.services[name]['Units'][unit]
+        self._changed(*deltas)
+
+    def _relation_key(self, endpoints):
+        end_a, end_b = endpoints
+        ends = sorted([_endpoint(end_a, end_b), _endpoint(end_b, end_a)])
+        for service, _ in ends:
+            self._service(service)
+        return ' '.join('%s:%s' % end for end in ends), ends
+
+    def do_AddRelation(self, params, op):
+        key, ends = self._relation_key(params['Endpoints'])
+        if key in self.relations:
+            raise FakeError('relation already exists')
+        self.relations[key] = ends
+        for (service, rel), (remote, _) in (ends, ends[::-1]):
+            related = self.services[service]['Relations'].setdefault(
+                rel, [])
+            related.append(remote)
+        self._changed(['relation', 'change', {'Key': key}])
+        return {'Endpoints': dict(
+            (s, {'Name': r}) for s, r in ends)}
+
+    def do_DestroyRelation(self, params, op):
+        key, ends = self._relation_key(params['Endpoints'])
+        if key not in self.relations:
+            raise FakeError('relation not found')
+        self._remove_relation(key)
+
+    def _remove_relation(self, key):
+        ends = self.relations.pop(key)
+        for (service, rel), (remote, _) in (ends, ends[::-1]):
+            relations = self.services[service]['Relations']
+            relations.get(rel, []).remove(remote)
+            if not relations.get(rel):
+                relations.pop(rel, None)
+        self._changed(['relation', 'remove', {'Key': key}])
+
+    def do_WatchAll(self, params, op):
+        watcher_id = str(len(self._watchers) + 1)
+        self._watchers[watcher_id] = None
+        return {'AllWatcherId': watcher_id}
+
+    def do_Next(self, params, op):
+        watcher_id = op.get('Id')
+        if watcher_id not in self._watchers:
+            raise FakeError('unknown watcher id')
+        position = self._watchers[watcher_id]
+        if position is None:
+            self._watchers[watcher_id] = len(self._log)
+            return {'Deltas': self._snapshot()}
+        if position < len(self._log):
+            self._watchers[watcher_id] = len(self._log)
+            return {'Deltas': self._log[position:]}
+        result = Future()
+
+        def retry(future):
+            value = self.do_Next(params, op)
+            if isinstance(value, Future):
+                chain_future(value, result)
+            else:
+                result.set_result(value)
+        self.io_loop.add_future(self._waiter, retry)
+        return result
+
+    def do_Stop(self, params, op):
+        self._watchers.pop(op.get('Id'), None)
+
+    def upload_charm(self, series, archive):
+        metadata = yaml.safe_load(
+            zipfile.ZipFile(StringIO(archive)).read('metadata.yaml'))
+        name = metadata['name']
+        revision = len([u for u in self.charms
+                        if u.startswith('local:%s/%s-' % (series, name))])
+        url = 'local:%s/%s-%d' % (series, name, revision)
+        self.charms[url] = len(archive)
+        return url
+
+
+class APIHandler(tornado.websocket.WebSocketHandler):
+    def initialize(self, juju):
+        self.juju = juju
+
+    def check_origin(self, origin):
+        return True
+
+    def open(self):
+        self.juju.sockets.add(self)
+
+    def on_close(self):
+        self.juju.sockets.discard(self)
+
+    def on_message(self, message):
+        future = self.juju.dispatch(json.loads(message))
+        self.juju.io_loop.add_future(future, self._send)
+
+    def _send(self, future):
+        if self.ws_connection is None:
+            return
+        self.write_message(json.dumps(future.result()))
+
+
+class CharmsHandler(tornado.web.RequestHandler):
+    def initialize(self, juju):
+        self.juju = juju
+
+    @gen.coroutine
+    def post(self):
+        delay = self.juju.delay('AddLocalCharm')
+        if delay:
+            yield gen.Task(self.juju.io_loop.add_timeout,
+                           self.juju.io_loop.time() + delay)
+        try:
+            self.juju.count('AddLocalCharm')
+            url = self.juju.upload_charm(self.get_argument('series'),
+                                         self.request.body)
+        except Exception as e:
+            self.set_status(400)
+            self.write({'Error': str(e)})
+            return
+        self.write({'CharmURL': url})
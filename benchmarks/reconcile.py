@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Time and peak memory of the reconciler's strategy building path at
+synthetic scale.
+
+Each size runs in a child process so peak RSS is its own::
+
+    PYTHONPATH=.:charmgen python -m benchmarks.reconcile 10 100 1000 5000
+
+For every size this seeds a StateDatabase from a synthetic status
+served by an in-process FakeEnvironment, builds the strategy for a
+synthetic bundle, rebuilds it unchanged (which should be skipped),
+looks up every relation through RealityIndex and utils.rel_exists,
+and estimates the plan.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import synthetic
+from benchmarks.fake import FakeEnvironment
+
+DEFAULT_SIZES = [10, 100, 1000, 5000]
+
+
+def _timed(results, name, fn, *args):
+    start = time.time()
+    value = fn(*args)
+    results[name] = time.time() - start
+    return value
+
+
+def _peak_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run(size):
+    from cloudfoundry import delta, model, plan, utils
+
+    results = {'size': size, 'baseline_mb': _peak_mb()}
+    expected = synthetic.bundle(size)
+    real = synthetic.status(expected)
+    results['relations'] = len(expected['relations'])
+
+    fake = FakeEnvironment(real)
+
+    class Database(model.StateDatabase):
+        @classmethod
+        def get_env(cls, *args, **kw):
+            return fake
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db = Database({
+            'juju.environment': 'synthetic',
+            'credentials.password': 'secret',
+            'juju.pool_size': 1,
+            'server.repository': os.path.join(tmpdir, 'build'),
+            'journal.path': os.path.join(tmpdir, 'journal.log'),
+            'journal.backups': 1})
+
+        _timed(results, 'seed', lambda: db.reality.seed(db.env.status()))
+        db.expected = expected
+        _timed(results, 'build', db.build_strategy)
+        results['tactics'] = len(db.strategy)
+        strategy = db.strategy
+        db.strategy = db._new_strategy()
+        _timed(results, 'rebuild', db.build_strategy)
+        results['skipped'] = not db.strategy
+
+        pairs = [(a, b) for a, ends in expected['relations'] for b in ends]
+        index = _timed(results, 'index', delta.RealityIndex, real)
+        _timed(results, 'has_relation',
+               lambda: [index.has_relation(a, b) for a, b in pairs])
+        _timed(results, 'rel_exists',
+               lambda: [utils.rel_exists(real, a, b) for a, b in pairs])
+        _timed(results, 'plan', plan.estimate, strategy, db.durations)
+    finally:
+        shutil.rmtree(tmpdir)
+    results['peak_mb'] = _peak_mb()
+    return results
+
+
+def spawn(size):
+    output = subprocess.check_output(
+        [sys.executable, '-m', 'benchmarks.reconcile', '--child', str(size)])
+    return json.loads(output)
+
+
+COLUMNS = [
+    ('size', '%7d'), ('relations', '%9d'), ('tactics', '%7d'),
+    ('seed', '%8.3f'), ('build', '%8.3f'), ('rebuild', '%8.3f'),
+    ('has_relation', '%12.4f'), ('rel_exists', '%10.4f'),
+    ('plan', '%8.3f'), ('peak_mb', '%8.1f'),
+]
+
+
+def report(rows):
+    print ' '.join('%*s' % (len(fmt % 0), name) for name, fmt in COLUMNS)
+    for row in rows:
+        print ' '.join(fmt % row[name] for name, fmt in COLUMNS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('sizes', nargs='*', type=int, default=DEFAULT_SIZES)
+    parser.add_argument('--json', action='store_true',
+                        help='print one JSON document per size')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print json.dumps(run(args.child))
+        return
+
+    rows = [spawn(size) for size in args.sizes]
+    if args.json:
+        for row in rows:
+            print json.dumps(row)
+    else:
+        report(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Synthetic bundles and juju status documents of any size.
+
+Generation is seeded so a given size always produces the same
+documents, and timings stay comparable between runs.
+"""
+import random
+
+
+def service_name(i):
+    return 'svc-%04d' % i
+
+
+def bundle(size, seed=0):
+    """
+    An expected state with `size` services and about as many
+    relations, each service relating to a random earlier one.
+    """
+    rng = random.Random(seed)
+    services = {}
+    relations = []
+    for i in range(size):
+        name = service_name(i)
+        services[name] = {
+            'charm': 'cs:trusty/%s' % name,
+            'num_units': rng.randint(1, 3),
+            'options': {'port': 4000 + i},
+        }
+        if i:
+            remote = service_name(rng.randrange(i))
+            relations.append(['%s:db' % name, ['%s:db-%d' % (remote, i)]])
+    return {'series': 'trusty', 'services': services,
+            'relations': relations}
+
+
+def status(expected, deployed=0.9, related=0.9, seed=0):
+    """
+    FullStatus output for `expected` with only a fraction of its
+    services deployed and relations established.
+    """
+    rng = random.Random(seed)
+    services = {}
+    for name, service in sorted(expected['services'].items()):
+        if rng.random() >= deployed:
+            continue
+        units = {}
+        for n in range(service.get('num_units', 1)):
+            units['%s/%d' % (name, n)] = {
+                'Machine': str(rng.randrange(1000)),
+                'AgentState': 'started',
+                'PublicAddress': '10.0.%d.%d' % (n, rng.randrange(255)),
+            }
+        services[name] = {
+            'Charm': service['charm'] + '-0',
+            'Exposed': False,
+            'Config': dict(service.get('options', {})),
+            'Relations': {},
+            'Units': units,
+        }
+    for end_a, ends in expected['relations']:
+        for end_b in ends:
+            svc_a, rel_a = end_a.split(':')
+            svc_b, rel_b = end_b.split(':')
+            if svc_a not in services or svc_b not in services or \
+                    rng.random() >= related:
+                continue
+            services[svc_a]['Relations'].setdefault(rel_a, []).append(svc_b)
+            services[svc_b]['Relations'].setdefault(rel_b, []).append(svc_a)
+    return {'EnvironmentName': 'synthetic', 'Services': services}
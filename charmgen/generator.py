@@ -1,20 +1,31 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import argparse
+import functools
+import hashlib
+import json
+import multiprocessing
 import os
 import sys
 import shutil
-from itertools import chain
-import inspect
 
 import pkg_resources
 import yaml
 
 try:
-    from cloudfoundry import contexts
+    import cloudfoundry  # noqa
 except ImportError:
     sys.path.append('.')
-    from cloudfoundry import contexts
+
+from charmgen.store import ObjectStore
+from charmgen.topology import (
+    Topology, charm_endpoints, charm_hooks, parse_charm_ref)
+
+
+# Part of every charm's build key, bump it whenever
+# the same inputs would now generate a different charm
+GENERATOR_VERSION = 1
+MANIFEST = 'manifest.json'
 
 
 class CharmGenerator(object):
@@ -25,6 +36,7 @@ class CharmGenerator(object):
         self.release = None
         self.release_version = None
         self.service_registry = service_registry
+        self._topology = None
 
     def select_release(self, version):
         if isinstance(version, basestring):
@@ -42,14 +54,26 @@ class CharmGenerator(object):
             if version < low:
                 continue
             if not high or version <= high:
+                if r is not self.release:
+                    self._topology = None
                 self.release = r
                 self.release_version = version
                 return r
         raise KeyError(version)
 
-    def _is_relation(self, context):
-        return inspect.isclass(context)\
-            and issubclass(context, contexts.RelationContext)
+    @property
+    def topology(self):
+        """The selected release, compiled on first use."""
+        if self._topology is None:
+            self._topology = Topology(self.release, self.service_registry)
+        return self._topology
+
+    def _endpoints(self, charm_name):
+        if self.release is not None and \
+                charm_name in self.topology.provides:
+            return (self.topology.provides[charm_name],
+                    self.topology.requires[charm_name])
+        return charm_endpoints(self.service_registry[charm_name])
 
     def build_metadata(self, service_key):
         # service usage within the topo can include the service name
@@ -57,38 +81,25 @@ class CharmGenerator(object):
         if isinstance(service_key, (tuple, list)):
             service_key = service_key[0]
         service = self.service_registry[service_key]
+        provides, requires = self._endpoints(service_key)
         result = dict(
             name=service_key,
             summary=service.get('summary', ''),
             description=service.get('description', ''),
             author=self.author,
-            requires={
-                contexts.OrchestratorRelation.name: dict(
-                    interface=contexts.OrchestratorRelation.interface)
-            })
-        provides = {}
-        for job in service.get('jobs', []):
-            for relation in job.get('provided_data', []):
-                if self._is_relation(relation):
-                    provides[relation.name] = dict(interface=relation.interface)
-            for relation in job.get('required_data', []):
-                if self._is_relation(relation):
-                    result['requires'][relation.name] = dict(
-                        interface=relation.interface)
+            requires=dict((e.name, dict(interface=e.interface))
+                          for e in requires))
         if provides:
-            result['provides'] = provides
-
+            result['provides'] = dict((e.name, dict(interface=e.interface))
+                                      for e in provides)
         return result
 
     def build_hooks(self, service_key):
-        meta = self.build_metadata(service_key)
-        results = ['start', 'stop', 'config-changed',
-                   'upgrade-charm', 'install', 'health']
-        for rel in chain(meta.get('provides', {}), meta.get('requires', {})):
-            results.append('{}-relation-changed'.format(rel))
-            results.append('{}-relation-joined'.format(rel))
-            results.append('{}-relation-broken'.format(rel))
-        return results
+        if isinstance(service_key, (tuple, list)):
+            service_key = service_key[0]
+        if self.release is not None and service_key in self.topology.hooks:
+            return list(self.topology.hooks[service_key])
+        return list(charm_hooks(*self._endpoints(service_key)))
 
     def build_entry(self, service_key):
         _, name, _ = self._parse_charm_ref(service_key)
@@ -98,7 +109,7 @@ class CharmGenerator(object):
             'job_manager("{}")'.format(name)
         ])
 
-    def generate_charm(self, service_key, target_dir):
+    def generate_charm(self, service_key, target_dir, store=None):
         if not os.path.exists(target_dir):
             os.makedirs(target_dir)
         meta = self.build_metadata(service_key)
@@ -106,8 +117,11 @@ class CharmGenerator(object):
         yaml.safe_dump(meta, meta_target, default_flow_style=False)
         meta_target.close()
 
-        shutil.copyfile(pkg_resources.resource_filename(__name__, '../icon.svg'),
-                        os.path.join(target_dir, 'icon.svg'))
+        icon = pkg_resources.resource_filename(__name__, '../icon.svg')
+        if store is None:
+            shutil.copyfile(icon, os.path.join(target_dir, 'icon.svg'))
+        else:
+            store.link(icon, os.path.join(target_dir, 'icon.svg'))
 
         hook_dir = os.path.join(target_dir, 'hooks')
         if not os.path.exists(hook_dir):
@@ -131,19 +145,7 @@ class CharmGenerator(object):
             )
 
     def _parse_charm_ref(self, service_id):
-        if isinstance(service_id, tuple):
-            charm_id = charm_name = service_id[0]
-            service_name = service_id[1]
-        else:
-            charm_id = charm_name = service_id
-            service_name = service_id
-
-        if '/' in charm_name:
-            charm_name = charm_name.split('/', 1)[1]
-
-        if '/' in service_name:
-            service_name = service_name.split('/', 1)[1]
-        return charm_id, charm_name, service_name
+        return tuple(parse_charm_ref(service_id))
 
     def _normalize_relation(self, rel):
         if isinstance(rel, tuple):
@@ -152,38 +154,10 @@ class CharmGenerator(object):
             return rel
 
     def _get_managed_charms(self):
-        charms = []
-        for service in self.release['topology']['services']:
-            charm_id, charm_name, service_name = self._parse_charm_ref(service)
-            if charm_id.startswith('cs:'):
-                continue
-            if charm_name not in self.service_registry:
-                raise KeyError(
-                    'Missing service_registry definition for charm: {}'.format(
-                        charm_name))
-            charms.append((charm_id, charm_name, service_name))
-        return charms
+        return [tuple(charm) for charm in self.topology.managed]
 
     def _get_relations(self):
-        relations = self.release['topology'].get('relations', [])
-        services = {service_name: self.service_registry[charm_name]
-                    for _, charm_name, service_name in self._get_managed_charms()}
-        provided = {provider.name: service_name
-                    for service_name, service_def in services.iteritems()
-                    for job in service_def.get('jobs', [])
-                    for provider in job.get('provided_data', [])}
-        for service_name, service_def in services.iteritems():
-            for job in service_def.get('jobs', []):
-                for required in job.get('required_data', []):
-                    if not self._is_relation(required):
-                        continue
-                    if not required.name in provided:
-                        continue
-                    provider_name = provided[required.name]
-                    lhs = (service_name, required.name)
-                    rhs = (provider_name, required.name)
-                    relations.append((lhs, rhs))
-        return relations
+        return list(self.topology.relations)
 
     def build_deployment(self):
         services = {}
@@ -196,14 +170,12 @@ class CharmGenerator(object):
         }}
 
         rel_data = {}
-        exposed = set(self.release['topology'].get('expose', []))
-        constraints = self.release['topology'].get('constraints', {})
-        for service_id in self.release['topology']['services']:
-            charm_id, _, service_name = self._parse_charm_ref(service_id)
+        topology = self.topology
+        for charm_id, _, service_name in topology.charms:
             services[service_name] = self._build_charm_ref(charm_id)
-            if service_name in exposed:
+            if service_name in topology.exposed:
                 services[service_name]['expose'] = True
-            constraint = constraints.get(service_name, constraints.get("__default__"))
+            constraint = topology.constraint(service_name)
             if constraint:
                 services[service_name]['constraints'] = constraint
 
@@ -220,35 +192,189 @@ class CharmGenerator(object):
         if not os.path.exists(target_dir):
             os.makedirs(target_dir)
         bundle = self.build_deployment()
-        target = os.path.join(target_dir, 'bundles.yaml')
-        with open(target, 'w') as fp:
-            yaml.safe_dump(bundle, fp, default_flow_style=False)
-            fp.flush()
-
-    def generate(self, target_dir):
+        # the deployer takes the bundle to mean the repo
+        # is complete, so it must never be seen half written
+        _write_atomic(os.path.join(target_dir, 'bundles.yaml'),
+                      yaml.safe_dump(bundle, default_flow_style=False))
+
+    def _sources_digest(self, store):
+        # what every charm ships besides its own metadata and hooks
+        h = hashlib.sha1()
+        icon = pkg_resources.resource_filename(__name__, '../icon.svg')
+        h.update(store.digest(icon))
+        for source, _ in self._shared_trees(''):
+            for dirpath, dirnames, filenames in os.walk(source,
+                                                        followlinks=True):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    filename = os.path.join(dirpath, name)
+                    h.update(os.path.relpath(filename, source))
+                    h.update(store.digest(filename))
+        return h.hexdigest()
+
+    def build_key(self, charm_name, sources):
+        """
+        Hash of everything `charm_name` is generated from, given the
+        digest of the shared sources.
+        """
+        h = hashlib.sha1(str(GENERATOR_VERSION))
+        h.update(sources)
+        h.update(json.dumps(self.service_registry[charm_name],
+                            sort_keys=True, default=_describe))
+        return h.hexdigest()
+
+    def build_keys(self, store):
+        """Build keys of the managed charms, by charm name."""
+        sources = self._sources_digest(store)
+        return dict((name, self.build_key(name, sources))
+                    for _, name, _ in self._get_managed_charms())
+
+    def outdated(self, target_dir, store=None):
+        """
+        Names of the charms built into `target_dir` from what has
+        changed since, so that generating rebuilds them. Charms never
+        built there aren't included.
+        """
+        built = _read_manifest(target_dir)
+        if not built:
+            return []
+        if store is None:
+            store = ObjectStore(os.path.join(target_dir, '.objects'))
+        return sorted(name for name, key in self.build_keys(store).items()
+                      if name in built and built[name] != key)
+
+    def _shared_trees(self, charm_path):
+        # (source, target) of what every managed charm ships
+        return [
+            (pkg_resources.resource_filename(__name__, '../cloudfoundry'),
+             os.path.join(charm_path, 'hooks', 'cloudfoundry')),
+            (pkg_resources.resource_filename(__name__, '../files'),
+             os.path.join(charm_path, 'files')),
+            # charmhelpers goes into the hook_dir
+            (pkg_resources.resource_filename(
+                __name__, '../hooks/charmhelpers'),
+             os.path.join(charm_path, 'hooks', 'charmhelpers')),
+        ]
+
+    def build_charm(self, charm_name, repo, store):
+        charm_path = os.path.join(repo, charm_name)
+        if not os.path.exists(charm_path):
+            os.makedirs(charm_path)
+        self.generate_charm(charm_name, charm_path, store)
+        for source, target in self._shared_trees(charm_path):
+            store.link_tree(source, target)
+
+    def generate(self, target_dir, store=None, workers=None):
+        """
+        Write the managed charms of the selected release, then the
+        bundle. Returns the names of the charms (re)built.
+
+        A manifest in `target_dir` records what each charm was built
+        from, so generating into an existing build only rebuilds the
+        charms whose service definition, shared sources or generator
+        changed.
+
+        Charms are built by `workers` processes (one per CPU by
+        default). Files shared by every charm are hardlinked from
+        `store`, by default an ObjectStore in `target_dir`; pass one
+        kept beside several release builds to have them share their
+        files too.
+        """
         # Ensure that both the target dir
         # and its 'trusty' subdir exists
         repo = os.path.join(target_dir, 'trusty')
         if not os.path.exists(repo):
             os.makedirs(repo)
+        bundle = os.path.join(target_dir, 'bundles.yaml')
+        if os.path.exists(bundle):
+            os.unlink(bundle)
+        if store is None:
+            store = ObjectStore(os.path.join(target_dir, '.objects'))
+
+        charms = [name for _, name, _ in self._get_managed_charms()]
+        manifest_path = os.path.join(target_dir, MANIFEST)
+        built = _read_manifest(target_dir)
+        keys = self.build_keys(store)
+        stale = [name for name in charms if built.get(name) != keys[name] or
+                 not os.path.isdir(os.path.join(repo, name))]
+
+        # forget what is about to be removed before removing it,
+        # so a failed build can't leave a charm recorded as current
+        current = dict((name, key) for name, key in built.items()
+                       if keys.get(name) == key and name not in stale)
+        if current != built:
+            _write_atomic(manifest_path, json.dumps(current, indent=2,
+                                                    sort_keys=True))
+        for name in sorted(set(built) - set(current) | set(stale)):
+            charm_path = os.path.join(repo, name)
+            if os.path.isdir(charm_path):
+                shutil.rmtree(charm_path)
+
+        if stale:
+            # store the shared files up front, so workers only link
+            for source, _ in self._shared_trees(repo):
+                store.put_tree(source)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = min(workers, len(stale))
+        if workers > 1:
+            # forked workers inherit the generator and store,
+            # only charm names are sent through the pool
+            pool = multiprocessing.Pool(
+                workers, _init_worker, (self, repo, store))
+            try:
+                pool.map(_build_charm, stale, chunksize=1)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for charm_name in stale:
+                self.build_charm(charm_name, repo, store)
+
+        _write_atomic(manifest_path, json.dumps(keys, indent=2,
+                                                sort_keys=True))
         self.generate_deployment(target_dir)
+        return stale
 
-        for _, charm_name, _ in self._get_managed_charms():
-            charm_path = os.path.join(repo, charm_name)
-            if not os.path.exists(charm_path):
-                os.makedirs(charm_path)
-
-            self.generate_charm(charm_name, charm_path)
-            shutil.copytree(pkg_resources.resource_filename(
-                __name__, '../cloudfoundry'),
-                os.path.join(charm_path, 'hooks', 'cloudfoundry'))
-            shutil.copytree(pkg_resources.resource_filename(
-                __name__, '../files'),
-                os.path.join(charm_path, 'files'))
-            # copy charmhelpers into the hook_dir
-            shutil.copytree(pkg_resources.resource_filename(
-                __name__, '../hooks/charmhelpers'),
-                os.path.join(charm_path, 'hooks', 'charmhelpers'))
+
+def _read_manifest(target_dir):
+    manifest_path = os.path.join(target_dir, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as fp:
+        return json.load(fp)
+
+
+def _write_atomic(target, data):
+    with open(target + '.tmp', 'w') as fp:
+        fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(target + '.tmp', target)
+
+
+def _describe(obj):
+    # a stable stand-in for the functions and classes
+    # in service definitions, for hashing them
+    if isinstance(obj, functools.partial):
+        return [_describe(obj.func), obj.args, obj.keywords or {}]
+    if hasattr(obj, '__name__'):
+        return '%s.%s' % (getattr(obj, '__module__', None), obj.__name__)
+    return repr(obj)
+
+
+# (generator, repo, store) in a generate() worker process
+_worker = None
+
+
+def _init_worker(generator, repo, store):
+    global _worker
+    _worker = generator, repo, store
+
+
+def _build_charm(charm_name):
+    generator, repo, store = _worker
+    generator.build_charm(charm_name, repo, store)
 
 
 def main(args=None):
@@ -258,6 +384,9 @@ def main(args=None):
     parser.add_argument('release', type=int)
     parser.add_argument('-d', '--directory', dest="directory")
     parser.add_argument('-f', '--force', action="store_true")
+    parser.add_argument('-j', '--workers', type=int,
+                        help="Processes to build charms with "
+                             "(default: one per CPU)")
     options = parser.parse_args(args)
 
     using_default_dir = False
@@ -276,7 +405,7 @@ def main(args=None):
 
     g = CharmGenerator(RELEASES, SERVICES)
     g.select_release(options.release)
-    g.generate(options.directory)
+    g.generate(options.directory, workers=options.workers)
 
 if __name__ == '__main__':
     main()
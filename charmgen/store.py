@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed file store for generated charms.
+
+Every managed charm ships the same cloudfoundry package, files and
+charmhelpers. Rather than copying them into each charm, their
+contents are stored once under the build dir and hardlinked into
+place, so a release build costs about the same whatever the number
+of charms, and releases built into the same store share files too.
+"""
+import errno
+import hashlib
+import os
+import shutil
+import stat
+
+from cloudfoundry.charms import FileDigests
+
+
+class ObjectStore(object):
+    def __init__(self, root):
+        self.root = root
+        self._files = FileDigests()
+
+    def digest(self, source):
+        # files only differing in mode are different objects,
+        # as every link to an object shares its mode
+        mode = stat.S_IMODE(os.stat(source).st_mode)
+        return hashlib.sha1('%o\0%s' % (
+            mode, self._files.digest(source))).hexdigest()
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def put(self, source):
+        """Store the contents of `source`, returning the object path."""
+        obj = self.path(self.digest(source))
+        if os.path.exists(obj):
+            return obj
+        parent = os.path.dirname(obj)
+        try:
+            os.makedirs(parent)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # write aside and rename so concurrent builds never
+        # link a partially written object
+        tmp = '%s.%d.tmp' % (obj, os.getpid())
+        shutil.copy2(source, tmp)
+        os.rename(tmp, obj)
+        return obj
+
+    def put_tree(self, source):
+        for dirpath, dirnames, filenames in os.walk(source, followlinks=True):
+            for name in filenames:
+                self.put(os.path.join(dirpath, name))
+
+    def link(self, source, target):
+        obj = self.put(source)
+        if os.path.lexists(target):
+            os.unlink(target)
+        try:
+            os.link(obj, target)
+        except OSError as e:
+            # a store on another filesystem still saves the hashing
+            if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                raise
+            shutil.copy2(obj, target)
+
+    def link_tree(self, source, target):
+        """
+        Like shutil.copytree (symlinks followed), but hardlinking
+        every file from the store.
+        """
+        for dirpath, dirnames, filenames in os.walk(source, followlinks=True):
+            dest = os.path.join(target, os.path.relpath(dirpath, source))
+            if not os.path.isdir(dest):
+                os.makedirs(dest)
+            for name in filenames:
+                self.link(os.path.join(dirpath, name),
+                          os.path.join(dest, name))
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+A release topology and the service registry, compiled once into
+indexed, immutable lookups for the generator.
+"""
+import inspect
+from collections import namedtuple
+
+from cloudfoundry import contexts
+
+# charm_id is what the topology names ("cs:trusty/mysql", "nats-v1"),
+# name the bare charm name and service_name the deployed service
+Charm = namedtuple('Charm', 'charm_id name service_name')
+Endpoint = namedtuple('Endpoint', 'name interface')
+
+ORCHESTRATOR = Endpoint(contexts.OrchestratorRelation.name,
+                        contexts.OrchestratorRelation.interface)
+
+STANDARD_HOOKS = ('start', 'stop', 'config-changed',
+                  'upgrade-charm', 'install', 'health')
+
+
+def is_relation(context):
+    return inspect.isclass(context)\
+        and issubclass(context, contexts.RelationContext)
+
+
+def parse_charm_ref(service_id):
+    if isinstance(service_id, tuple):
+        charm_id = charm_name = service_id[0]
+        service_name = service_id[1]
+    else:
+        charm_id = charm_name = service_id
+        service_name = service_id
+
+    if '/' in charm_name:
+        charm_name = charm_name.split('/', 1)[1]
+
+    if '/' in service_name:
+        service_name = service_name.split('/', 1)[1]
+    return Charm(charm_id, charm_name, service_name)
+
+
+def _unique(endpoints):
+    # last one wins, as when building a dict keyed by name
+    seen = {}
+    for endpoint in endpoints:
+        seen[endpoint.name] = endpoint
+    return tuple(seen[name] for name in sorted(seen))
+
+
+def charm_endpoints(service):
+    """(provides, requires) Endpoints of a service definition."""
+    provides, requires = [], [ORCHESTRATOR]
+    for job in service.get('jobs', []):
+        provides.extend(Endpoint(r.name, r.interface)
+                        for r in job.get('provided_data', [])
+                        if is_relation(r))
+        requires.extend(Endpoint(r.name, r.interface)
+                        for r in job.get('required_data', [])
+                        if is_relation(r))
+    return _unique(provides), _unique(requires)
+
+
+def charm_hooks(provides, requires):
+    hooks = list(STANDARD_HOOKS)
+    for endpoint in provides + requires:
+        hooks.append('{}-relation-changed'.format(endpoint.name))
+        hooks.append('{}-relation-joined'.format(endpoint.name))
+        hooks.append('{}-relation-broken'.format(endpoint.name))
+    return tuple(hooks)
+
+
+class Topology(object):
+    """
+    Everything generation needs to know about one release.
+
+    Built once from the release and the service registry and never
+    changed afterwards; nothing in the release or registry is
+    modified either, so releases sharing lists (COMMON_RELATIONS)
+    stay as they were written.
+    """
+    def __init__(self, release, service_registry):
+        topology = release['topology']
+        self.charms = tuple(parse_charm_ref(s) for s in topology['services'])
+        self.managed = tuple(c for c in self.charms
+                             if not c.charm_id.startswith('cs:'))
+        for charm in self.managed:
+            if charm.name not in service_registry:
+                raise KeyError(
+                    'Missing service_registry definition for charm: {}'.format(
+                        charm.name))
+
+        # charm name -> provided and required Endpoints, hooks
+        self.provides, self.requires, self.hooks = {}, {}, {}
+        for charm in self.managed:
+            provides, requires = charm_endpoints(
+                service_registry[charm.name])
+            self.provides[charm.name] = provides
+            self.requires[charm.name] = requires
+            self.hooks[charm.name] = charm_hooks(provides, requires)
+
+        # relation name -> the managed service providing it
+        self.providers = {}
+        for charm in self.managed:
+            for job in service_registry[charm.name].get('jobs', []):
+                for provider in job.get('provided_data', []):
+                    self.providers[provider.name] = charm.service_name
+        # (service, relation name) pairs requiring a provided relation
+        self.requirers = tuple(
+            (charm.service_name, endpoint.name)
+            for charm in self.managed
+            for endpoint in self.requires[charm.name]
+            if endpoint.name in self.providers)
+
+        self.relations = tuple(topology.get('relations', [])) + tuple(
+            ((service, name), (self.providers[name], name))
+            for service, name in self.requirers)
+        self.exposed = frozenset(topology.get('expose', []))
+        self.constraints = tuple(sorted(
+            topology.get('constraints', {}).items()))
+
+    def constraint(self, service_name):
+        constraints = dict(self.constraints)
+        return constraints.get(service_name, constraints.get('__default__'))
@@ -1,7 +1,6 @@
 import datetime
 import logging
 import os
-import shutil
 
 from cloudfoundry.config import (
     PENDING, COMPLETE, RUNNING, FAILED, STATES
@@ -9,26 +8,71 @@ from cloudfoundry.config import (
 
 from deployer.charm import Charm
 from deployer.service import Service
-from deployer.utils import get_qualified_charm_url
+from jujuclient import EnvError
 
 
 from charmgen.generator import CharmGenerator
+from charmgen.store import ObjectStore
+from cloudfoundry.charms import CharmArchives, split_revision
+from cloudfoundry.executor import run_in_process
 from cloudfoundry.releases import RELEASES
 from cloudfoundry.services import SERVICES
 
 
 class Tactic(object):
+    # Retry policy, see Strategy. A failed tactic is tried again up
+    # to `retries` times, waiting `backoff` seconds doubling after
+    # every attempt; an attempt running past `timeout` seconds counts
+    # as failed.
+    retries = 0
+    backoff = 2.0
+    timeout = None
+
     def __init__(self,  **kwargs):
         self.state = PENDING
         self.failure = None
         self.start_time = None
         self.end_time = None
+        self.attempts = 0
+        # CharmRevisions shared by the tactics of a strategy
+        self.charms = kwargs.pop('charms', None)
         self.kwargs = kwargs
 
     def __str__(self):
         return "%s [%s]: %s" % (self.name, STATES[self.state], self.kwargs)
 
-    def run(self, env):
+    def describe(self):
+        """The arguments worth recording about this tactic."""
+        return self.kwargs
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'tactic': self.__class__.__name__,
+            'state': STATES[self.state],
+            'args': self.describe(),
+            'start_time': self.start_time and self.start_time.isoformat(),
+            'end_time': self.end_time and self.end_time.isoformat(),
+            'failure': self.failure and str(self.failure),
+            'attempts': self.attempts,
+        }
+
+    def provides(self):
+        """Keys of the things this tactic brings into existence."""
+        return set()
+
+    def requires(self):
+        """Keys this tactic depends on, see Strategy.compile."""
+        return set()
+
+    def run(self, env, attempt=None):
+        # An attempt the strategy gave up on (timed out) may still
+        # start or finish later, it must leave the state alone then
+        if attempt is None:
+            self.attempts += 1
+            attempt = self.attempts
+        if attempt != self.attempts:
+            return
         if self.state != PENDING:
             raise ValueError("strategy out of order")
         self.start_time = datetime.datetime.now()
@@ -36,49 +80,140 @@ class Tactic(object):
         try:
             logging.debug("Running %s", self)
             self._run(env, **self.kwargs)
-            self.state = COMPLETE
+            state, failure = COMPLETE, None
         except Exception, e:
             logging.debug("Tactic Failed", exc_info=True)
-            self.state = FAILED
-            self.failure = e
-        finally:
+            state, failure = FAILED, e
+        if attempt == self.attempts and self.state == RUNNING:
+            self.state, self.failure = state, failure
             self.end_time = datetime.datetime.now()
 
+    def _done_before(self, error, *messages):
+        """
+        Whether `error` only says an earlier attempt got through, its
+        reply having been lost (with the connection, say).
+        """
+        return self.attempts > 1 and isinstance(error, EnvError) and \
+            any(message in error.message for message in messages)
+
+    def fail(self, failure):
+        """Mark the current attempt failed from outside."""
+        self.state = FAILED
+        self.failure = failure
+        self.end_time = datetime.datetime.now()
+
+    def reset(self):
+        """Make a failed tactic runnable again."""
+        self.state = PENDING
+        self.start_time = self.end_time = None
+
 
 class GenerateTactic(Tactic):
     name = "Generate charms"
+    timeout = 1800
+
+    def provides(self):
+        return set([('repo', self.kwargs['repo'])])
 
     def _run(self, env,  **kwargs):
         version = kwargs.get('cf_release',  RELEASES[0]['releases'][1])
         build_dir = os.path.join(kwargs['repo'], str(version))
-        if os.path.exists(build_dir):
-            return
+        # an existing build is brought up to date, rebuilding only
+        # the charms whose inputs changed. Generation is CPU bound,
+        # keep it off the reconciler's GIL
+        run_in_process(self._generate, version, build_dir,
+                       os.path.join(kwargs['repo'], '.objects'),
+                       kwargs.get('workers'))
+
+    @staticmethod
+    def _generate(version, build_dir, objects, workers):
         generator = CharmGenerator(RELEASES, SERVICES)
         generator.select_release(version)
-        generator.generate(build_dir)
+        generator.generate(build_dir, ObjectStore(objects), workers)
+
+
+def local_charm_path(repo, charm_url, version=None):
+    """(series, path) of the tree a `local:` charm URL is built in."""
+    series, charm_name = split_revision(charm_url)[0][6:].split('/')
+    version = version or RELEASES[0]['releases'][1]
+    return series, os.path.join(repo, str(version), series, charm_name)
+
+
+# objects dir -> ObjectStore, to keep hashes of the shared sources
+_stores = {}
+
+
+def outdated_charms(repo, version=None):
+    """
+    Names of the charms generated into `repo` that generating again
+    would rebuild, their definition or shared sources having changed.
+    """
+    version = version or RELEASES[0]['releases'][1]
+    objects = os.path.join(repo, '.objects')
+    store = _stores.get(objects)
+    if store is None:
+        store = _stores[objects] = ObjectStore(objects)
+    generator = CharmGenerator(RELEASES, SERVICES)
+    generator.select_release(version)
+    return generator.outdated(os.path.join(repo, str(version)), store)
 
 
 class UpdateCharmTactic(Tactic):
     name = "Update charm"
+    retries = 3
+    timeout = 600
+
+    def provides(self):
+        return set([('charm', self.kwargs['charm_url'])])
+
+    def requires(self):
+        return set([('repo', self.kwargs['repo'])])
 
     def _run(self, env, **kwargs):
-        charm_url = get_qualified_charm_url(kwargs['charm_url'])
-        if charm_url.startswith('local:'):
-            series, charm_id = charm_url.split(':')[1].split('/')
-            charm_name = charm_id.rsplit('-', 1)[0]
-            charm_file = os.path.join('/tmp', charm_id)
-            version = kwargs.get('cf_release',  RELEASES[0]['releases'][1])
-            charm_path = os.path.join(kwargs['repo'],
-                                      str(version), series, charm_name)
-            shutil.make_archive(charm_file, 'zip', charm_path)
-            archive = charm_file + '.zip'
-            size = os.path.getsize(archive)
-            with open(archive) as fp:
-                env.add_local_charm(fp, series, size)
+        charm_url = kwargs['charm_url']
+        if not charm_url.startswith('local:'):
+            return
+        series, charm_path = local_charm_path(
+            kwargs['repo'], charm_url, kwargs.get('cf_release'))
+        archives = self.charms.archives if self.charms else CharmArchives()
+        digest, fp, size = archives.open(charm_path)
+        with fp:
+            # the controller already has this very tree
+            if self.charms and self.charms.uploaded(charm_url, digest):
+                return
+            result = env.add_local_charm(fp, series, size)
+        if self.charms is not None:
+            self.charms.record_upload(charm_url, digest, result['CharmURL'])
+
+
+def _resolve(charms, charm_url):
+    # local charms get their revision from juju on upload
+    if not charm_url.startswith('local:'):
+        return charm_url
+    resolved = charms and charms.resolve(charm_url)
+    if not resolved:
+        raise ValueError("No uploaded revision of %s" % charm_url)
+    return resolved
 
 
 class DeployTactic(Tactic):
     name = "Deploy"
+    retries = 2
+    timeout = 300
+
+    def describe(self):
+        return {'service_name': self.kwargs['service']['service_name'],
+                'repo': self.kwargs['repo']}
+
+    def provides(self):
+        return set([('service', self.kwargs['service']['service_name'])])
+
+    def requires(self):
+        result = set([('repo', self.kwargs['repo'])])
+        branch = self.kwargs['service'].get('branch')
+        if branch:
+            result.add(('charm', branch))
+        return result
 
     def _run(self, env, **kwargs):
         s = kwargs['service']
@@ -87,19 +222,60 @@ class DeployTactic(Tactic):
         charm = Charm.from_service(s['service_name'],
                                    os.path.join(kwargs['repo'], str(version)),
                                    'trusty', s)
-        env.deploy(svc.name,
-                   # XXX version hack, have to probe for actual version after
-                   # push
-                   charm.charm_url + "-0",
-                   config=svc.config,
-                   constraints=svc.constraints,
-                   num_units=svc.num_units)
+        charm_url = _resolve(self.charms, charm.charm_url)
+        if not charm_url.startswith('local:'):
+            env.add_charm(charm_url)
+        try:
+            env.deploy(svc.name,
+                       charm_url,
+                       config=svc.config,
+                       constraints=svc.constraints,
+                       num_units=svc.num_units)
+        except EnvError as e:
+            if not self._done_before(e, 'already exists'):
+                raise
         if svc.expose:
-            env.expose(svc.name)
+            try:
+                env.expose(svc.name)
+            except EnvError as e:
+                if not self._done_before(e, 'already exposed'):
+                    raise
+
+
+class UpgradeCharmTactic(Tactic):
+    name = "Upgrade charm"
+    retries = 2
+    timeout = 120
+
+    def provides(self):
+        # config and units of the service wait for the new charm
+        return set([('service', self.kwargs['service_name'])])
+
+    def requires(self):
+        if self.kwargs['charm_url'].startswith('local:'):
+            return set([('charm', self.kwargs['charm_url'])])
+        return set()
+
+    def _run(self, env, **kwargs):
+        charm_url = None
+        if self.charms and kwargs.get('repo') and \
+                kwargs['charm_url'].startswith('local:'):
+            # the upload of the tree built now, not just the latest one
+            _, charm_path = local_charm_path(
+                kwargs['repo'], kwargs['charm_url'], kwargs.get('cf_release'))
+            charm_url = self.charms.uploaded(
+                kwargs['charm_url'],
+                self.charms.archives.tree_hash(charm_path))
+        charm_url = charm_url or _resolve(self.charms, kwargs['charm_url'])
+        if not charm_url.startswith('local:'):
+            env.add_charm(charm_url)
+        env.set_charm(kwargs['service_name'], charm_url)
 
 
 class RemoveServiceTactic(Tactic):
     name = "Remove Service"
+    retries = 5
+    timeout = 120
 
     def _run(self, env, **kwargs):
         env.destroy_service(kwargs['service_name'])
@@ -107,13 +283,61 @@ class RemoveServiceTactic(Tactic):
 
 class AddRelationTactic(Tactic):
     name = "Add Relation"
+    retries = 5
+    timeout = 120
+
+    def requires(self):
+        return set(('service', endpoint.split(':')[0]) for endpoint in
+                   (self.kwargs['endpoint_a'], self.kwargs['endpoint_b']))
 
     def _run(self, env, **kwargs):
-        env.add_relation(kwargs['endpoint_a'], kwargs['endpoint_b'])
+        try:
+            env.add_relation(kwargs['endpoint_a'], kwargs['endpoint_b'])
+        except EnvError as e:
+            if not self._done_before(e, 'already exists'):
+                raise
 
 
 class RemoveRelationTactic(Tactic):
-    name = "Add Relation"
+    name = "Remove Relation"
+    retries = 5
+    timeout = 120
 
     def _run(self, env, **kwargs):
         env.remove_relation(kwargs['endpoint_a'], kwargs['endpoint_b'])
+
+
+class SetConfigTactic(Tactic):
+    name = "Set Config"
+    retries = 5
+    timeout = 120
+
+    def requires(self):
+        return set([('service', self.kwargs['service_name'])])
+
+    def _run(self, env, **kwargs):
+        env.set_config(kwargs['service_name'], kwargs['config'])
+
+
+class AddUnitsTactic(Tactic):
+    name = "Add Units"
+    retries = 5
+    timeout = 120
+
+    def requires(self):
+        return set([('service', self.kwargs['service_name'])])
+
+    def _run(self, env, **kwargs):
+        env.add_units(kwargs['service_name'], kwargs['num_units'])
+
+
+class RemoveUnitsTactic(Tactic):
+    name = "Remove Units"
+    retries = 5
+    timeout = 120
+
+    def requires(self):
+        return set([('service', self.kwargs['service_name'])])
+
+    def _run(self, env, **kwargs):
+        env.remove_units(kwargs['unit_names'])
@@ -1,5 +1,7 @@
+import errno
 import os
-import shutil
+import socket
+import time
 from charmhelpers.core import hookenv
 
 from deployer.env.gui import GUIEnvironment
@@ -7,6 +9,9 @@ from deployer.utils import get_qualified_charm_url
 from deployer.utils import parse_constraints
 from deployer.deployment import Deployment
 
+from cloudfoundry.charms import CharmArchives
+from cloudfoundry.client import PipelinedEnvironment
+
 
 class JujuLoggingDeployment(Deployment):
     def _handle_feedback(self, feedback):
@@ -21,6 +26,26 @@ class APIEnvironment(GUIEnvironment):
     """
     Environment subclass that uses the APi but supports local charms.
     """
+    def connect(self):
+        # Same as GoEnvironment.connect, but with a client
+        # that can pipeline and batch requests
+        if self.client is not None:
+            return
+        while True:
+            try:
+                self.client = PipelinedEnvironment(self.api_endpoint)
+            except socket.error as err:
+                if err.errno not in (
+                        errno.ETIMEDOUT, errno.ECONNREFUSED, errno.ECONNRESET):
+                    raise
+                time.sleep(1)
+                continue
+            break
+        self.client.login(self._get_token())
+
+    def add_relations(self, endpoint_pairs):
+        return self.client.add_relations(endpoint_pairs)
+
     def deploy(self, name, charm_url, repo=None, config=None, constraints=None,
                num_units=1, force_machine=None):
         charm_url = get_qualified_charm_url(charm_url)
@@ -28,12 +53,10 @@ class APIEnvironment(GUIEnvironment):
         if charm_url.startswith('local:'):
             series, charm_id = charm_url.split(':')[1].split('/')
             charm_name = charm_id.rsplit('-', 1)[0]
-            charm_file = os.path.join('/tmp', charm_id)
             charm_path = os.path.join(repo, series, charm_name)
-            shutil.make_archive(charm_file, 'zip', charm_path)
-            archive = charm_file + '.zip'
-            size = os.path.getsize(archive)
-            with open(archive) as fp:
+            # streamed straight into the upload, no zip on disk
+            digest, fp, size = CharmArchives().open(charm_path)
+            with fp:
                 self.client.add_local_charm(fp, series, size)
         else:
             self.client.add_charm(charm_url)
@@ -0,0 +1,256 @@
+"""
+Bookkeeping for the charms in an environment, and the archives
+local charms are uploaded as.
+"""
+import hashlib
+import json
+import os
+import re
+import stat
+import struct
+import threading
+import zlib
+
+_REVISION = re.compile(r'^(.*)-(\d+)$')
+
+
+def split_revision(charm_url):
+    """("local:trusty/nats-v1", 3) for "local:trusty/nats-v1-3"."""
+    match = _REVISION.match(charm_url or '')
+    if not match:
+        return charm_url, None
+    return match.group(1), int(match.group(2))
+
+
+class CharmRevisions(object):
+    """
+    The newest revision of every charm we know of, keyed by the
+    charm URL without its revision.
+
+    Juju picks the revision of an uploaded local charm, so the URL
+    it hands back is recorded here for deploys and upgrades to use,
+    along with the hash of the tree uploaded. Juju can't tell us the
+    latter, so uploads are kept in the file at `path` when given.
+    """
+    def __init__(self, archives=None, path=None):
+        self.revisions = {}
+        self.archives = archives or CharmArchives()
+        self.path = path
+        # (unrevisioned URL, tree hash) -> uploaded charm URL
+        self.uploads = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as fp:
+                for charm_url, digest, uploaded_url in json.load(fp):
+                    self.record_upload(charm_url, digest, uploaded_url,
+                                       save=False)
+
+    def record(self, charm_url):
+        base, revision = split_revision(charm_url)
+        if revision is None:
+            return
+        with self._lock:
+            if revision >= self.revisions.get(base, -1):
+                self.revisions[base] = revision
+
+    def record_upload(self, charm_url, digest, uploaded_url, save=True):
+        self.record(uploaded_url)
+        with self._lock:
+            self.uploads[(charm_url, digest)] = uploaded_url
+            if save and self.path:
+                self._save()
+
+    def _save(self):
+        parent = os.path.dirname(self.path)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+        with open(self.path + '.tmp', 'w') as fp:
+            json.dump(sorted([url, digest, uploaded] for (url, digest),
+                             uploaded in self.uploads.items()), fp)
+        os.rename(self.path + '.tmp', self.path)
+
+    def uploaded(self, charm_url, digest):
+        """The URL `charm_url` was uploaded as with tree hash `digest`."""
+        with self._lock:
+            return self.uploads.get((charm_url, digest))
+
+    def stale(self, charm_url, charm_path, deployed):
+        """
+        Whether `deployed` isn't the upload of the tree at
+        `charm_path`, the local charm `charm_url` is built in.
+
+        A tree we never uploaded is only known to be new if other
+        trees were uploaded under that name; a charm deployed some
+        other way (by the deployer hook) is taken as current.
+        """
+        if not os.path.isdir(charm_path):
+            return False
+        digest = self.archives.tree_hash(charm_path)
+        with self._lock:
+            uploaded = self.uploads.get((charm_url, digest))
+            if uploaded:
+                return uploaded != deployed
+            return any(url == charm_url for url, _ in self.uploads)
+
+    def seed(self, status):
+        """Learn the revisions deployed according to a status."""
+        for service in (status.get('Services') or {}).values():
+            self.record(service.get('Charm'))
+
+    def resolve(self, charm_url):
+        """The newest revision of unrevisioned `charm_url`, or None."""
+        with self._lock:
+            revision = self.revisions.get(charm_url)
+        if revision is None:
+            return None
+        return '%s-%d' % (charm_url, revision)
+
+
+# Every archive entry is dated 1980-01-01 00:00 (in DOS format),
+# so the same tree always zips to the same bytes
+_DOS_TIME, _DOS_DATE = 0, (0 << 9) | (1 << 5) | 1
+
+_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+_DESCRIPTOR = struct.Struct('<4sLLL')
+_CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+_END = struct.Struct('<4s4H2LH')
+# entries are stored and sizes and CRCs follow the data
+_FLAGS = 0x08
+
+
+def _walk(charm_path):
+    # (relative name, path) of every file, symlinks followed as
+    # zipfile would, in a stable order
+    files = []
+    for dirpath, dirnames, filenames in os.walk(charm_path,
+                                                followlinks=True):
+        for name in filenames:
+            filename = os.path.join(dirpath, name)
+            files.append((os.path.relpath(filename, charm_path), filename))
+    return sorted(files)
+
+
+class ZipStream(object):
+    """
+    A zip archive of `files` ((name, path) pairs), produced as it is
+    read rather than written out first.
+
+    Entries are stored uncompressed, so the archive's `size` is known
+    up front from the file sizes, and each CRC goes in a data
+    descriptor after the entry's data.
+    """
+    def __init__(self, files):
+        self.files = []
+        for name, filename in files:
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            self.files.append((name, filename, os.stat(filename)))
+        self.size = _END.size
+        for name, filename, st in self.files:
+            if st.st_size >= 1 << 32:
+                raise ValueError("%s is too large to archive" % filename)
+            self.size += (_LOCAL_HEADER.size + _DESCRIPTOR.size +
+                          _CENTRAL_HEADER.size + 2 * len(name) + st.st_size)
+        self._chunks = self._generate()
+        self._buffer = ''
+
+    def _generate(self):
+        offset = 0
+        central = []
+        for name, filename, st in self.files:
+            header = _LOCAL_HEADER.pack(
+                'PK\x03\x04', 20, 0, _FLAGS, 0, _DOS_TIME, _DOS_DATE,
+                0, 0, 0, len(name), 0) + name
+            yield header
+            crc = size = 0
+            with open(filename, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(1 << 16), ''):
+                    crc = zlib.crc32(chunk, crc)
+                    size += len(chunk)
+                    yield chunk
+            if size != st.st_size:
+                raise IOError("%s changed while archiving" % filename)
+            crc &= 0xffffffff
+            yield _DESCRIPTOR.pack('PK\x07\x08', crc, size, size)
+            mode = stat.S_IFREG | stat.S_IMODE(st.st_mode)
+            central.append(_CENTRAL_HEADER.pack(
+                'PK\x01\x02', 20, 3, 20, 0, _FLAGS, 0, _DOS_TIME, _DOS_DATE,
+                crc, size, size, len(name), 0, 0, 0, 0, mode << 16,
+                offset) + name)
+            offset += len(header) + size + _DESCRIPTOR.size
+        directory = ''.join(central)
+        yield directory
+        yield _END.pack('PK\x05\x06', 0, 0, len(central), len(central),
+                        len(directory), offset, 0)
+
+    def read(self, n=-1):
+        while n < 0 or len(self._buffer) < n:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if n < 0:
+            n = len(self._buffer)
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+    def close(self):
+        self._chunks.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FileDigests(object):
+    """
+    SHA1 of file contents, remembered until the file changes, so
+    hashing a tree again only reads what was rebuilt.
+    """
+    def __init__(self):
+        # path -> (size, mtime, inode), digest
+        self._digests = {}
+
+    def digest(self, filename):
+        st = os.stat(filename)
+        key = (st.st_size, st.st_mtime, st.st_ino)
+        cached = self._digests.get(filename)
+        if cached and cached[0] == key:
+            return cached[1]
+        h = hashlib.sha1()
+        with open(filename, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 16), ''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self._digests[filename] = (key, digest)
+        return digest
+
+
+class CharmArchives(object):
+    """
+    Archives of charm trees to upload, and the hashes identifying them.
+    """
+    def __init__(self):
+        self._files = FileDigests()
+
+    def _tree_hash(self, files):
+        h = hashlib.sha1()
+        for name, filename in files:
+            mode = stat.S_IMODE(os.stat(filename).st_mode)
+            h.update('%s\0%o\0%s\0' % (
+                name, mode, self._files.digest(filename)))
+        return h.hexdigest()
+
+    def tree_hash(self, charm_path):
+        return self._tree_hash(_walk(charm_path))
+
+    def open(self, charm_path):
+        """
+        (tree hash, archive stream, archive size) for the charm at
+        `charm_path`.
+        """
+        files = _walk(charm_path)
+        stream = ZipStream(files)
+        return self._tree_hash(files), stream, stream.size
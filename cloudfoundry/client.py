@@ -0,0 +1,349 @@
+"""
+Juju API client that pipelines requests over a single websocket, and
+a small self-healing pool of those connections.
+"""
+import httplib
+import json
+import logging
+import threading
+import time
+
+from base64 import b64encode
+from jujuclient import EnvError, Environment, LoginRequired
+
+from cloudfoundry import metrics
+
+API_CALLS = metrics.Counter(
+    'cloudfoundry_juju_api_calls_total',
+    'Juju API requests, by request type and outcome.',
+    ['environment', 'request', 'result'])
+API_LATENCY = metrics.Histogram(
+    'cloudfoundry_juju_api_latency_seconds',
+    'Juju API round trip time, by request type.',
+    ['environment', 'request'])
+
+
+def _observe(environment, request, start, error=None):
+    API_LATENCY.observe(time.time() - start,
+                        environment=environment, request=request)
+    API_CALLS.inc(environment=environment, request=request,
+                  result='error' if error else 'ok')
+
+
+class ConnectionLost(EnvError):
+    """The websocket went away with the request unanswered."""
+    def __init__(self, reason):
+        super(ConnectionLost, self).__init__(
+            {'Error': 'connection lost: %s' % (reason or 'closed')})
+
+
+class _Slot(object):
+    """Where the reader thread drops the response to one request."""
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class PipelinedEnvironment(Environment):
+    """
+    Environment multiplexing concurrent requests over one connection.
+
+    Every request is tagged with a RequestId and a reader thread hands
+    each response to whoever is waiting on that id, so calls from
+    several threads are in flight at once instead of taking turns on
+    the socket. `batch` goes a step further and puts a whole list of
+    requests on the wire before waiting for any of them; the deploy
+    hook uses it for the orchestrator relations, while tactics make
+    single calls and get their overlap from running side by side.
+    """
+    # the environment name API metrics are labelled with
+    env_name = ''
+
+    def __init__(self, *args, **kwargs):
+        super(PipelinedEnvironment, self).__init__(*args, **kwargs)
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._reader = None
+        self.broken = False
+
+    @property
+    def healthy(self):
+        return not self.broken and bool(self.conn and self.conn.connected)
+
+    def _rpc(self, op):
+        start = time.time()
+        try:
+            result = self._result(self._send(op))
+        except Exception:
+            _observe(self.env_name, op['Request'], start, error=True)
+            raise
+        _observe(self.env_name, op['Request'], start)
+        return result
+
+    def add_local_charm(self, charm_file, series, size=None):
+        start = time.time()
+        try:
+            result = self._upload_charm(charm_file, series, size)
+        except Exception:
+            _observe(self.env_name, 'AddLocalCharm', start, error=True)
+            raise
+        _observe(self.env_name, 'AddLocalCharm', start)
+        return result
+
+    def _upload_charm(self, charm_file, series, size=None):
+        # Like Environment.add_local_charm, but a plain ws://
+        # endpoint (a test server) gets a plain HTTP upload
+        scheme, endpoint = self.endpoint.split('://', 1)
+        host, port = endpoint.split('/', 1)[0].split(':')
+        if scheme == 'ws':
+            conn = httplib.HTTPConnection(host, port)
+        else:
+            conn = httplib.HTTPSConnection(host, port)
+        headers = {
+            'Content-Type': 'application/zip',
+            'Authorization': 'Basic %s' % b64encode(
+                '%(user)s:%(password)s' % self._creds)}
+        if size:
+            headers['Content-Length'] = size
+        conn.request("POST", "/charms?series=%s" % series, charm_file,
+                     headers)
+        response = conn.getresponse()
+        result = json.loads(response.read())
+        if not response.status == 200:
+            raise EnvError(result)
+        return result
+
+    def get_watch(self, *args, **kwargs):
+        watcher = super(PipelinedEnvironment, self).get_watch(*args, **kwargs)
+        # the pool hands back only the watcher, so it carries
+        # the way to stop it and drop it from this environment
+        watcher.release = lambda: self._release_watch(watcher)
+        return watcher
+
+    def _release_watch(self, watcher):
+        if watcher in self._watches:
+            self._watches.remove(watcher)
+        try:
+            watcher.stop()
+        except Exception:
+            logging.debug("Error stopping juju watcher", exc_info=True)
+
+    def _send(self, op):
+        if not self._auth and not op.get("Request") == "Login":
+            raise LoginRequired()
+        if 'Params' not in op:
+            op['Params'] = {}
+        slot = _Slot()
+        with self._send_lock:
+            if self.broken:
+                raise ConnectionLost('broken')
+            op['RequestId'] = self._request_id
+            self._request_id += 1
+            self._pending[op['RequestId']] = slot
+            if self._reader is None:
+                self._reader = threading.Thread(
+                    target=self._read, name='juju-api-reader')
+                self._reader.daemon = True
+                self._reader.start()
+            try:
+                self.conn.send(json.dumps(op))
+            except Exception as e:
+                self._pending.pop(op['RequestId'], None)
+                self.broken = True
+                raise ConnectionLost(e)
+        return slot
+
+    def _result(self, slot):
+        slot.event.wait()
+        if slot.error is not None:
+            raise slot.error
+        if 'Error' in slot.response:
+            raise EnvError(slot.response)
+        return slot.response['Response']
+
+    def _read(self):
+        while True:
+            try:
+                raw = self.conn.recv()
+                if not raw:
+                    raise ConnectionLost('closed')
+                response = json.loads(raw)
+            except Exception as e:
+                if not isinstance(e, ConnectionLost):
+                    e = ConnectionLost(e)
+                self._fail_pending(e)
+                return
+            slot = self._pending.pop(response.get('RequestId'), None)
+            if slot is None:
+                logging.warning("Dropping unexpected response %s", raw)
+                continue
+            slot.response = response
+            slot.event.set()
+
+    def _fail_pending(self, error):
+        with self._send_lock:
+            pending, self._pending = self._pending, {}
+            self._reader = None
+            self.broken = True
+        for slot in pending.values():
+            slot.error = error
+            slot.event.set()
+
+    def batch(self, ops):
+        """
+        Send all of `ops` before reading any response.
+
+        Returns the responses in order; failed requests come back as
+        EnvError instances rather than raising, so one bad request
+        doesn't hide the outcome of the rest.
+        """
+        start = time.time()
+        slots = [self._send(op) for op in ops]
+        results = []
+        for op, slot in zip(ops, slots):
+            try:
+                results.append(self._result(slot))
+            except EnvError as e:
+                results.append(e)
+            _observe(self.env_name, op['Request'], start,
+                     isinstance(results[-1], EnvError))
+        return results
+
+    def add_relations(self, endpoint_pairs):
+        return self.batch([{
+            'Type': 'Client',
+            'Request': 'AddRelation',
+            'Params': {'Endpoints': [a, b]}} for a, b in endpoint_pairs])
+
+
+# Calls that are safe to send again when the connection
+# they went out on died before an answer came back
+IDEMPOTENT = frozenset([
+    'info', 'status', 'get_charm', 'get_service', 'get_config',
+    'get_constraints', 'get_env_config', 'get_env_constraints',
+    'get_annotation', 'get_stat', 'add_charm', 'set_config',
+    'set_constraints', 'expose', 'unexpose',
+])
+
+
+class EnvironmentPool(object):
+    """
+    A few PipelinedEnvironments to the same state server.
+
+    Each call goes to the least busy connection with room for it,
+    connections are opened lazily by `factory` (which must return a
+    logged-in environment) and one that breaks is replaced on next
+    use. Idempotent calls that lost their connection are retried
+    once on a fresh one; anything else raises ConnectionLost.
+
+    Everything not defined here is proxied through `call`, so the
+    pool stands in for an Environment.
+    """
+    def __init__(self, factory, size=2, max_in_flight=8):
+        self.factory = factory
+        self.size = size
+        self.max_in_flight = max_in_flight
+        self.reconnects = 0
+        self._conns = [None] * size
+        self._in_flight = [0] * size
+        self._cond = threading.Condition()
+        self._connecting = [threading.Lock() for i in range(size)]
+
+    def __getattr__(self, name):
+        if name.startswith('_') or \
+                not callable(getattr(PipelinedEnvironment, name, None)):
+            raise AttributeError(name)
+
+        def method(*args, **kw):
+            return self.call(name, *args, **kw)
+        method.__name__ = name
+        return method
+
+    def call(self, name, *args, **kw):
+        attempts = 2 if name in IDEMPOTENT else 1
+        for attempt in range(attempts):
+            index = self._acquire()
+            try:
+                env = self._connection(index)
+                return getattr(env, name)(*args, **kw)
+            except ConnectionLost:
+                logging.warning("Juju API connection lost during %s", name)
+                if attempt + 1 == attempts:
+                    raise
+            finally:
+                self._release(index)
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                free = [i for i in range(self.size)
+                        if self._in_flight[i] < self.max_in_flight]
+                if free:
+                    break
+                self._cond.wait()
+            index = min(free, key=lambda i: (self._in_flight[i], i))
+            self._in_flight[index] += 1
+            return index
+
+    def _release(self, index):
+        with self._cond:
+            self._in_flight[index] -= 1
+            self._cond.notify()
+
+    def _connection(self, index):
+        with self._connecting[index]:
+            env = self._conns[index]
+            if env is not None and env.healthy:
+                return env
+            if env is not None:
+                self.reconnects += 1
+                self._close(env)
+            self._conns[index] = None
+            env = self._conns[index] = self.factory()
+            return env
+
+    def _close(self, env):
+        try:
+            env.close()
+        except Exception:
+            logging.debug("Error closing juju API connection",
+                          exc_info=True)
+
+    def check(self):
+        """
+        Ping idle connections, dropping the ones that don't answer.
+
+        Meant to be run periodically so a dead controller is noticed
+        before a tactic trips over it.
+        """
+        for index in range(self.size):
+            with self._cond:
+                env = self._conns[index]
+                if env is None or self._in_flight[index]:
+                    continue
+                self._in_flight[index] += 1
+            try:
+                if env.healthy:
+                    env.info()
+            except ConnectionLost:
+                pass
+            except EnvError:
+                # an API level error still means it answered
+                continue
+            finally:
+                self._release(index)
+            if not env.healthy:
+                logging.info("Dropping dead juju API connection %d", index)
+                with self._connecting[index]:
+                    if self._conns[index] is env:
+                        self._conns[index] = None
+                        self.reconnects += 1
+                        self._close(env)
+
+    def close(self):
+        for index in range(self.size):
+            with self._connecting[index]:
+                env, self._conns[index] = self._conns[index], None
+            if env is not None:
+                self._close(env)
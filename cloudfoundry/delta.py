@@ -0,0 +1,223 @@
+"""
+Three-way merge of the previous expected state, the current
+expected state and reality into a list of tactics.
+
+Expected states are in bundle format while reality is juju-core
+FullStatus output, so the key names differ between the two.
+"""
+import hashlib
+import json
+import logging
+
+from cloudfoundry import actions
+from cloudfoundry import utils
+from cloudfoundry.charms import split_revision
+
+
+def split_endpoint(endpoint):
+    if ':' in endpoint:
+        return tuple(endpoint.split(':', 1))
+    return endpoint, None
+
+
+class RealityIndex(object):
+    """
+    Hashed lookups over a status document, built once per diff.
+    """
+    def __init__(self, real):
+        self.services = real.get('Services') or {}
+        # (service, relation name) -> remote services
+        self.endpoints = {}
+        # unordered service pairs with any relation
+        self.pairs = set()
+        for rel in utils.flatten_reality(real):
+            # one side is always "service:relation", the
+            # other the bare remote service name
+            local, remote = rel if ':' in rel[0] else rel[::-1]
+            service, name = split_endpoint(local)
+            self.endpoints.setdefault((service, name), set()).add(remote)
+            self.pairs.add(frozenset((service, remote)))
+
+    def has_relation(self, end_a, end_b):
+        svc_a, rel_a = split_endpoint(end_a)
+        svc_b, rel_b = split_endpoint(end_b)
+        if rel_a:
+            return svc_b in self.endpoints.get((svc_a, rel_a), ())
+        if rel_b:
+            return svc_a in self.endpoints.get((svc_b, rel_b), ())
+        return frozenset((svc_a, svc_b)) in self.pairs
+
+
+def fingerprint(real):
+    """
+    Hash of what a diff reads from a status document, leaving out
+    churn like agent states and addresses.
+    """
+    services = {}
+    for name, service in (real.get('Services') or {}).items():
+        services[name] = [
+            service.get('Charm'),
+            service.get('Exposed'),
+            service.get('Config'),
+            dict((k, sorted(v)) for k, v in
+                 (service.get('Relations') or {}).items()),
+            sorted(service.get('Units') or {}),
+        ]
+    return hashlib.sha1(json.dumps(services, sort_keys=True)).hexdigest()
+
+
+def _options(service):
+    return (service or {}).get('options') or {}
+
+
+def diff_config(name, expected, previous, real):
+    # Prefer the settings reported by the watcher, otherwise fall back
+    # to what changed between the previous and current expected state.
+    options = _options(expected)
+    real_config = real.get('Config')
+    if real_config is not None:
+        changed = dict((k, v) for k, v in options.items()
+                       if real_config.get(k) != v)
+    elif options != _options(previous):
+        changed = options
+    else:
+        changed = {}
+    if changed:
+        return [actions.SetConfigTactic(service_name=name, config=changed)]
+    return []
+
+
+def diff_charm(name, expected, real, charms=None, repo=None, outdated=()):
+    """
+    Upgrade services whose deployed charm isn't the expected one.
+
+    Deployed charm URLs always carry a revision, expected ones may
+    (a pinned store charm) or may not. A new CF release changes the
+    names of the generated local charms, so those get upgraded too,
+    as do local charms changed under the same name: with `charms` and
+    `repo`, those in `outdated` (about to be regenerated) and those
+    whose tree in `repo` isn't the upload the service runs.
+    """
+    charm_url = expected.get('branch') or expected.get('charm') or ''
+    deployed = real.get('Charm')
+    if ':' not in charm_url or not deployed:
+        return []
+    if charm_url == deployed:
+        return []
+    if charm_url == split_revision(deployed)[0]:
+        if not (charm_url.startswith('local:') and charms and repo):
+            return []
+        _, charm_path = actions.local_charm_path(repo, charm_url)
+        if charm_url.split('/')[-1] not in outdated and \
+                not charms.stale(charm_url, charm_path, deployed):
+            return []
+    return [actions.UpgradeCharmTactic(service_name=name, charm_url=charm_url,
+                                       repo=repo, charms=charms)]
+
+
+def _unit_number(unit_name):
+    return int(unit_name.rsplit('/', 1)[1])
+
+
+def _removal_order(units):
+    # units in error go first, then the most recently added
+    def key(item):
+        name, unit = item
+        broken = unit.get('AgentState') == 'error' or bool(unit.get('Err'))
+        return (not broken, -_unit_number(name))
+    return [name for name, unit in sorted(units.items(), key=key)]
+
+
+def diff_units(name, expected, real):
+    # Only services that pin a unit count are scaled
+    if 'num_units' not in expected:
+        return []
+    want = int(expected['num_units'])
+    # units already on their way out don't count
+    units = dict((n, u or {}) for n, u in (real.get('Units') or {}).items()
+                 if (u or {}).get('Life') not in ('dying', 'dead'))
+    if want > len(units):
+        return [actions.AddUnitsTactic(service_name=name,
+                                       num_units=want - len(units))]
+    if want < len(units):
+        doomed = _removal_order(units)[:len(units) - want]
+        return [actions.RemoveUnitsTactic(
+            service_name=name, unit_names=sorted(doomed, key=_unit_number))]
+    return []
+
+
+def three_way(previous, expected, real, repo, charms=None, workers=None):
+    """
+    Compute the tactics moving reality to `expected`.
+
+    Things are only removed if they were part of `previous`, so
+    anything deployed by hand alongside the bundle is left alone.
+    `charms` (a CharmRevisions) is where uploads are recorded and
+    deploys and upgrades look up local charm revisions. `workers`
+    is the number of processes to generate charms with.
+    """
+    result = []
+    if not expected:
+        return result
+    previous = previous or {}
+    index = RealityIndex(real)
+    current = expected.get('services', {})
+    prev = previous.get('services', {})
+    # local charms to upload, once each
+    uploads = set()
+    # and those whose generated tree is out of date
+    outdated = actions.outdated_charms(repo) if charms is not None else ()
+
+    for service_name in sorted(current):
+        service = current[service_name]
+        real_service = index.services.get(service_name)
+        if real_service is None:
+            service = service.copy()
+            service['service_name'] = service_name
+            branch = service.get('branch')
+            if branch and branch.startswith('local:'):
+                uploads.add(branch)
+            result.append(actions.DeployTactic(service=service, repo=repo,
+                                               charms=charms))
+            continue
+        upgrade = diff_charm(service_name, service, real_service,
+                             charms, repo, outdated)
+        for tactic in upgrade:
+            if tactic.kwargs['charm_url'].startswith('local:'):
+                uploads.add(tactic.kwargs['charm_url'])
+        result.extend(upgrade)
+        result.extend(diff_config(service_name, service,
+                                  prev.get(service_name), real_service))
+        result.extend(diff_units(service_name, service, real_service))
+
+    for branch in sorted(uploads, reverse=True):
+        result.insert(0, actions.UpdateCharmTactic(
+            charm_url=branch, repo=repo, charms=charms))
+
+    for service_name in sorted(set(prev) - set(current)):
+        if service_name in index.services:
+            result.append(actions.RemoveServiceTactic(
+                service_name=service_name))
+
+    crels = utils.flatten_relations(expected.get('relations', []))
+    prels = utils.flatten_relations(previous.get('relations', []))
+    for end_a, end_b in sorted(crels):
+        if not index.has_relation(end_a, end_b):
+            result.append(actions.AddRelationTactic(
+                endpoint_a=end_a, endpoint_b=end_b))
+    for end_a, end_b in sorted(prels - crels):
+        # relations of removed services go with the service
+        if split_endpoint(end_a)[0] not in current or \
+                split_endpoint(end_b)[0] not in current:
+            continue
+        if index.has_relation(end_a, end_b):
+            result.append(actions.RemoveRelationTactic(
+                endpoint_a=end_a, endpoint_b=end_b))
+
+    # charms only need generating when something is
+    # going to be uploaded or deployed from the repo
+    if any(('repo', repo) in t.requires() for t in result):
+        result.insert(0, actions.GenerateTactic(repo=repo, workers=workers))
+
+    logging.debug("Delta %s", [str(t) for t in result])
+    return result
@@ -0,0 +1,45 @@
+"""
+Strategy progress events for long-poll and server-sent-event clients.
+"""
+import collections
+import itertools
+import json
+
+from tornado.concurrent import Future
+
+
+class EventLog(object):
+    """
+    A bounded, sequenced log of events.
+
+    Events are serialized once when published; subscribers get the
+    encoded payloads and all share a single Future to wait on, so the
+    cost of a publish doesn't grow with the number of clients.
+    """
+    def __init__(self, size=1000):
+        self.events = collections.deque(maxlen=size)
+        self.last_id = 0
+        self._waiter = None
+
+    def publish(self, kind, **data):
+        self.last_id += 1
+        data.update(id=self.last_id, type=kind)
+        self.events.append(
+            (self.last_id, json.dumps(data, separators=(',', ':'))))
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            waiter.set_result(self.last_id)
+
+    def since(self, last_id):
+        """(id, payload) pairs published after `last_id`."""
+        if not self.events:
+            return []
+        # ids are contiguous, so we can index straight in
+        start = max(last_id + 1 - self.events[0][0], 0)
+        return list(itertools.islice(self.events, start, None))
+
+    def wait(self):
+        """A Future resolved by the next publish."""
+        if self._waiter is None:
+            self._waiter = Future()
+        return self._waiter
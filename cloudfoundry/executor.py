@@ -0,0 +1,192 @@
+"""
+Run blocking work off the IOLoop.
+"""
+import collections
+import multiprocessing
+import sys
+import threading
+
+import tornado.ioloop
+from tornado.concurrent import Future
+
+# Upper bound on child processes forked by run_in_process
+MAX_PROCESSES = 2
+_process_slots = threading.BoundedSemaphore(MAX_PROCESSES)
+
+
+class ThreadPool(object):
+    """
+    A bounded pool of worker threads.
+
+    Results are handed back on the IOLoop as tornado Futures,
+    so coroutines can simply yield on them.
+
+    Work can be split into lanes, served round-robin and each with
+    an optional cap on the workers it may occupy at once, so one
+    lane with a deep queue of slow work can't starve the others.
+    """
+    def __init__(self, workers=4, io_loop=None):
+        self.workers = workers
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self._cond = threading.Condition()
+        self._lanes = []
+        self._turn = 0
+        self._threads = []
+        self._default = self.lane(None)
+
+    def lane(self, key, limit=None):
+        with self._cond:
+            for lane in self._lanes:
+                if lane.key == key:
+                    return lane
+            lane = Lane(self, key, limit)
+            self._lanes.append(lane)
+            return lane
+
+    def submit(self, fn, *args, **kwargs):
+        return self._default.submit(fn, *args, **kwargs)
+
+    def _put(self, lane, item):
+        with self._cond:
+            lane.queue.append(item)
+            self._cond.notify()
+            if len(self._threads) < self.workers:
+                worker = threading.Thread(
+                    target=self._work,
+                    name='worker-%d' % len(self._threads))
+                worker.daemon = True
+                self._threads.append(worker)
+                worker.start()
+
+    def _next(self):
+        # the first lane with work and room for
+        # it, starting after the last one served
+        count = len(self._lanes)
+        for i in range(count):
+            lane = self._lanes[(self._turn + i) % count]
+            if lane.queue and (lane.limit is None or lane.busy < lane.limit):
+                self._turn = (self._turn + i + 1) % count
+                lane.busy += 1
+                return lane, lane.queue.popleft()
+        return None, None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                lane, item = self._next()
+                while lane is None:
+                    self._cond.wait()
+                    lane, item = self._next()
+            future, fn, args, kwargs = item
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                self.io_loop.add_callback(future.set_exc_info,
+                                          sys.exc_info())
+            else:
+                self.io_loop.add_callback(future.set_result, result)
+            finally:
+                with self._cond:
+                    lane.busy -= 1
+                    self._cond.notify()
+
+
+class Lane(object):
+    """A named queue of a ThreadPool."""
+    def __init__(self, pool, key, limit=None):
+        self.pool = pool
+        self.key = key
+        self.limit = limit
+        self.busy = 0
+        self.queue = collections.deque()
+
+    @property
+    def io_loop(self):
+        return self.pool.io_loop
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        self.pool._put(self, (future, fn, args, kwargs))
+        return future
+
+
+def first_completed(futures, io_loop=None):
+    """Return a Future resolving to the first of `futures` to finish."""
+    io_loop = io_loop or tornado.ioloop.IOLoop.current()
+    result = Future()
+
+    def done(future):
+        if not result.done():
+            result.set_result(future)
+
+    for future in futures:
+        io_loop.add_future(future, done)
+    return result
+
+
+def run_in_process(fn, *args, **kwargs):
+    """
+    Run `fn` in a forked child, blocking the calling worker thread
+    until it is done.
+
+    CPU bound work (charm generation) would otherwise hold the GIL
+    away from the IOLoop. The child is not a daemon so it may use
+    its own process pool.
+    """
+    reader, writer = multiprocessing.Pipe(duplex=False)
+
+    def target():
+        try:
+            result = ('ok', fn(*args, **kwargs))
+        except Exception as e:
+            result = ('error', e)
+        try:
+            writer.send(result)
+        except Exception:
+            writer.send(('error', RuntimeError(repr(result[1]))))
+
+    with _process_slots:
+        child = multiprocessing.Process(target=target)
+        child.start()
+        writer.close()
+        try:
+            status, value = reader.recv()
+        except EOFError:
+            status, value = 'error', RuntimeError(
+                'child process exited with %s' % child.exitcode)
+        child.join()
+    if status == 'error':
+        raise value
+    return value
+
+
+class Guard(object):
+    """
+    Non-blocking mutual exclusion for code running on the IOLoop.
+
+    acquire() never waits, it tells the caller whether it now owns
+    the guard; wait() gives a Future for the current holder.
+    """
+    def __init__(self):
+        self._future = None
+
+    @property
+    def locked(self):
+        return self._future is not None
+
+    def acquire(self):
+        if self.locked:
+            return False
+        self._future = Future()
+        return True
+
+    def release(self):
+        future, self._future = self._future, None
+        future.set_result(None)
+
+    def wait(self):
+        if self._future is None:
+            future = Future()
+            future.set_result(None)
+            return future
+        return self._future
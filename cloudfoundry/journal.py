@@ -0,0 +1,92 @@
+"""
+Append-only on-disk record of finished strategies.
+"""
+import collections
+import json
+import os
+
+
+def reverse_lines(filename, block_size=8192):
+    """Yield the lines of a file last to first, reading from the end."""
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'rb') as fp:
+        fp.seek(0, os.SEEK_END)
+        pos = fp.tell()
+        tail = ''
+        while pos > 0:
+            size = min(block_size, pos)
+            pos -= size
+            fp.seek(pos)
+            lines = (fp.read(size) + tail).split('\n')
+            tail = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line
+        if tail:
+            yield tail
+
+
+class Journal(object):
+    """
+    Strategies are written as JSON lines to `filename`. Once that grows
+    past `max_bytes` it is rotated to filename.1 .. filename.<backups>
+    and the oldest is dropped; without backups it is just emptied.
+
+    The last `recent` entries are kept in memory, newest first, so the
+    common case of looking at the latest history never touches disk.
+    """
+    def __init__(self, filename, max_bytes=1024 * 1024, backups=5,
+                 recent=50):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.recent = collections.deque(maxlen=recent)
+        for line in self._lines():
+            if len(self.recent) == recent:
+                break
+            self.recent.append(json.loads(line))
+
+    @property
+    def files(self):
+        return [self.filename] + ['%s.%d' % (self.filename, i)
+                                  for i in range(1, self.backups + 1)]
+
+    def append(self, entry):
+        line = json.dumps(entry, separators=(',', ':'))
+        with open(self.filename, 'a') as fp:
+            fp.write(line + '\n')
+            size = fp.tell()
+        self.recent.appendleft(entry)
+        if size > self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        if not self.backups:
+            open(self.filename, 'w').close()
+            return
+        files = self.files
+        for older, newer in reversed(zip(files[1:], files[:-1])):
+            if os.path.exists(newer):
+                os.rename(newer, older)
+
+    def _lines(self):
+        for filename in self.files:
+            for line in reverse_lines(filename):
+                yield line
+
+    def page(self, offset=0, limit=20):
+        """Entries newest first, only reading as much as the page needs."""
+        if offset + limit <= len(self.recent):
+            return list(self.recent)[offset:offset + limit]
+        result = []
+        for i, line in enumerate(self._lines()):
+            if i < offset:
+                continue
+            if len(result) == limit:
+                break
+            result.append(json.loads(line))
+        return result
@@ -0,0 +1,149 @@
+"""
+Minimal Prometheus-style instrumentation for the reconciler.
+
+Metrics register themselves with REGISTRY when created and are
+rendered in the Prometheus text exposition format.
+"""
+import contextlib
+import threading
+import time
+
+
+def _label_str(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (n, str(v).replace('\\', r'\\').replace('"', r'\"'))
+        for n, v in zip(names, values))
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, doc, labels=(), registry=None):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels):
+        # a label the metric wasn't declared with would
+        # otherwise fold its series into one
+        unknown = set(labels) - set(self.labels)
+        if unknown:
+            raise ValueError('%s has no label %s' % (
+                self.name, ', '.join(sorted(unknown))))
+        return tuple(labels.get(n, '') for n in self.labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield self.name, _label_str(self.labels, key), value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.doc),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append('%s%s %s' % (name, labels, repr(float(value))))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, *args, **kw):
+        super(Gauge, self).__init__(*args, **kw)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, fn, **labels):
+        """Read the value from `fn()` at render time."""
+        with self._lock:
+            self._functions[self._key(labels)] = fn
+
+    def value(self, **labels):
+        key = self._key(labels)
+        if key in self._functions:
+            return self._functions[key]()
+        return self._values.get(key, 0)
+
+    def samples(self):
+        with self._lock:
+            keys = sorted(set(self._values) | set(self._functions))
+        for key in keys:
+            yield self.name, _label_str(self.labels, key), \
+                self.value(**dict(zip(self.labels, key)))
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    # seconds, from an API round trip to a slow deploy
+    BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10,
+               30, 60, 120, 300, 600)
+
+    def __init__(self, name, doc, labels=(), registry=None, buckets=None):
+        super(Histogram, self).__init__(name, doc, labels, registry)
+        self.buckets = tuple(sorted(buckets or self.BUCKETS))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, n = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [c + (value <= b) for c, b in zip(counts, self.buckets)]
+            self._values[key] = (counts, total + value, n + 1)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def count(self, **labels):
+        return self._values.get(self._key(labels), (None, 0, 0))[2]
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        names = self.labels + ('le',)
+        for key, (buckets, total, n) in items:
+            for bound, count in zip(self.buckets, buckets):
+                yield (self.name + '_bucket',
+                       _label_str(names, key + (repr(float(bound)),)), count)
+            yield self.name + '_bucket', _label_str(names, key + ('+Inf',)), n
+            yield self.name + '_sum', _label_str(self.labels, key), total
+            yield self.name + '_count', _label_str(self.labels, key), n
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        return '\n'.join(m.render() for m in self.metrics) + '\n'
+
+
+REGISTRY = Registry()
@@ -1,149 +1,375 @@
+import copy
+import datetime
+import gzip
+import hashlib
+import json
 import logging
 import threading
 import os
+import time
+from cStringIO import StringIO
 
 import tornado.ioloop
 from tornado import gen
+from tornado.concurrent import Future
 
-from cloudfoundry import actions
-from config import (PENDING, COMPLETE, FAILED, RUNNING)
+from cloudfoundry import delta
+from cloudfoundry import metrics
+from cloudfoundry import plan
 from cloudfoundry import utils
+from cloudfoundry.charms import CharmRevisions
+from cloudfoundry.client import EnvironmentPool, PipelinedEnvironment
+from cloudfoundry.events import EventLog
+from cloudfoundry.journal import Journal
+from cloudfoundry.executor import Guard, ThreadPool, first_completed
+from config import (PENDING, COMPLETE, FAILED, RUNNING, STATES)
 
-from jujuclient import Environment
+# Config every environment starts from; the server config file, and
+# the per environment overrides in it, are merged over these.
+# juju.environment defaults to the current juju environment.
+DEFAULTS = {
+    'server.address': '127.0.0.1',
+    'server.port': 8888,
+    'server.repository': 'build',
+    'credentials.user': 'user-admin',
+    'strategy.concurrency': 4,
+    # processes generating charms, None for one per CPU
+    'generate.workers': None,
+    'reconcile.debounce': 0.5,
+    'reconcile.max_delay': 5,
+    'journal.path': os.path.expanduser(
+        '~/.config/juju-deployer/journal.log'),
+    'journal.max_bytes': 1024 * 1024,
+    'journal.backups': 5,
+    'journal.recent': 50,
+    'juju.pool_size': 2,
+    'juju.max_in_flight': 8,
+    'juju.health_interval': 30,
+}
+
+
+def with_defaults(config):
+    """`config` merged over DEFAULTS, as a NestedDict."""
+    result = utils.NestedDict(DEFAULTS)
+    result.update(config)
+    return result
+
+
+def _merge_states(previous, expected):
+    """
+    Services and relations of both states, those of `expected`
+    winning, so either one's removals are found by the next diff.
+    """
+    services = dict(previous.get('services', {}))
+    services.update(expected.get('services', {}))
+    relations = list(previous.get('relations', []))
+    relations.extend(r for r in expected.get('relations', [])
+                     if r not in relations)
+    return {'services': services, 'relations': relations}
+
+
+RECONCILE_PASSES = metrics.Counter(
+    'cloudfoundry_reconcile_passes_total',
+    'Reconcile passes, by whether the diff was skipped as unchanged.',
+    ['environment', 'result'])
+STRATEGIES = metrics.Counter(
+    'cloudfoundry_strategies_total',
+    'Strategies run to the end, by final state.',
+    ['environment', 'result'])
+TACTIC_DURATION = metrics.Histogram(
+    'cloudfoundry_tactic_duration_seconds',
+    'Wall time of finished tactics, by tactic class.',
+    ['environment', 'tactic'])
+TACTIC_RETRIES = metrics.Counter(
+    'cloudfoundry_tactic_retries_total',
+    'Failed tactic attempts scheduled to run again, by tactic class.',
+    ['environment', 'tactic'])
+PENDING_TACTICS = metrics.Gauge(
+    'cloudfoundry_pending_tactics',
+    'Tactics of the current strategy waiting to run.',
+    ['environment'])
 
 
 class StateDatabase(object):
-    def __init__(self, config):
-        self.config = config
+    def __init__(self, config, executor=None, name=None):
+        self.config = config = with_defaults(config)
+        self.name = name or config['juju.environment']
         self._env = None
+        # encodings of expected, cached per version
+        self._encoded = {}
+        self.expected_version = 0
         # expected is the state we are
         # transitioning to
         self.expected = {}
-        # previous is the last (optional)
-        # expected state
+        # previous is the last (optional) expected
+        # state, as far as it was known to be applied
         self.previous = {}
-        self.strategy = Strategy(self.env)
-        self.history = []
-        self.exec_lock = threading.Lock()
+        # (expected hash, reality fingerprint) of
+        # the last state we built a strategy from
+        self.reconciled = None
+        # reality is seeded from a single status
+        # call and then kept current by the watcher
+        self.reality = Reality()
+        # uploads are per controller, so per environment
+        self.charms = CharmRevisions(path=os.path.join(
+            config['server.repository'], '.uploads-%s.json' % self.name))
+        self.concurrency = config['strategy.concurrency']
+        # environments sharing a process share one pool,
+        # each queueing on its own lane of it
+        self.executor = executor or ThreadPool(self.concurrency)
+        self.events = EventLog()
+        self.strategy = self._new_strategy()
+        self.history = Journal(
+            config['journal.path'],
+            max_bytes=config['journal.max_bytes'],
+            backups=config['journal.backups'],
+            recent=config['journal.recent'])
+        self.durations = plan.Durations()
+        for entry in reversed(self.history.recent):
+            self.durations.record(entry)
+        self.exec_lock = Guard()
+        PENDING_TACTICS.set_function(
+            lambda: sum(1 for t in self.strategy if t.state == PENDING),
+            environment=self.name)
+
+    @property
+    def expected(self):
+        return self._expected
+
+    @expected.setter
+    def expected(self, value):
+        self._expected = value
+        self.expected_version += 1
+        self._encoded = {}
+
+    def encode_expected(self, compress=False):
+        """
+        Compact JSON of the expected state, optionally gzipped.
+
+        Encodings are computed once per version of expected, so
+        repeated reads cost nothing while it's unchanged.
+        """
+        key = 'gzip' if compress else 'json'
+        if key not in self._encoded:
+            if compress:
+                buf = StringIO()
+                # fixed mtime so the bytes only depend on the content
+                with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as fp:
+                    fp.write(self.encode_expected())
+                self._encoded[key] = buf.getvalue()
+            else:
+                self._encoded[key] = json.dumps(
+                    self._expected, sort_keys=True, separators=(',', ':'))
+        return self._encoded[key]
+
+    @property
+    def expected_hash(self):
+        """Content hash of the expected state."""
+        if 'hash' not in self._encoded:
+            self._encoded['hash'] = hashlib.sha1(
+                self.encode_expected()).hexdigest()
+        return self._encoded['hash']
 
     def reset(self):
         self.expected = {}
+        self.reconciled = None
+        self._settle(self.strategy)
         self._reset_strategy()
 
+    def _settle(self, strategy):
+        """
+        Move `previous` on by a strategy that ended or was dropped.
+
+        Only a complete (or empty) strategy made reality its expected
+        state; otherwise what it was moving to is merged in, so
+        removals that didn't happen are computed (and tried) again.
+        """
+        if strategy.expected is None:
+            return
+        if strategy.state == COMPLETE or not strategy:
+            self.previous = strategy.expected
+        else:
+            self.previous = _merge_states(self.previous, strategy.expected)
+        strategy.expected = None
+
     def _reset_strategy(self):
         if self.strategy:
-            self.history.append(self.strategy)
-        self.strategy = Strategy(self.env)
+            entry = self.strategy.as_dict()
+            self.history.append(entry)
+            self.durations.record(entry)
+        self.strategy = self._new_strategy()
+
+    def _new_strategy(self):
+        return Strategy(self.env, self.executor, self.concurrency,
+                        self.events, environment=self.name)
 
     @property
     def env(self):
+        # A pool rather than one connection, so a controller
+        # restart costs a reconnect instead of a reconciler restart
         if self._env:
             return self._env
         c = self.config
-        self._env = self.get_env(
-            c['juju.environment'],
-            user=c['credentials.user'],
-            password=c['credentials.password'])
+
+        def connect():
+            env = self.get_env(
+                c['juju.environment'],
+                user=c['credentials.user'],
+                password=c['credentials.password'])
+            env.env_name = self.name
+            return env
+        self._env = EnvironmentPool(
+            connect,
+            size=c['juju.pool_size'],
+            max_in_flight=c['juju.max_in_flight'])
         return self._env
 
     @property
     def real(self):
-        return self.env.status()
+        if not self.reality.seeded:
+            return None
+        return self.reality.status
+
+    @gen.coroutine
+    def refresh(self):
+        """Re-seed the reality model from a full status call."""
+        status = yield self.executor.submit(self.env.status)
+        self.reality.seed(status)
+
+    def watch(self, callback=None):
+        """
+        Keep the reality model current from a juju AllWatcher.
+
+        The watcher blocks on its own connection so it runs in a
+        daemon thread; change sets are handed to the IOLoop which
+        applies them and calls `callback` when reality changed.
+
+        The first change set of a watcher holds everything there is,
+        so it replaces reality: that seeds it when it comes before
+        the status call, and when the watcher is restarted it drops
+        whatever was removed while nothing was watching. The same
+        goes for a watcher reconnecting by itself, which starts a new
+        AllWatcher on a new connection.
+        """
+        loop = tornado.ioloop.IOLoop.current()
+
+        def on_deltas(deltas, snapshot):
+            if snapshot:
+                self.reality.replace(deltas)
+            elif not self.reality.apply(deltas):
+                return
+            if callback:
+                callback()
+
+        def generation(watcher):
+            return (getattr(watcher, 'conn', None),
+                    getattr(watcher, 'watcher_id', None))
+
+        def run():
+            while True:
+                watcher = None
+                try:
+                    watcher = self.env.get_watch()
+                    current = generation(watcher)
+                    snapshot = True
+                    for deltas in watcher:
+                        if generation(watcher) != current:
+                            current, snapshot = generation(watcher), True
+                        loop.add_callback(on_deltas, deltas, snapshot)
+                        snapshot = False
+                except Exception:
+                    logging.warning("Watcher failed, restarting",
+                                    exc_info=True)
+                    time.sleep(5)
+                finally:
+                    # stop it rather than leave it to pile up
+                    # in the environment's watches
+                    release = getattr(watcher, 'release', None)
+                    if release is not None:
+                        release()
+
+        watcher = threading.Thread(target=run, name='reality-watcher')
+        watcher.daemon = True
+        watcher.start()
+        return watcher
 
     def build_strategy(self, reality=None):
         if reality is None:
             reality = self.real
+            fingerprint = self.reality.seeded and self.reality.fingerprint
+        else:
+            fingerprint = delta.fingerprint(reality)
         if reality is None:
             return []
 
-        # Service Deltas
-        self.strategy.extend(self.build_services())
-        self.strategy.extend(self.build_relations())
-
-    def build_services(self):
-        # This should do a 3-way merge from the previous expected state
-        # to current with a delta for reality
-        current = self.expected
-        result = []
-        if not current:
-            return result
-
-        real = self.real
-        prev = self.previous
-        # XXX This is a very shallow diff in the sense that it only does
-        # service name merges and not charm revision
-        # XXX This deals with bundle format and the juju-core status output
-        # formats, so the key names are a little different
-        adds = set(current['services'].keys()) - set(real['Services'].keys())
-        deletes = set()
-        if prev:
-            deletes = set(prev['services'].keys()) - set(
-                current['services'].keys()) & set(
-                real['Services'].keys())
-
-        # XXX detect when we really want to do this,
-        # ie, hash has changed or something
-        result.append(actions.GenerateTactic(
-            repo=self.config['server.repository']))
-        for service_name in adds:
-            service = current['services'][service_name].copy()
-            service['service_name'] = service_name
-            branch = service.get('branch')
-            if branch and branch.startswith('local:'):
-                result.append(actions.UpdateCharmTactic(
-                    charm_url=branch,
-                    repo=self.config['server.repository']))
-            result.append(actions.DeployTactic(service=service,
-                                               repo=self.config['server.repository']))
-
-        for service_name in deletes:
-            result.push(actions.RemoveServiceTactic(service_name))
-
-        logging.debug("Build New %s", result)
-        return result
-
-    def build_relations(self):
-        current = self.expected
-        result = []
-        if not current:
-            return result
-
-        real = self.real
-        # prev = self.previous
-
-        crels = utils.flatten_relations(current['relations'])
-        for rel in crels:
-            if not utils.rel_exists(real, rel[0], rel[1]):
-                result.append(actions.AddRelationTactic(
-                    endpoint_a=rel[0], endpoint_b=rel[1]))
-
-        # XXX skip deletes for now
-
-        return result
+        # Nothing to do if neither side moved since the last build
+        state = (self.expected_hash, fingerprint)
+        if state == self.reconciled:
+            RECONCILE_PASSES.inc(environment=self.name, result='skipped')
+            return []
+        RECONCILE_PASSES.inc(environment=self.name, result='built')
+        self.reconciled = state
+
+        self.charms.seed(reality)
+        self.strategy.extend(delta.three_way(
+            self.previous, self.expected, reality,
+            repo=self.config['server.repository'], charms=self.charms,
+            workers=self.config['generate.workers']))
+        # removals are computed against the last expected
+        # state applied, which this one becomes once the
+        # strategy completes; with nothing to do it already is
+        self.strategy.expected = self.expected
+        if not self.strategy:
+            self._settle(self.strategy)
+
+    def plan(self, candidate):
+        """
+        What posting `candidate` as the expected state would do,
+        without doing it. None until reality has been seeded.
+        """
+        if self.real is None:
+            return None
+        strategy = Strategy(self.env, concurrency=self.concurrency)
+        strategy.extend(delta.three_way(
+            self.expected, candidate, self.real,
+            repo=self.config['server.repository'],
+            workers=self.config['generate.workers']))
+        return plan.estimate(strategy, self.durations)
 
     def execute_strategy(self):
         # each strategy is a list of tactics,
         # we track the state of each of those
-        # by mutating the tactic in the list
-        # execute strategy shouldn't blocka
-        # so if the lock is taken we continue
-        # without modifying the strategy
-        # and pick up in the next timeout cycle
+        # by mutating the tactic in the list.
+        # The strategy runs as a coroutine with
+        # tactics on the executor, so if the guard
+        # is taken a run is already in flight
         if not self.strategy.runnable:
             return
 
-        if not self.exec_lock.acquire(False):
+        if not self.exec_lock.acquire():
             return
-        try:
-            logging.debug("Exec Strat %s", self.strategy)
-            self.strategy()
-            if self.strategy.runnable:
-                tornado.ioloop.IOLoop.instance().add_callback(
-                    self.execute_strategy)
-            else:
+        logging.debug("Exec Strat %s", self.strategy)
+        strategy = self.strategy
+
+        def done(future):
+            try:
+                future.result()
+                self._settle(strategy)
+                if self.strategy.state == FAILED:
+                    # out of retries, make sure the next
+                    # trigger diffs again instead of skipping
+                    self.reconciled = None
+                timings = self.strategy.timings()
+                if timings:
+                    logging.info(
+                        "Strategy finished in %(wall).1fs, "
+                        "%(serial).1fs of tactics (%(speedup).1fx)", timings)
+            except Exception:
+                logging.exception("Strategy failed")
+            finally:
                 self._reset_strategy()
-        finally:
-            self.exec_lock.release()
+                self.exec_lock.release()
+        tornado.ioloop.IOLoop.current().add_future(self.strategy(), done)
 
     @classmethod
     def get_env(cls, name=None, user=None, password=None):
@@ -152,45 +378,349 @@ class StateDatabase(object):
         if not api_addresses:
             # use the local option/connect which
             # parses local jenv info
-            env = Environment.connect(name)
+            env = PipelinedEnvironment.connect(name)
         else:
-            env = Environment(api_addresses.split()[0])
+            env = PipelinedEnvironment(api_addresses.split()[0])
             env.login(user=user, password=password)
         return env
 
 
+class Reality(object):
+    """
+    In-memory copy of the FullStatus output of an environment.
+
+    This is seeded from `Environment.status()` and then updated
+    incrementally from AllWatcher deltas, so reading it doesn't
+    cost a round trip to the state server.
+    """
+    def __init__(self):
+        self.services = {}
+        self.seeded = False
+        # bumped on every change so consumers can
+        # tell if reality moved under them
+        self.version = 0
+        self._fingerprint = (None, None)
+
+    @property
+    def status(self):
+        return {'Services': self.services}
+
+    @property
+    def fingerprint(self):
+        """Hash of the parts of reality the diff looks at."""
+        version, digest = self._fingerprint
+        if version != self.version:
+            digest = delta.fingerprint(self.status)
+            self._fingerprint = (self.version, digest)
+        return digest
+
+    def seed(self, status):
+        self.services = copy.deepcopy(status.get('Services') or {})
+        self.seeded = True
+        self.version += 1
+
+    def replace(self, deltas):
+        """Seed from the change set describing everything there is."""
+        self.services = {}
+        self.apply(deltas)
+        self.seeded = True
+        self.version += 1
+
+    def apply(self, deltas):
+        changed = False
+        for entity_type, change, data in deltas:
+            handler = getattr(self, '_apply_%s' % entity_type, None)
+            if handler and handler(change, data) is not False:
+                changed = True
+        if changed:
+            self.version += 1
+        return changed
+
+    def _service(self, name):
+        return self.services.setdefault(name, {
+            'Charm': '', 'Exposed': False, 'Life': '',
+            'Relations': {}, 'Units': {}})
+
+    def _apply_service(self, change, data):
+        name = data['Name']
+        if change == 'remove':
+            return self.services.pop(name, None) is not None
+        service = self._service(name)
+        service.update({
+            'Charm': data.get('CharmURL', service.get('Charm')),
+            'Exposed': data.get('Exposed', False),
+            'Life': data.get('Life', ''),
+        })
+        if 'Config' in data:
+            service['Config'] = data['Config']
+
+    def _apply_unit(self, change, data):
+        name = data['Name']
+        if change == 'remove':
+            service = self.services.get(data['Service'], {})
+            return service.get('Units', {}).pop(name, None) is not None
+        units = self._service(data['Service']).setdefault('Units', {})
+        unit = units.setdefault(name, {})
+        unit.update({
+            'Machine': data.get('MachineId', ''),
+            'AgentState': data.get('Status', ''),
+            'AgentStateInfo': data.get('StatusInfo', ''),
+            'Life': data.get('Life', ''),
+            'PublicAddress': data.get('PublicAddress', ''),
+            'Charm': data.get('CharmURL', ''),
+        })
+
+    def _apply_relation(self, change, data):
+        # Key is "svc:rel svc:rel", or "svc:rel" for peers
+        endpoints = [ep.split(':', 1) for ep in data['Key'].split()]
+        changed = False
+        for service_name, rel_name in endpoints:
+            remotes = [s for s, _ in endpoints if s != service_name]
+            if not remotes:
+                remotes = [service_name]
+            if change == 'remove':
+                service = self.services.get(service_name)
+                if not service:
+                    continue
+                related = service.get('Relations', {}).get(rel_name, [])
+                for remote in remotes:
+                    if remote in related:
+                        related.remove(remote)
+                        changed = True
+                if not related:
+                    service.get('Relations', {}).pop(rel_name, None)
+            else:
+                rels = self._service(service_name).setdefault(
+                    'Relations', {})
+                related = rels.setdefault(rel_name, [])
+                for remote in remotes:
+                    if remote not in related:
+                        related.append(remote)
+                        changed = True
+        return changed
+
+
 class Strategy(list):
-    def __init__(self, env):
+    """
+    The tactics moving reality to the expected state.
+
+    Before running, the tactics are compiled into a DAG from what
+    each one requires and provides (charm upload before deploy,
+    deploy of both endpoints before add-relation). Tactics whose
+    dependencies are complete run concurrently on the executor, up
+    to `concurrency` at a time.
+
+    A failed tactic is retried with backoff as its class allows,
+    attempts running past the class timeout count as failures, and
+    one that has run out of retries only holds up the tactics that
+    depend on it; the rest of the plan carries on. A timed out
+    attempt can't be stopped, so until it does finish it keeps its
+    slot and its tactic isn't tried again.
+
+    State transitions of the strategy and its tactics are published
+    to `events` when given.
+    """
+    def __init__(self, env, executor=None, concurrency=1, events=None,
+                 environment=''):
         self.state = PENDING
         self.env = env
+        # name of the environment, to label metrics with
+        self.environment = environment
+        self.executor = executor
+        self.concurrency = concurrency
+        self.events = events
+        self.deps = {}
+        self.running = set()
+        # worker futures of timed out attempts still going
+        self.abandoned = set()
+        # tactic -> IOLoop time it may be retried at
+        self.retry_at = {}
+        # the pending backoff timer, see _wakeup
+        self._timer = None
+        # the expected state this was built for
+        self.expected = None
 
-    def find_next_tactic(self):
-        if not self:
-            return None
+    def compile(self):
+        producers = {}
         for tactic in self:
-            if tactic.state == FAILED:
-                return None
-            if tactic.state == PENDING:
-                return tactic
+            for key in tactic.provides():
+                producers.setdefault(key, []).append(tactic)
+        self.deps = {}
+        for tactic in self:
+            self.deps[tactic] = set(
+                producer
+                for key in tactic.requires()
+                for producer in producers.get(key, ())
+                if producer is not tactic)
+        return self.deps
+
+    def ready(self, now=None):
+        """Pending tactics whose dependencies have completed."""
+        if len(self.deps) != len(self):
+            self.compile()
+        if now is None:
+            now = tornado.ioloop.IOLoop.current().time()
+        return [t for t in self
+                if t.state == PENDING and t not in self.running and
+                self.retry_at.get(t, 0) <= now and
+                all(d.state == COMPLETE for d in self.deps[t])]
+
+    def find_next_tactic(self):
+        ready = self.ready()
+        if ready:
+            return ready[0]
         return None
 
     @property
     def runnable(self):
         return bool(self.find_next_tactic())
 
+    def _publish(self, kind, **data):
+        if self.events is not None:
+            self.events.publish(kind, **data)
+
+    def _publish_tactic(self, tactic, **extra):
+        data = tactic.as_dict()
+        data.update(extra, index=self.index(tactic))
+        self._publish('tactic', **data)
+
+    def _launch(self, tactic, env):
+        self.running.add(tactic)
+        self.retry_at.pop(tactic, None)
+        tactic.attempts += 1
+        # the worker flips the state, but subscribers
+        # should see the transition as we schedule it
+        self._publish_tactic(tactic, state=STATES[RUNNING],
+                             attempt=tactic.attempts)
+        if self.executor is None:
+            tactic.run(env, tactic.attempts)
+            future = raw = gen.maybe_future(None)
+        else:
+            future = raw = self.executor.submit(
+                tactic.run, env, tactic.attempts)
+            if tactic.timeout:
+                future = gen.with_timeout(
+                    datetime.timedelta(seconds=tactic.timeout), raw)
+        future.tactic = raw.tactic = tactic
+        future.raw = raw
+        return future
+
+    def _settle(self, future, now):
+        tactic = future.tactic
+        if future.raw.done():
+            self.running.discard(tactic)
+        else:
+            # timed out; the attempt still holds its worker and its
+            # side effects aren't over, so the tactic stays running
+            # (not ready for a retry) until the worker is done
+            self.abandoned.add(future.raw)
+        self._observe(tactic)
+        if future.exception() is not None and tactic.state != FAILED:
+            error = future.exception()
+            if isinstance(error, gen.TimeoutError):
+                error = gen.TimeoutError(
+                    "timed out after %ss" % tactic.timeout)
+            tactic.fail(error)
+        if tactic.state != FAILED or tactic.attempts > tactic.retries:
+            self._publish_tactic(tactic)
+            return
+        delay = tactic.backoff * 2 ** (tactic.attempts - 1)
+        logging.info("Retrying %s in %.1fs: %s",
+                     tactic.name, delay, tactic.failure)
+        TACTIC_RETRIES.inc(environment=self.environment,
+                           tactic=type(tactic).__name__)
+        self._publish_tactic(tactic, retry_in=delay)
+        tactic.reset()
+        self.retry_at[tactic] = now + delay
+
+    def _wakeup(self, io_loop, now):
+        """
+        A Future resolving when the next backoff still to come runs
+        out, or None if there is none. Retries already due wait for
+        a slot instead, and a slot freeing up wakes the loop anyway.
+        """
+        pending = [t for t in self.retry_at.values() if t > now]
+        if not pending:
+            return None
+        deadline = min(pending)
+        timer = self._timer
+        if timer is not None:
+            if timer.deadline <= deadline:
+                return timer
+            io_loop.remove_timeout(timer.handle)
+        timer = self._timer = Future()
+        timer.tactic, timer.deadline = None, deadline
+        timer.handle = io_loop.add_timeout(
+            deadline, lambda: timer.set_result(None))
+        return timer
+
+    def _observe(self, tactic):
+        if tactic.start_time and tactic.end_time:
+            elapsed = tactic.end_time - tactic.start_time
+            TACTIC_DURATION.observe(elapsed.total_seconds(),
+                                    environment=self.environment,
+                                    tactic=type(tactic).__name__)
+
     @gen.coroutine
     def __call__(self, env=None):
         if env is None:
             env = self.env
 
-        current = self.find_next_tactic()
-        if not current:
-            self.state = COMPLETE
+        io_loop = tornado.ioloop.IOLoop.current()
+        self.compile()
+        self.state = RUNNING
+        self._publish('strategy', state=STATES[self.state],
+                      tactics=[t.as_dict() for t in self])
+        running = set()
+        while True:
+            for tactic in self.ready(io_loop.time()):
+                if len(running) + len(self.abandoned) >= self.concurrency:
+                    break
+                running.add(self._launch(tactic, env))
+            if not running and not self.abandoned and not self.retry_at:
+                break
+            waiting = running | self.abandoned
+            if len(waiting) < self.concurrency:
+                timer = self._wakeup(io_loop, io_loop.time())
+                if timer is not None:
+                    waiting.add(timer)
+            done = yield first_completed(waiting)
+            if done in running:
+                running.discard(done)
+                self._settle(done, io_loop.time())
+            elif done in self.abandoned:
+                self.abandoned.discard(done)
+                self.running.discard(done.tactic)
+            else:
+                self._timer = None
+
+        if any(t.state == FAILED for t in self):
+            self.state = FAILED
         else:
-            self.state = RUNNING
-            current.run(env)
-            if current.state != COMPLETE:
-                self.state = FAILED
+            self.state = COMPLETE
+        STRATEGIES.inc(environment=self.environment,
+                       result=STATES[self.state])
+        self._publish('strategy', state=STATES[self.state],
+                      timings=self.timings())
+
+    def as_dict(self):
+        return {
+            'state': STATES[self.state],
+            'timings': self.timings(),
+            'tactics': [t.as_dict() for t in self],
+        }
+
+    def timings(self):
+        """Wall clock time of the run against the serial sum of tactics."""
+        done = [t for t in self if t.start_time and t.end_time]
+        if not done:
+            return None
+        serial = sum((t.end_time - t.start_time).total_seconds()
+                     for t in done)
+        wall = (max(t.end_time for t in done) -
+                min(t.start_time for t in done)).total_seconds()
+        return {'wall': wall, 'serial': serial,
+                'speedup': serial / wall if wall else 1.0}
 
     def __str__(self):
         return "Strategy %s" % [str(t) for t in self]
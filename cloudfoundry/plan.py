@@ -0,0 +1,102 @@
+"""
+Dry runs: the strategy a candidate expected state would produce,
+with a duration estimate from how long past tactics took.
+"""
+import datetime
+import heapq
+
+from cloudfoundry.config import COMPLETE, STATES
+
+# Seconds assumed for a tactic class we have never seen complete
+DEFAULT_DURATION = 30.0
+
+
+def _parse_time(value):
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Bad timestamp %r" % value)
+
+
+class Durations(object):
+    """
+    Mean duration of completed tactics, per tactic class.
+
+    Fed from journal entries (Strategy.as_dict output), so the
+    estimates survive restarts as far back as the journal goes.
+    """
+    def __init__(self, default=DEFAULT_DURATION):
+        self.default = default
+        # tactic class -> (total seconds, count)
+        self.totals = {}
+
+    def record(self, entry):
+        for tactic in entry.get('tactics', ()):
+            if tactic['state'] != STATES[COMPLETE] or \
+                    not tactic['start_time'] or not tactic['end_time']:
+                continue
+            elapsed = (_parse_time(tactic['end_time']) -
+                       _parse_time(tactic['start_time'])).total_seconds()
+            total, count = self.totals.get(tactic['tactic'], (0.0, 0))
+            self.totals[tactic['tactic']] = (total + elapsed, count + 1)
+
+    def estimate(self, tactic):
+        total, count = self.totals.get(type(tactic).__name__, (0.0, 0))
+        if not count:
+            return self.default
+        return total / count
+
+
+def estimate(strategy, durations):
+    """
+    Simulate running `strategy` the way Strategy.__call__ would.
+
+    Tactics start in list order as soon as their dependencies are
+    done and a slot under the strategy's concurrency is free. The
+    critical path is the chain of dependencies ending in the last
+    tactic to finish.
+    """
+    deps = strategy.compile()
+    index = dict((t, i) for i, t in enumerate(strategy))
+    cost = [durations.estimate(t) for t in strategy]
+    start, finish = {}, {}
+    running = []
+    now = 0.0
+    while len(finish) < len(strategy):
+        for i, tactic in enumerate(strategy):
+            if len(running) >= strategy.concurrency:
+                break
+            if i in start or not all(index[d] in finish
+                                     for d in deps[tactic]):
+                continue
+            start[i] = now
+            heapq.heappush(running, (now + cost[i], i))
+        if not running:
+            raise ValueError("Strategy has a dependency cycle")
+        now, i = heapq.heappop(running)
+        finish[i] = now
+
+    path = []
+    current = max(finish, key=lambda i: (finish[i], -i)) if finish else None
+    while current is not None:
+        path.append(current)
+        before = [index[d] for d in deps[strategy[current]]]
+        current = max(before, key=lambda i: (finish[i], -i)) \
+            if before else None
+    path.reverse()
+
+    tactics = []
+    for i, tactic in enumerate(strategy):
+        data = tactic.as_dict()
+        data.update(index=i, estimate=cost[i], start=start[i],
+                    finish=finish[i],
+                    depends=sorted(index[d] for d in deps[tactic]))
+        tactics.append(data)
+    return {
+        'duration': max(finish.values()) if finish else 0.0,
+        'serial': sum(cost),
+        'critical_path': path,
+        'tactics': tactics,
+    }
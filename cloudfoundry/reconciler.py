@@ -4,6 +4,11 @@
 Run deployer in a loop, then remove any services not
 in the expected state.
 
+One process can reconcile several environments, listed under
+`environments` in the config file; each entry is merged over the
+top level settings. The API of each lives under /api/v1/<name>/,
+and /api/v1/ itself serves the default environment.
+
 To experiment with this::
 
     #activate virtualenv
@@ -17,21 +22,17 @@ To experiment with this::
     ./test-server.sh
 
     This should push a bundle of expected state, HUP the
-    server to force a run and then status the system.
+    server to force a resync and then status the system.
     Debug output should show whats happening and
 
 
 ISSUES:
     local charm version in charm url
         need to probe server still
-    reconcile loop:
-        should only trigger builds after push/reality change
-        execute should happen by queueing the callback
-        should listen directly on the websocket and schedule
-            rebuilds on change
     no support for unit state currently (auto-retry/replace, etc)
-    relation removal still needs work
 """
+import copy
+import datetime
 import json
 import logging
 import os
@@ -45,30 +46,147 @@ import tornado.options
 import tornado.process
 import tornado.web
 
+from tornado import gen
 from tornado.options import define, options
 from cloudfoundry import config
+from cloudfoundry import metrics
 from cloudfoundry import model
 from cloudfoundry import utils
+from cloudfoundry.executor import ThreadPool
 
-env_name = None
 server = None
-db = None
-
-
-def reconcile():
-    # delta state real vs expected
-    # build strategy
-    # execute strategy inside lock
-    if not db.strategy:
-        reality = db.real
-        db.build_strategy(reality)
-    if db.strategy:
-        db.execute_strategy()
-
-
-def sig_reconcile(sig, frame):
-    logging.info("Forcing reconcile loop")
-    tornado.ioloop.IOLoop.instance().add_callback(reconcile)
+# environment name -> Reconciler
+reconcilers = {}
+default_env = None
+
+TRIGGERS = metrics.Counter(
+    'cloudfoundry_reconcile_triggers_total',
+    'Requests for a reconcile pass, before debouncing.',
+    ['environment'])
+TRIGGERS_MERGED = metrics.Counter(
+    'cloudfoundry_reconcile_triggers_merged_total',
+    'Reconcile triggers folded into another pass by the debouncer.',
+    ['environment'])
+RECONCILE_LATENCY = metrics.Histogram(
+    'cloudfoundry_reconcile_seconds',
+    'Time spent diffing and starting strategies per reconcile pass.',
+    ['environment'])
+
+
+class Debouncer(object):
+    """
+    Collapse bursts of triggers into a single call.
+
+    Each trigger (re)schedules `callback` `delay` seconds out, but
+    never later than `max_delay` after the first trigger of a burst,
+    so a steady stream of pushes can't starve reconciliation.
+    """
+    def __init__(self, callback, delay=0.5, max_delay=5, io_loop=None,
+                 environment=''):
+        self.callback = callback
+        self.environment = environment
+        self.delay = delay
+        self.max_delay = max_delay
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+        self.pending = 0
+        self._first = None
+        self._timeout = None
+
+    def __call__(self):
+        TRIGGERS.inc(environment=self.environment)
+        now = self.io_loop.time()
+        self.pending += 1
+        if self._first is None:
+            self._first = now
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+        self._timeout = self.io_loop.add_timeout(
+            min(now + self.delay, self._first + self.max_delay), self._fire)
+
+    def _fire(self):
+        merged, self.pending = self.pending, 0
+        self._first = self._timeout = None
+        TRIGGERS_MERGED.inc(merged - 1, environment=self.environment)
+        logging.debug("Reconciling for %d merged triggers", merged)
+        self.callback()
+
+
+class Reconciler(object):
+    """
+    One environment: its state database, the debouncer in front of
+    its reconcile passes and the watcher keeping reality current.
+    """
+    def __init__(self, name, config, executor=None):
+        self.name = name
+        self.config = config = model.with_defaults(config)
+        if executor is not None:
+            executor = executor.lane(name, config['strategy.concurrency'])
+        self.db = model.StateDatabase(config, executor=executor, name=name)
+        self.schedule = Debouncer(self.reconcile,
+                                  delay=config['reconcile.debounce'],
+                                  max_delay=config['reconcile.max_delay'],
+                                  environment=name)
+
+    def reconcile(self):
+        # delta state real vs expected
+        # build strategy
+        # execute strategy inside lock
+        db = self.db
+        with RECONCILE_LATENCY.time(environment=self.name):
+            if not db.strategy:
+                reality = db.real
+                db.build_strategy(reality)
+            if db.strategy:
+                db.execute_strategy()
+
+    @gen.coroutine
+    def resync(self):
+        # normally reality is kept current by the watcher, this
+        # re-seeds it from a full status in case we drifted,
+        # and forces a diff even if nothing seems to have changed
+        yield self.db.refresh()
+        self.db.reconciled = None
+        self.reconcile()
+
+    def start(self):
+        # seed reality once, from here on it follows the watcher
+        # and every real change schedules a reconcile
+        tornado.ioloop.IOLoop.current().add_callback(self.resync)
+        self.db.watch(self.schedule)
+        tornado.ioloop.PeriodicCallback(
+            lambda: self.db.executor.submit(self.db.env.check),
+            self.config['juju.health_interval'] * 1000).start()
+
+
+def environment_configs(config):
+    """
+    Per environment configs, keyed by name.
+
+    Journals and charm repositories default to a per environment
+    file or directory next to the configured one.
+    """
+    top = utils.NestedDict(config)
+    envs = top.pop('environments', None)
+    if not envs:
+        return {top['juju.environment']: top}
+    result = {}
+    for name, overrides in envs.items():
+        env_config = utils.NestedDict(copy.deepcopy(top))
+        env_config.update({'juju': {'environment': name}})
+        root, ext = os.path.splitext(top['journal.path'])
+        env_config['journal.path'] = '%s-%s%s' % (root, name, ext)
+        env_config['server.repository'] = os.path.join(
+            top['server.repository'], name)
+        env_config.update(overrides)
+        result[name] = env_config
+    return result
+
+
+def sig_resync(sig, frame):
+    logging.info("Forcing reality resync")
+    loop = tornado.ioloop.IOLoop.instance()
+    for reconciler in reconcilers.values():
+        loop.add_callback(reconciler.resync)
 
 
 def sig_restart(sig, frame):
@@ -96,68 +214,231 @@ def shutdown():
     stop_loop()
 
 
-class StateHandler(tornado.web.RequestHandler):
-    def get(self):
-        self.write(json.dumps(db.expected, indent=2))
+class EnvHandler(tornado.web.RequestHandler):
+    """
+    Base for handlers scoped to one environment: the one named in
+    the route, or the default one.
+    """
+    def prepare(self):
+        name = self.path_kwargs.get('env') or default_env
+        if name not in reconcilers:
+            raise tornado.web.HTTPError(404)
+        self.reconciler = reconcilers[name]
+        self.db = self.reconciler.db
+
+    def get_count_argument(self, name, default, kind=int):
+        """A non-negative `kind` query argument, 400 otherwise."""
+        return self.parse_count(name, self.get_argument(name, None),
+                                default, kind)
+
+    def parse_count(self, name, value, default, kind=int):
+        if value is None:
+            return default
+        try:
+            value = kind(value)
+        except ValueError:
+            value = -1
+        # NaN fails every comparison, so it lands here too
+        if not 0 <= value < float('inf'):
+            raise tornado.web.HTTPError(400, "%s must be a non-negative %s" % (
+                name, 'integer' if kind is int else 'number'))
+        return value
+
+
+class StateHandler(EnvHandler):
+    @property
+    def gzip(self):
+        return 'gzip' in self.request.headers.get('Accept-Encoding', '')
+
+    def compute_etag(self):
+        # the two encodings are different representations
+        if self.gzip:
+            return '"%s-gz"' % self.db.expected_hash
+        return '"%s"' % self.db.expected_hash
+
+    def get(self, env=None):
+        self.set_header('Vary', 'Accept-Encoding')
+        self.set_etag_header()
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('X-State-Version', self.db.expected_version)
+        if self.gzip:
+            self.set_header('Content-Encoding', 'gzip')
+            self.write(self.db.encode_expected(compress=True))
+        else:
+            self.write(self.db.encode_expected())
 
-    def post(self):
-        db.expected = json.loads(self.request.body)
-        tornado.ioloop.IOLoop.instance().add_callback(reconcile)
+    def post(self, env=None):
+        self.db.expected = json.loads(self.request.body)
+        self.reconciler.schedule()
 
 
-class StrategyHandler(tornado.web.RequestHandler):
-    def get(self):
-        self.write(json.dumps([str(t) for t in db.strategy],
+class StrategyHandler(EnvHandler):
+    def get(self, env=None):
+        self.write(json.dumps([str(t) for t in self.db.strategy],
                               indent=2))
 
 
-class ResetHandler(tornado.web.RequestHandler):
+class PlanHandler(EnvHandler):
+    """Dry run a candidate expected state, nothing is executed."""
+    def post(self, env=None):
+        result = self.db.plan(json.loads(self.request.body))
+        if result is None:
+            raise tornado.web.HTTPError(503, "reality not seeded yet")
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(result))
+
+
+class HistoryHandler(EnvHandler):
+    def get(self, env=None):
+        offset = self.get_count_argument('offset', 0)
+        limit = min(self.get_count_argument('limit', 20), 100)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({
+            'offset': offset,
+            'limit': limit,
+            'entries': self.db.history.page(offset, limit)}))
+
+
+class EventsHandler(EnvHandler):
+    """
+    Long-poll for strategy progress: returns the events after `since`,
+    waiting up to `timeout` seconds for one to arrive.
+    """
+    @gen.coroutine
+    def get(self, env=None):
+        since = self.get_count_argument('since', 0)
+        timeout = min(self.get_count_argument('timeout', 30, float), 300)
+        events = self.db.events.since(since)
+        if not events:
+            try:
+                yield gen.with_timeout(
+                    datetime.timedelta(seconds=timeout), self.db.events.wait())
+            except gen.TimeoutError:
+                pass
+            events = self.db.events.since(since)
+        self.set_header('Content-Type', 'application/json')
+        # payloads are already encoded, just splice them in
+        self.write('{"last_id":%d,"events":[%s]}' % (
+            self.db.events.last_id, ','.join(p for _, p in events)))
+
+
+class EventStreamHandler(EnvHandler):
+    """Strategy progress as server-sent events."""
+    @gen.coroutine
+    def get(self, env=None):
+        self.closed = False
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        # a reconnecting EventSource says where it got to
+        last_id = self.parse_count(
+            'Last-Event-ID', self.request.headers.get('Last-Event-ID'),
+            None)
+        if last_id is None:
+            last_id = self.get_count_argument(
+                'since', self.db.events.last_id)
+        while not self.closed:
+            for event_id, payload in self.db.events.since(last_id):
+                self.write('id: %d\ndata: %s\n\n' % (event_id, payload))
+                last_id = event_id
+            self.flush()
+            try:
+                yield gen.with_timeout(
+                    datetime.timedelta(seconds=15), self.db.events.wait())
+            except gen.TimeoutError:
+                # keep intermediaries from dropping an idle stream
+                self.write(': keepalive\n\n')
+
+    def on_connection_close(self):
+        self.closed = True
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.REGISTRY.render())
+
+
+class ResetHandler(EnvHandler):
+    def get(self, env=None):
+        self.db.reset()
+
+
+class EnvironmentsHandler(tornado.web.RequestHandler):
     def get(self):
-        db.reset()
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({
+            'default': default_env,
+            'environments': sorted(reconcilers)}))
+
+
+def routes():
+    scoped = [
+        (r"strategy", StrategyHandler),
+        (r"plan", PlanHandler),
+        (r"history", HistoryHandler),
+        (r"events", EventsHandler),
+        (r"events/stream", EventStreamHandler),
+        (r"reset", ResetHandler),
+        (r"", StateHandler),
+    ]
+    # the unscoped routes go first, so they win
+    # over an environment of the same name
+    result = [
+        (r"/api/v1/metrics", MetricsHandler),
+        (r"/api/v1/environments", EnvironmentsHandler),
+    ]
+    result.extend((r"/api/v1/" + path, handler) for path, handler in scoped)
+    result.extend((r"/api/v1/(?P<env>[^/]+)/" + path, handler)
+                  for path, handler in scoped)
+    return result
 
 
 def main():
     define('config', default='/etc/juju-deployer/server.conf', type=str)
 
     tornado.options.parse_command_line()
-    config = utils.parse_config(options.config, {
-        'server.address': '127.0.0.1',
-        'server.port': 8888,
-        'credentials.user': 'user-admin',
-        'server.repository': 'build',
-        'juju.environment': utils.current_env()
-    })
-
-    application = tornado.web.Application([
-        (r"/api/v1/", StateHandler),
-        (r"/api/v1/strategy", StrategyHandler),
-        (r"/api/v1/reset", ResetHandler),
-    ],
+    defaults = model.with_defaults({'juju.environment': utils.current_env()})
+    config = utils.parse_config(options.config, defaults)
+
+    application = tornado.web.Application(
+        routes(),
         autoreload=True,
         config=config,
         **config['server']
     )
 
     global server
-    global db
-
-    if not os.path.exists(config['server.repository']):
-        os.makedirs(config['server.repository'])
+    global default_env
+
+    configs = environment_configs(config)
+    # one pool for every environment, with a lane
+    # each sized to that environment's concurrency
+    executor = ThreadPool(
+        sum(c['strategy.concurrency'] for c in configs.values()))
+    for name, env_config in configs.items():
+        if not os.path.exists(env_config['server.repository']):
+            os.makedirs(env_config['server.repository'])
+        reconcilers[name] = Reconciler(name, env_config, executor)
+    default_env = config['server'].get('default_environment') or \
+        sorted(configs)[0]
 
-    db = model.StateDatabase(config)
     server = tornado.httpserver.HTTPServer(application)
     server.listen(config['server.port'], config['server.address'])
 
     signal.signal(signal.SIGTERM, sig_restart)
     signal.signal(signal.SIGINT, sig_restart)
-    signal.signal(signal.SIGHUP, sig_reconcile)
+    signal.signal(signal.SIGHUP, sig_resync)
 
     # config file change should reload the application
     # its values are passed to Application init
     tornado.autoreload.watch(options.config)
     utils.record_pid()
     loop = tornado.ioloop.IOLoop.instance()
-    # tornado.ioloop.PeriodicCallback(reconcile, 500, io_loop=loop).start()
+    for reconciler in reconcilers.values():
+        reconciler.start()
     loop.start()
 
 
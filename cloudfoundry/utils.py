@@ -28,7 +28,7 @@ def flatten_relations(rels):
     for pair in rels:
         a = pair[0]
         b = pair[1]
-        if isinstance(b, list):
+        if isinstance(b, (list, tuple)):
             for ep in b:
                 result.append(tuple(sorted((a, ep))))
         else:
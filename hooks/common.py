@@ -2,13 +2,13 @@
 
 import os
 import yaml
-import shutil
 import subprocess
 
 from charmhelpers.core import hookenv
 from charmhelpers.core import services
 
 from charmgen.generator import CharmGenerator
+from charmgen.store import ObjectStore
 from cloudfoundry.releases import RELEASES
 from cloudfoundry.services import SERVICES
 from cloudfoundry.contexts import JujuAPICredentials
@@ -47,12 +47,15 @@ def generate(s):
     version = config.get('cf_version')
     if not version or version == 'latest':
         version = RELEASES[0]['releases'][1]
-    build_dir = os.path.join(hookenv.charm_dir(), 'build', str(version))
-    if os.path.exists(build_dir):
-        shutil.rmtree(build_dir)
+    build_root = os.path.join(hookenv.charm_dir(), 'build')
+    build_dir = os.path.join(build_root, str(version))
     generator = CharmGenerator(RELEASES, SERVICES)
     generator.select_release(version)
-    generator.generate(build_dir)
+    # only charms whose inputs changed are rebuilt, and the object
+    # store outlives builds so moving between releases relinks
+    # rather than copies
+    generator.generate(build_dir,
+                       ObjectStore(os.path.join(build_root, '.objects')))
 
 
 def deploy(s):
@@ -94,16 +97,19 @@ def deploy(s):
         # the generated charms; this can't be done in the bundle because
         # the orchestrator is not defined in the bundle
         orchestrator = hookenv.service_name()
-        for service_name, service_data in bundle['cloudfoundry']['services'].items():
-            # XXX: explicitly check if service has orchestrator interface
-            if not service_data['charm'].startswith('cs:'):
-                try:
-                    env.add_relation(orchestrator, service_name)
-                except EnvError as e:
-                    if e.message.endswith('relation already exists'):
-                        continue  # existing relations are ok, just skip
-                    else:
-                        hookenv.log('Error adding orchestrator relation: {}'.format(str(e)), hookenv.ERROR)
+        # XXX: explicitly check if service has orchestrator interface
+        managed = [service_name for service_name, service_data
+                   in bundle['cloudfoundry']['services'].items()
+                   if not service_data['charm'].startswith('cs:')]
+        results = env.add_relations(
+            [(orchestrator, service_name) for service_name in managed])
+        for service_name, result in zip(managed, results):
+            if not isinstance(result, EnvError):
+                continue
+            if result.message.endswith('relation already exists'):
+                continue  # existing relations are ok, just skip
+            hookenv.log('Error adding orchestrator relation: {}'.format(
+                str(result)), hookenv.ERROR)
         env.expose('haproxy')
     finally:
         env.close()
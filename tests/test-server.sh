@@ -9,6 +9,18 @@ function status() {
     echo
 }
 
+function events() {
+    # long-poll progress instead of re-fetching the strategy
+    curl "${ADDRESS}events?since=${1:-0}&timeout=${2:-30}"
+    echo
+}
+
+function plan() {
+    # what posting a bundle would do, without doing it
+    curl -d @${1:-state.json} ${ADDRESS}plan
+    echo
+}
+
 function HUPHUP() {
     kill -HUP `cat ~/.config/juju-deployer/server.pid`
     curl ${ADDRESS}strategy
@@ -21,6 +33,7 @@ curl $ADDRESS
 echo
 
 HUPHUP
+events
 
 #curl $ADDRESS/reset
 
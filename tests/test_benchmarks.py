@@ -0,0 +1,28 @@
+import unittest
+
+from benchmarks import reconcile, synthetic
+from cloudfoundry import actions
+from cloudfoundry import delta
+
+
+class TestSynthetic(unittest.TestCase):
+    def test_converged(self):
+        expected = synthetic.bundle(50)
+        real = synthetic.status(expected, deployed=1, related=1)
+        self.assertEqual(len(real['Services']), 50)
+        self.assertEqual(delta.three_way({}, expected, real, 'build'), [])
+
+    def test_partial(self):
+        expected = synthetic.bundle(50)
+        real = synthetic.status(expected)
+        self.assertEqual(real, synthetic.status(expected))
+        result = delta.three_way({}, expected, real, 'build')
+        deployed = set(t.kwargs['service']['service_name'] for t in result
+                       if isinstance(t, actions.DeployTactic))
+        self.assertEqual(deployed,
+                         set(expected['services']) - set(real['Services']))
+
+    def test_run(self):
+        results = reconcile.run(10)
+        self.assertTrue(results['skipped'])
+        self.assertGreater(results['tactics'], 0)
@@ -0,0 +1,106 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import mock
+
+from cloudfoundry import actions
+from cloudfoundry import charms
+from cloudfoundry.config import COMPLETE
+from cloudfoundry.path import path
+
+
+class TestCharmRevisions(unittest.TestCase):
+    def test_split_revision(self):
+        self.assertEqual(charms.split_revision('local:trusty/nats-v1-3'),
+                         ('local:trusty/nats-v1', 3))
+        self.assertEqual(charms.split_revision('cs:trusty/mysql'),
+                         ('cs:trusty/mysql', None))
+
+    def test_resolve(self):
+        revisions = charms.CharmRevisions()
+        self.assertIsNone(revisions.resolve('local:trusty/nats-v1'))
+        revisions.seed({'Services': {'nats': {
+            'Charm': 'local:trusty/nats-v1-2'}}})
+        revisions.record('local:trusty/nats-v1-5')
+        revisions.record('local:trusty/nats-v1-4')
+        self.assertEqual(revisions.resolve('local:trusty/nats-v1'),
+                         'local:trusty/nats-v1-5')
+
+    def test_uploads_saved(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        saved = os.path.join(tmpdir, 'build', '.uploads.json')
+        revisions = charms.CharmRevisions(path=saved)
+        revisions.record_upload('local:trusty/nats-v1', 'abc',
+                                'local:trusty/nats-v1-3')
+        # a restarted server still knows which tree it uploaded
+        revisions = charms.CharmRevisions(path=saved)
+        self.assertEqual(revisions.uploaded('local:trusty/nats-v1', 'abc'),
+                         'local:trusty/nats-v1-3')
+        self.assertEqual(revisions.resolve('local:trusty/nats-v1'),
+                         'local:trusty/nats-v1-3')
+
+
+class TestCharmArchives(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.charm = self.tmpdir / 'repo/173/trusty/nats-v1'
+        (self.charm / 'hooks').makedirs_p()
+        (self.charm / 'metadata.yaml').write_text('name: nats-v1\n')
+        (self.charm / 'hooks/entry.py').write_text('#!/usr/bin/env python')
+        os.chmod(self.charm / 'hooks/entry.py', 0755)
+        os.symlink('entry.py', self.charm / 'hooks/install')
+
+    def read(self, archives):
+        digest, fp, size = archives.open(self.charm)
+        with fp:
+            data = ''
+            for chunk in iter(lambda: fp.read(7), ''):
+                data += chunk
+        self.assertEqual(len(data), size)
+        return digest, data
+
+    def test_archive(self):
+        digest, data = self.read(charms.CharmArchives())
+        zf = zipfile.ZipFile(io.BytesIO(data))
+        self.assertIsNone(zf.testzip())
+        self.assertEqual(zf.namelist(), ['hooks/entry.py', 'hooks/install',
+                                         'metadata.yaml'])
+        self.assertEqual(zf.read('hooks/install'), '#!/usr/bin/env python')
+        self.assertTrue(zf.getinfo('hooks/install').external_attr >> 16 &
+                        0100)
+
+    def test_reproducible(self):
+        digest, data = self.read(charms.CharmArchives())
+        os.utime(self.charm / 'metadata.yaml', (0, 0))
+        self.assertEqual(self.read(charms.CharmArchives()), (digest, data))
+
+        (self.charm / 'metadata.yaml').write_text('name: nats-v2\n')
+        self.assertNotEqual(self.read(charms.CharmArchives())[0], digest)
+
+    def test_update_charm_skips_known_upload(self):
+        revisions = charms.CharmRevisions()
+        env = mock.Mock()
+        env.add_local_charm.return_value = {
+            'CharmURL': 'local:trusty/nats-v1-4'}
+
+        def update():
+            tactic = actions.UpdateCharmTactic(
+                charm_url='local:trusty/nats-v1', repo=self.tmpdir / 'repo',
+                cf_release=173, charms=revisions)
+            tactic.run(env)
+            self.assertEqual(tactic.state, COMPLETE, tactic.failure)
+        update()
+        update()
+        self.assertEqual(env.add_local_charm.call_count, 1)
+        self.assertEqual(revisions.resolve('local:trusty/nats-v1'),
+                         'local:trusty/nats-v1-4')
+        # a changed tree is uploaded again
+        (self.charm / 'metadata.yaml').write_text('name: nats-v2\n')
+        update()
+        self.assertEqual(env.add_local_charm.call_count, 2)
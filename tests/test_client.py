@@ -0,0 +1,189 @@
+import json
+import Queue
+import threading
+import time
+import unittest
+
+import mock
+from jujuclient import EnvError
+
+from cloudfoundry import client
+from cloudfoundry.client import (ConnectionLost, EnvironmentPool,
+                                 PipelinedEnvironment)
+
+
+class FakeConnection(object):
+    """Answers requests in reverse order once `batch` have arrived."""
+    def __init__(self, batch=1):
+        self.batch = batch
+        self.connected = True
+        self.requests = []
+        self.waiting = []
+        self.responses = Queue.Queue()
+        self.lock = threading.Lock()
+
+    def send(self, raw):
+        with self.lock:
+            self.requests.append(json.loads(raw))
+            self.waiting.append(self.requests[-1])
+            if len(self.waiting) < self.batch:
+                return
+            for op in reversed(self.waiting):
+                self.responses.put(json.dumps(self.respond(op)))
+            self.waiting = []
+
+    def respond(self, op):
+        if op['Request'] == 'AddRelation' and \
+                op['Params']['Endpoints'][1] == 'bad':
+            return {'RequestId': op['RequestId'],
+                    'Error': 'relation already exists'}
+        return {'RequestId': op['RequestId'],
+                'Response': {'Echo': op['Params']}}
+
+    def recv(self):
+        return self.responses.get()
+
+    def close(self):
+        self.connected = False
+        self.responses.put('')
+
+
+class TestPipelinedEnvironment(unittest.TestCase):
+    def env(self, conn):
+        env = PipelinedEnvironment('wss://localhost:17070', conn=conn)
+        env.login('secret')
+        return env
+
+    def test_routes_out_of_order_responses(self):
+        conn = FakeConnection()
+        env = self.env(conn)
+        conn.batch = 2
+        results = {}
+
+        def call(name):
+            results[name] = env.expose(name)
+
+        threads = [threading.Thread(target=call, args=(n,))
+                   for n in ('a', 'b')]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(results, {'a': {'Echo': {'ServiceName': 'a'}},
+                                   'b': {'Echo': {'ServiceName': 'b'}}})
+
+    def test_batch(self):
+        conn = FakeConnection()
+        env = self.env(conn)
+        conn.batch = 3
+        results = env.add_relations([('cf', 'a'), ('cf', 'bad'), ('cf', 'c')])
+        self.assertEqual(results[0], {'Echo': {'Endpoints': ['cf', 'a']}})
+        self.assertIsInstance(results[1], EnvError)
+        self.assertEqual(results[1].message, 'relation already exists')
+        self.assertEqual(results[2], {'Echo': {'Endpoints': ['cf', 'c']}})
+        # all three went out before any response came back
+        self.assertEqual(len(conn.requests), 4)
+
+    def test_release_watch(self):
+        class WatchConnection(FakeConnection):
+            def respond(self, op):
+                return {'RequestId': op['RequestId'],
+                        'Response': {'AllWatcherId': '1'}}
+        env = self.env(FakeConnection())
+        watch_conn = WatchConnection()
+        watcher = env.get_watch(connection=mock.Mock(conn=watch_conn))
+        self.assertEqual(env._watches, [watcher])
+        watcher.release()
+        self.assertEqual(env._watches, [])
+        self.assertEqual(watch_conn.requests[-1]['Request'], 'Stop')
+        self.assertFalse(watch_conn.connected)
+
+    def test_error_raises(self):
+        env = self.env(FakeConnection())
+        env.env_name = 'prod'
+        errors = client.API_CALLS.value(
+            environment='prod', request='AddRelation', result='error')
+        self.assertRaises(EnvError, env.add_relation, 'cf', 'bad')
+        self.assertEqual(client.API_CALLS.value(
+            environment='prod', request='AddRelation', result='error'),
+            errors + 1)
+
+    def test_connection_lost(self):
+        conn = FakeConnection()
+        env = self.env(conn)
+        conn.batch = 2
+        slot = env._send({'Type': 'Client', 'Request': 'FullStatus'})
+        conn.close()
+        self.assertRaises(ConnectionLost, env._result, slot)
+        self.assertFalse(env.healthy)
+        self.assertRaises(ConnectionLost, env.info)
+
+
+def wait_broken(env):
+    for i in range(100):
+        if env.broken:
+            return
+        time.sleep(0.01)
+
+
+class TestEnvironmentPool(unittest.TestCase):
+    def setUp(self):
+        self.envs = []
+        self.pool = EnvironmentPool(self.connect, size=2, max_in_flight=2)
+
+    def connect(self):
+        env = PipelinedEnvironment('wss://localhost:17070',
+                                   conn=FakeConnection())
+        env.login('secret')
+        self.envs.append(env)
+        return env
+
+    def test_reconnects(self):
+        self.assertEqual(self.pool.info(), {'Echo': {}})
+        self.envs[0].conn.close()
+        wait_broken(self.envs[0])
+        self.assertEqual(self.pool.info(), {'Echo': {}})
+        self.assertEqual(len(self.envs), 2)
+        self.assertEqual(self.pool.reconnects, 1)
+
+    def test_retries_idempotent(self):
+        self.pool.info()
+        # hold the next request, then drop the connection under it
+        self.envs[0].conn.batch = 2
+        timer = threading.Timer(0.1, self.envs[0].conn.close)
+        timer.start()
+        self.assertEqual(self.pool.expose('nats'),
+                         {'Echo': {'ServiceName': 'nats'}})
+        self.assertEqual(len(self.envs), 2)
+
+        self.envs[1].conn.batch = 2
+        timer = threading.Timer(0.1, self.envs[1].conn.close)
+        timer.start()
+        self.assertRaises(ConnectionLost, self.pool.add_relation, 'a', 'b')
+
+    def test_in_flight_cap(self):
+        self.assertEqual([self.pool._acquire() for i in range(4)],
+                         [0, 1, 0, 1])
+        acquired = []
+        waiter = threading.Thread(
+            target=lambda: acquired.append(self.pool._acquire()))
+        waiter.start()
+        waiter.join(0.1)
+        self.assertEqual(acquired, [])
+        self.pool._release(1)
+        waiter.join(5)
+        self.assertEqual(acquired, [1])
+
+    def test_check(self):
+        self.pool.info()
+        self.pool.check()
+        self.assertEqual(self.pool.reconnects, 0)
+        self.envs[0].conn.close()
+        wait_broken(self.envs[0])
+        self.pool.check()
+        self.assertEqual(self.pool._conns, [None, None])
+        self.assertEqual(self.pool.reconnects, 1)
+
+    def test_not_proxied(self):
+        self.assertRaises(AttributeError, getattr, self.pool, 'nope')
+        self.assertRaises(AttributeError, getattr, self.pool, '_rpc')
@@ -0,0 +1,204 @@
+import copy
+import json
+import mock
+import os
+import pkg_resources
+import shutil
+import tempfile
+import unittest
+
+from cloudfoundry import actions
+from cloudfoundry import delta
+from cloudfoundry.charms import CharmRevisions
+
+
+def load(name):
+    return json.loads(pkg_resources.resource_string(__name__, name))
+
+
+def by_type(tactics, cls):
+    return [t for t in tactics if type(t) is cls]
+
+
+class TestRealityIndex(unittest.TestCase):
+    def test_has_relation(self):
+        index = delta.RealityIndex(load('status.json'))
+        self.assertTrue(index.has_relation('etcd', 'etcd:cluster'))
+        self.assertTrue(index.has_relation('router:nats', 'nats'))
+        self.assertTrue(index.has_relation('nats:nats', 'router:nats'))
+        self.assertTrue(index.has_relation('nats', 'router'))
+        self.assertFalse(index.has_relation('nats:cluster', 'router'))
+        self.assertFalse(index.has_relation('nats', 'rabbitmq'))
+
+
+class TestThreeWay(unittest.TestCase):
+    def setUp(self):
+        self.real = load('status.json')
+        self.expected = load('state.json')
+
+    def test_empty(self):
+        self.assertEqual(delta.three_way({}, {}, self.real, 'build'), [])
+
+    def test_adds(self):
+        result = delta.three_way({}, self.expected, self.real, 'build')
+        self.assertIsInstance(result[0], actions.GenerateTactic)
+        deployed = set(t.kwargs['service']['service_name']
+                       for t in by_type(result, actions.DeployTactic))
+        self.assertEqual(deployed, set(self.expected['services']) -
+                         set(self.real['Services']))
+        rels = [(t.kwargs['endpoint_a'], t.kwargs['endpoint_b'])
+                for t in by_type(result, actions.AddRelationTactic)]
+        # nats:nats <-> router:nats already exists
+        self.assertEqual(rels, [('mysql:db', 'uaa:db')])
+        self.assertFalse(by_type(result, actions.RemoveServiceTactic))
+        self.assertFalse(by_type(result, actions.RemoveRelationTactic))
+
+    def test_no_generate_without_deploys(self):
+        current = copy.deepcopy(self.expected)
+        for name in set(current['services']) - set(self.real['Services']):
+            del current['services'][name]
+        current['relations'] = [['nats:nats', ['router:nats']]]
+        self.assertEqual(delta.three_way({}, current, self.real, 'build'), [])
+
+    def test_fingerprint(self):
+        digest = delta.fingerprint(self.real)
+        units = self.real['Services']['nats']['Units']
+        units['nats/0']['AgentState'] = 'error'
+        self.assertEqual(delta.fingerprint(self.real), digest)
+        units['nats/1'] = {}
+        self.assertNotEqual(delta.fingerprint(self.real), digest)
+
+    def test_removes_only_previous(self):
+        current = copy.deepcopy(self.expected)
+        del current['services']['router']
+        current['relations'] = [['uaa:db', ['mysql:db']]]
+        result = delta.three_way(self.expected, current, self.real, 'build')
+        removed = by_type(result, actions.RemoveServiceTactic)
+        self.assertEqual([t.kwargs['service_name'] for t in removed],
+                         ['router'])
+        # the router relation goes away with the service
+        self.assertFalse(by_type(result, actions.RemoveRelationTactic))
+
+        # without a previous state nothing is removed
+        result = delta.three_way({}, current, self.real, 'build')
+        self.assertFalse(by_type(result, actions.RemoveServiceTactic))
+
+    def test_remove_relation(self):
+        current = copy.deepcopy(self.expected)
+        current['relations'] = [['uaa:db', ['mysql:db']]]
+        result = delta.three_way(self.expected, current, self.real, 'build')
+        removed = by_type(result, actions.RemoveRelationTactic)
+        self.assertEqual([(t.kwargs['endpoint_a'], t.kwargs['endpoint_b'])
+                          for t in removed], [('nats:nats', 'router:nats')])
+
+    def test_config(self):
+        current = copy.deepcopy(self.expected)
+        current['services']['nats']['options'] = {'port': 4222}
+        result = delta.three_way(self.expected, current, self.real, 'build')
+        config = by_type(result, actions.SetConfigTactic)
+        self.assertEqual(len(config), 1)
+        self.assertEqual(config[0].kwargs, {'service_name': 'nats',
+                                            'config': {'port': 4222}})
+        # unchanged since the previous state
+        result = delta.three_way(current, current, self.real, 'build')
+        self.assertFalse(by_type(result, actions.SetConfigTactic))
+        # watcher reported config wins over the previous state
+        self.real['Services']['nats']['Config'] = {'port': 4000}
+        result = delta.three_way(current, current, self.real, 'build')
+        self.assertEqual(len(by_type(result, actions.SetConfigTactic)), 1)
+
+    def test_units(self):
+        current = copy.deepcopy(self.expected)
+        current['services']['nats']['num_units'] = 3
+        result = delta.three_way({}, current, self.real, 'build')
+        adds = by_type(result, actions.AddUnitsTactic)
+        self.assertEqual(adds[0].kwargs, {'service_name': 'nats',
+                                          'num_units': 2})
+
+        units = self.real['Services']['nats']['Units']
+        units['nats/1'] = units['nats/2'] = units['nats/10'] = {}
+        result = delta.three_way({}, current, self.real, 'build')
+        removes = by_type(result, actions.RemoveUnitsTactic)
+        self.assertEqual(removes[0].kwargs['unit_names'], ['nats/10'])
+
+    def test_units_removal_order(self):
+        current = copy.deepcopy(self.expected)
+        current['services']['nats']['num_units'] = 2
+        units = self.real['Services']['nats']['Units']
+        units['nats/1'] = {'AgentState': 'error'}
+        units['nats/2'] = units['nats/3'] = {'AgentState': 'started'}
+        units['nats/4'] = {'Life': 'dying'}
+        result = delta.three_way({}, current, self.real, 'build')
+        removes = by_type(result, actions.RemoveUnitsTactic)
+        # one batch: the broken unit, then the newest live one
+        self.assertEqual(len(removes), 1)
+        self.assertEqual(removes[0].kwargs['unit_names'],
+                         ['nats/1', 'nats/3'])
+
+        current['services']['nats']['num_units'] = 6
+        result = delta.three_way({}, current, self.real, 'build')
+        adds = by_type(result, actions.AddUnitsTactic)
+        self.assertEqual(adds[0].kwargs['num_units'], 2)
+
+    def test_upgrade_charm(self):
+        current = copy.deepcopy(self.expected)
+        current['services']['nats']['branch'] = 'local:trusty/nats-v2'
+        current['services']['mysql']['charm'] = 'cs:trusty/mysql-4'
+        result = delta.three_way(self.expected, current, self.real, 'build')
+        upgrades = by_type(result, actions.UpgradeCharmTactic)
+        self.assertEqual(sorted(t.kwargs['charm_url'] for t in upgrades),
+                         ['cs:trusty/mysql-4', 'local:trusty/nats-v2'])
+        self.assertIsInstance(result[0], actions.GenerateTactic)
+        updates = by_type(result, actions.UpdateCharmTactic)
+        # uaa is a fresh deploy
+        self.assertEqual([t.kwargs['charm_url'] for t in updates],
+                         ['local:trusty/nats-v2', 'local:trusty/uaa-v1'])
+
+        # an unpinned charm is current at any revision
+        self.real['Services']['mysql']['Charm'] = 'cs:trusty/mysql-7'
+        result = delta.three_way({}, self.expected, self.real, 'build')
+        self.assertFalse(by_type(result, actions.UpgradeCharmTactic))
+
+    def test_upgrade_regenerated_charm(self):
+        repo = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, repo)
+        charm_url = 'local:trusty/nats-v1'
+        _, charm_path = actions.local_charm_path(repo, charm_url)
+        os.makedirs(charm_path)
+        with open(os.path.join(charm_path, 'metadata.yaml'), 'w') as fp:
+            fp.write('name: nats-v1\n')
+        charms = CharmRevisions()
+        charms.record_upload(charm_url, charms.archives.tree_hash(charm_path),
+                             'local:trusty/nats-v1-0')
+        current = copy.deepcopy(self.expected)
+        for name in set(current['services']) - set(self.real['Services']):
+            del current['services'][name]
+        current['relations'] = [['nats:nats', ['router:nats']]]
+        # the deployed upload is the tree on disk
+        self.assertEqual(delta.three_way(
+            current, current, self.real, repo, charms), [])
+
+        # a changed definition upgrades before the tree is regenerated
+        with mock.patch.object(actions, 'outdated_charms',
+                               return_value=['nats-v1']) as outdated:
+            result = delta.three_way(current, current, self.real, repo,
+                                     charms)
+        outdated.assert_called_once_with(repo)
+        self.assertEqual([type(t) for t in result],
+                         [actions.GenerateTactic, actions.UpdateCharmTactic,
+                          actions.UpgradeCharmTactic])
+
+        # regenerated under the same name
+        with open(os.path.join(charm_path, 'metadata.yaml'), 'w') as fp:
+            fp.write('name: nats-v1\nsummary: changed\n')
+        result = delta.three_way(current, current, self.real, repo, charms)
+        self.assertEqual([type(t) for t in result],
+                         [actions.GenerateTactic, actions.UpdateCharmTactic,
+                          actions.UpgradeCharmTactic])
+        env = mock.Mock()
+        env.add_local_charm.return_value = {
+            'CharmURL': 'local:trusty/nats-v1-1'}
+        result[1].run(env)
+        self.assertEqual(result[1].state, actions.COMPLETE)
+        result[2].run(env)
+        env.set_charm.assert_called_once_with('nats', 'local:trusty/nats-v1-1')
@@ -0,0 +1,28 @@
+import json
+import unittest
+
+from cloudfoundry.events import EventLog
+
+
+class TestEventLog(unittest.TestCase):
+    def test_publish(self):
+        log = EventLog(size=3)
+        waiter = log.wait()
+        self.assertIs(log.wait(), waiter)
+        log.publish('tactic', state='RUNNING')
+        self.assertEqual(waiter.result(), 1)
+        self.assertIsNot(log.wait(), waiter)
+        event_id, payload = log.since(0)[0]
+        self.assertEqual(event_id, 1)
+        self.assertEqual(json.loads(payload),
+                         {'id': 1, 'type': 'tactic', 'state': 'RUNNING'})
+
+    def test_since(self):
+        log = EventLog(size=3)
+        self.assertEqual(log.since(0), [])
+        for i in range(5):
+            log.publish('tactic', n=i)
+        # only the last three are kept
+        self.assertEqual([i for i, _ in log.since(0)], [3, 4, 5])
+        self.assertEqual([i for i, _ in log.since(4)], [5])
+        self.assertEqual(log.since(5), [])
@@ -0,0 +1,119 @@
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+
+from jujuclient import EnvError
+from tornado import testing
+
+from benchmarks import deploy
+from benchmarks.fakejuju import FakeJuju
+from cloudfoundry.charms import ZipStream
+from cloudfoundry.client import EnvironmentPool, PipelinedEnvironment
+from cloudfoundry.executor import ThreadPool
+
+
+class TestFakeJuju(testing.AsyncTestCase):
+    def setUp(self):
+        super(TestFakeJuju, self).setUp()
+        self.juju = FakeJuju(io_loop=self.io_loop)
+        self.port = self.juju.listen()
+        self.executor = ThreadPool(2, io_loop=self.io_loop)
+        self.envs = []
+
+    def tearDown(self):
+        self.juju.server.stop()
+        super(TestFakeJuju, self).tearDown()
+
+    def connect(self):
+        env = PipelinedEnvironment('ws://127.0.0.1:%d' % self.port)
+        env.login('secret')
+        self.envs.append(env)
+        return env
+
+    def call(self, fn, *args):
+        # the client blocks, the server needs the IOLoop
+        return self.executor.submit(fn, *args)
+
+    @testing.gen_test
+    def test_deploy_and_relate(self):
+        env = yield self.call(self.connect)
+        yield self.call(env.deploy, 'mysql', 'cs:trusty/mysql-1', 2)
+        yield self.call(env.deploy, 'uaa', 'cs:trusty/uaa-1')
+        yield self.call(env.add_relation, 'uaa:db', 'mysql:db')
+        yield self.call(env.expose, 'uaa')
+        status = yield self.call(env.status)
+        services = status['Services']
+        self.assertEqual(sorted(services['mysql']['Units']),
+                         ['mysql/0', 'mysql/1'])
+        self.assertEqual(services['uaa']['Relations'], {'db': ['mysql']})
+        self.assertTrue(services['uaa']['Exposed'])
+        with self.assertRaises(EnvError):
+            yield self.call(env.add_relation, 'mysql:db', 'uaa:db')
+
+        yield self.call(env.destroy_service, 'mysql')
+        status = yield self.call(env.status)
+        self.assertEqual(status['Services']['uaa']['Relations'], {})
+
+    @testing.gen_test
+    def test_login(self):
+        env = yield self.call(PipelinedEnvironment,
+                              'ws://127.0.0.1:%d' % self.port)
+        with self.assertRaises(EnvError):
+            yield self.call(env.login, 'wrong')
+
+    @testing.gen_test
+    def test_failure_injection(self):
+        self.juju.failures['ServiceDeploy'] = 1
+        env = yield self.call(self.connect)
+        with self.assertRaises(EnvError):
+            yield self.call(env.deploy, 'mysql', 'cs:trusty/mysql-1')
+        self.assertEqual(self.juju.calls['ServiceDeploy'], 1)
+
+    @testing.gen_test
+    def test_latency(self):
+        self.juju.latencies['EnvironmentInfo'] = 0.1
+        env = yield self.call(self.connect)
+        start = self.io_loop.time()
+        yield self.call(env.info)
+        self.assertGreaterEqual(self.io_loop.time() - start, 0.1)
+
+    @testing.gen_test
+    def test_add_local_charm(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('metadata.yaml', 'name: nats\n')
+        env = yield self.call(self.connect)
+        result = yield self.call(env.add_local_charm, archive.getvalue(),
+                                 'trusty')
+        self.assertEqual(result, {'CharmURL': 'local:trusty/nats-0'})
+
+    @testing.gen_test
+    def test_add_local_charm_streamed(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with open(os.path.join(tmpdir, 'metadata.yaml'), 'w') as fp:
+            fp.write('name: nats\n')
+        stream = ZipStream([('metadata.yaml',
+                             os.path.join(tmpdir, 'metadata.yaml'))])
+        env = yield self.call(self.connect)
+        result = yield self.call(env.add_local_charm, stream, 'trusty',
+                                 stream.size)
+        self.assertEqual(result, {'CharmURL': 'local:trusty/nats-0'})
+
+    @testing.gen_test
+    def test_pool_survives_restart(self):
+        pool = EnvironmentPool(self.connect, size=1)
+        yield self.call(pool.info)
+        self.juju.disconnect()
+        yield self.call(pool.info)
+        self.assertEqual(len(self.envs), 2)
+
+
+class TestDeployBenchmark(testing.AsyncTestCase):
+    @testing.gen_test(timeout=30)
+    def test_converges(self):
+        result = yield deploy.run(10)
+        self.assertEqual(result['state'], 'COMPLETE')
+        self.assertEqual(result['remaining'], 0)
@@ -6,9 +6,14 @@ import tempfile
 import unittest
 from contextlib import contextmanager
 
+import mock
 import yaml
 
 from charmgen.generator import CharmGenerator, main
+from charmgen.store import ObjectStore
+from charmgen.topology import Endpoint, Topology, charm_endpoints
+from cloudfoundry import releases
+from cloudfoundry.services import SERVICES as CF_SERVICES
 from cloudfoundry.contexts import OrchestratorRelation
 from cloudfoundry.path import path
 
@@ -172,6 +177,18 @@ class TestGenerator(unittest.TestCase):
         # Verify we found expected relations
         self.assertIn(expected, rels)
 
+    def test_build_deployment_leaves_release_alone(self):
+        g = CharmGenerator(releases.RELEASES, CF_SERVICES)
+        g.select_release(173)
+        common = list(releases.COMMON_RELATIONS)
+        first = g.build_deployment()
+        self.assertEqual(g.build_deployment(), first)
+        self.assertEqual(releases.COMMON_RELATIONS, common)
+        # a fresh generator compiles the same topology
+        g = CharmGenerator(releases.RELEASES, CF_SERVICES)
+        g.select_release(173)
+        self.assertEqual(g.build_deployment(), first)
+
     def test_generate_deployment(self):
         g = CharmGenerator(RELEASES, SERVICES)
         g.select_release(173)
@@ -206,6 +223,86 @@ class TestGenerator(unittest.TestCase):
             self.assertTrue(os.path.isdir(os.path.join(
                 tmpdir, 'trusty', 'cloud_controller_v1', 'files')))
 
+    def test_generate_shares_files(self):
+        g = CharmGenerator(RELEASES, SERVICES)
+        g.select_release(173)
+        with tempdir() as tmpdir:
+            store = ObjectStore(os.path.join(tmpdir, 'objects'))
+            g.generate(os.path.join(tmpdir, '173'), store)
+            g.generate(os.path.join(tmpdir, '174'), store)
+            a = path(tmpdir) / '173/trusty/cloud_controller_v1/hooks'
+            b = path(tmpdir) / '174/trusty/router_v1/hooks'
+            self.assertTrue(os.path.samefile(
+                a / 'cloudfoundry/jobs.py', b / 'cloudfoundry/jobs.py'))
+            self.assertTrue(os.path.samefile(
+                a / 'charmhelpers/__init__.py',
+                b / 'charmhelpers/__init__.py'))
+            # per charm files are not shared
+            self.assertFalse(os.path.samefile(
+                a / 'entry.py', b / 'entry.py'))
+
+    def test_generate_workers(self):
+        g = CharmGenerator(RELEASES, SERVICES)
+        g.select_release(173)
+
+        def tree(root):
+            return sorted((os.path.relpath(p, root),
+                           None if p.isdir() else p.bytes())
+                          for p in path(root).walk()
+                          if '.objects' not in p)
+        with tempdir() as tmpdir:
+            g.generate(os.path.join(tmpdir, 'serial'), workers=1)
+            g.generate(os.path.join(tmpdir, 'pool'), workers=3)
+            self.assertEqual(tree(os.path.join(tmpdir, 'serial')),
+                             tree(os.path.join(tmpdir, 'pool')))
+
+    def test_generate_failure_hides_bundle(self):
+        g = CharmGenerator(RELEASES, SERVICES)
+        g.select_release(173)
+        with tempdir() as tmpdir:
+            g.generate(tmpdir)
+            with mock.patch.object(CharmGenerator, 'build_entry',
+                                   side_effect=ValueError('boom')), \
+                    mock.patch('charmgen.generator.GENERATOR_VERSION', 2):
+                self.assertRaises(ValueError, g.generate, tmpdir, workers=2)
+            self.assertFalse(os.path.exists(
+                os.path.join(tmpdir, 'bundles.yaml')))
+            # and nothing is left recorded as built
+            self.assertEqual(len(g.generate(tmpdir)), 3)
+
+    def test_generate_partial(self):
+        g = CharmGenerator(RELEASES, SERVICES)
+        g.select_release(173)
+        with tempdir() as tmpdir:
+            charms = sorted(g.generate(tmpdir))
+            self.assertEqual(charms, ['cc_clock_v1', 'cloud_controller_v1',
+                                      'router_v1'])
+            self.assertEqual(g.generate(tmpdir), [])
+            self.assertTrue(os.path.exists(
+                os.path.join(tmpdir, 'bundles.yaml')))
+
+            registry = dict(SERVICES)
+            registry['router_v1'] = {'summary': 'changed'}
+            g = CharmGenerator(RELEASES, registry)
+            g.select_release(173)
+            # known to be out of date before the tree changes
+            meta = path(tmpdir) / 'trusty/router_v1/metadata.yaml'
+            before = meta.text()
+            self.assertEqual(g.outdated(tmpdir), ['router_v1'])
+            self.assertEqual(g.outdated(os.path.join(tmpdir, 'none')), [])
+            self.assertEqual(meta.text(), before)
+            self.assertEqual(g.generate(tmpdir), ['router_v1'])
+            self.assertEqual(g.outdated(tmpdir), [])
+            self.assertEqual(yaml.safe_load(meta.text())['summary'],
+                             'changed')
+
+            # missing charms are rebuilt
+            shutil.rmtree(os.path.join(tmpdir, 'trusty', 'cc_clock_v1'))
+            self.assertEqual(g.generate(tmpdir), ['cc_clock_v1'])
+
+            with mock.patch('charmgen.generator.GENERATOR_VERSION', 2):
+                self.assertEqual(len(g.generate(tmpdir)), 3)
+
     def test_generate_missing_service(self):
         releases = [{'releases': (1, 1), 'topology': {
             'services': [('missing', '??')],
@@ -223,5 +320,65 @@ class TestGenerator(unittest.TestCase):
             self.assertTrue((path(tmpdir) / 'bundles.yaml').exists())
             self.assertTrue((path(tmpdir) / 'trusty/nats-v1').exists())
 
+
+class TestTopology(unittest.TestCase):
+    def test_compile(self):
+        topology = Topology(RELEASES[0], SERVICES)
+        self.assertEqual([c.name for c in topology.managed],
+                         ['cloud_controller_v1', 'router_v1', 'cc_clock_v1'])
+        self.assertIn(Endpoint('nats', contexts.NatsRelation.interface),
+                      topology.requires['cloud_controller_v1'])
+        self.assertIn(Endpoint(OrchestratorRelation.name,
+                               OrchestratorRelation.interface),
+                      topology.requires['router_v1'])
+        self.assertEqual(topology.providers,
+                         {contexts.CloudControllerRelation.name: 'cc'})
+        self.assertIn('cc-relation-joined',
+                      topology.hooks['cloud_controller_v1'])
+        self.assertIsInstance(topology.relations, tuple)
+        self.assertEqual(topology.constraint('cc'), 'root-disk=10G')
+
+    def test_duplicate_endpoints(self):
+        class First(contexts.RelationContext):
+            name = 'db'
+            interface = 'mysql'
+
+        class Last(contexts.RelationContext):
+            name = 'db'
+            interface = 'postgresql'
+        provides, requires = charm_endpoints({'jobs': [
+            {'provided_data': [First]}, {'provided_data': [Last]}]})
+        # the last definition of a name wins
+        self.assertEqual(provides, (Endpoint('db', 'postgresql'),))
+
+    def test_missing_service(self):
+        release = {'topology': {'services': [('missing', '??')]}}
+        self.assertRaises(KeyError, Topology, release, {})
+
+
+class TestObjectStore(unittest.TestCase):
+    def test_link_tree(self):
+        with tempdir() as tmpdir:
+            src = path(tmpdir) / 'src'
+            (src / 'sub').makedirs_p()
+            (src / 'a').write_text('same')
+            (src / 'sub/b').write_text('same')
+            (src / 'c').write_text('same')
+            os.chmod(src / 'c', 0755)
+            store = ObjectStore(os.path.join(tmpdir, 'objects'))
+            store.link_tree(src, os.path.join(tmpdir, 'dst'))
+            dst = path(tmpdir) / 'dst'
+            self.assertEqual((dst / 'sub/b').text(), 'same')
+            self.assertTrue(os.path.samefile(dst / 'a', dst / 'sub/b'))
+            # the mode is part of an object's identity
+            self.assertFalse(os.path.samefile(dst / 'a', dst / 'c'))
+            self.assertTrue(os.access(dst / 'c', os.X_OK))
+
+            # changed sources get a new object
+            (src / 'a').write_text('changed')
+            store.link(src / 'a', dst / 'a')
+            self.assertEqual((dst / 'a').text(), 'changed')
+            self.assertEqual((dst / 'sub/b').text(), 'same')
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from cloudfoundry import journal
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'history', 'journal.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reverse_lines(self):
+        fn = os.path.join(self.tmpdir, 'lines')
+        with open(fn, 'w') as fp:
+            fp.write(''.join('line %d\n' % i for i in range(100)))
+        lines = list(journal.reverse_lines(fn, block_size=7))
+        self.assertEqual(lines, ['line %d' % i for i in range(99, -1, -1)])
+        self.assertEqual(list(journal.reverse_lines(fn + '.missing')), [])
+
+    def test_page(self):
+        j = journal.Journal(self.filename, recent=3)
+        for i in range(10):
+            j.append({'id': i})
+        self.assertEqual(len(j.recent), 3)
+        self.assertEqual(j.page(0, 2), [{'id': 9}, {'id': 8}])
+        # past the ring buffer the page comes from disk
+        self.assertEqual(j.page(4, 3), [{'id': 5}, {'id': 4}, {'id': 3}])
+        self.assertEqual(j.page(9, 5), [{'id': 0}])
+
+    def test_rotation(self):
+        j = journal.Journal(self.filename, max_bytes=100, backups=2,
+                            recent=1)
+        for i in range(100):
+            j.append({'id': i, 'pad': 'x' * 10})
+        self.assertTrue(os.path.exists(self.filename + '.2'))
+        self.assertFalse(os.path.exists(self.filename + '.3'))
+        total = sum(os.path.getsize(f) for f in j.files
+                    if os.path.exists(f))
+        self.assertLess(total, 400)
+        ids = [e['id'] for e in j.page(0, 100)]
+        self.assertEqual(ids, sorted(ids, reverse=True))
+        self.assertEqual(ids[0], 99)
+
+    def test_rotation_without_backups(self):
+        j = journal.Journal(self.filename, max_bytes=100, backups=0,
+                            recent=5)
+        for i in range(100):
+            j.append({'id': i, 'pad': 'x' * 10})
+        self.assertEqual(j.files, [self.filename])
+        self.assertLessEqual(os.path.getsize(self.filename), 100)
+        self.assertEqual(j.page(0, 1), [{'id': 99, 'pad': 'x' * 10}])
+
+    def test_reload(self):
+        j = journal.Journal(self.filename)
+        for i in range(3):
+            j.append({'id': i})
+        j = journal.Journal(self.filename)
+        self.assertEqual(list(j.recent), [{'id': 2}, {'id': 1}, {'id': 0}])
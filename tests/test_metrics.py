@@ -0,0 +1,60 @@
+import unittest
+
+from cloudfoundry import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        registry = metrics.Registry()
+        counter = metrics.Counter('passes_total', 'Passes.', ['result'],
+                                  registry=registry)
+        counter.inc(result='skipped')
+        counter.inc(2, result='built')
+        self.assertEqual(counter.value(result='built'), 2)
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP passes_total Passes.',
+            '# TYPE passes_total counter',
+            'passes_total{result="built"} 2.0',
+            'passes_total{result="skipped"} 1.0',
+            '']))
+
+    def test_unknown_label(self):
+        registry = metrics.Registry()
+        counter = metrics.Counter('c', 'C.', ['result'], registry=registry)
+        self.assertRaises(ValueError, counter.inc, environment='prod')
+        hist = metrics.Histogram('h', 'H.', ['kind'], registry=registry)
+        self.assertRaises(ValueError, hist.observe, 1, environment='prod')
+
+    def test_label_escaping(self):
+        registry = metrics.Registry()
+        counter = metrics.Counter('c', 'C.', ['name'], registry=registry)
+        counter.inc(name='say "hi"')
+        self.assertIn(r'c{name="say \"hi\""} 1.0', registry.render())
+
+    def test_gauge(self):
+        registry = metrics.Registry()
+        gauge = metrics.Gauge('depth', 'Depth.', registry=registry)
+        gauge.set(3)
+        self.assertEqual(gauge.value(), 3)
+        queue = [1, 2]
+        gauge.set_function(lambda: len(queue))
+        queue.append(3)
+        self.assertIn('depth 3.0', registry.render())
+
+    def test_histogram(self):
+        registry = metrics.Registry()
+        hist = metrics.Histogram('t_seconds', 'T.', ['kind'],
+                                 registry=registry, buckets=[1, 0.1])
+        hist.observe(0.05, kind='a')
+        hist.observe(0.5, kind='a')
+        hist.observe(5, kind='a')
+        self.assertEqual(hist.count(kind='a'), 3)
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP t_seconds T.',
+            '# TYPE t_seconds histogram',
+            't_seconds_bucket{kind="a",le="0.1"} 1.0',
+            't_seconds_bucket{kind="a",le="1.0"} 2.0',
+            't_seconds_bucket{kind="a",le="+Inf"} 3.0',
+            't_seconds_sum{kind="a"} 5.55',
+            't_seconds_count{kind="a"} 3.0',
+            '']))
@@ -0,0 +1,515 @@
+import datetime
+import gzip
+import json
+import pkg_resources
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from cStringIO import StringIO
+
+import mock
+import tornado.concurrent
+from jujuclient import EnvError
+from tornado import testing
+
+from cloudfoundry import actions
+from cloudfoundry import model
+from cloudfoundry.config import COMPLETE, FAILED, PENDING
+from cloudfoundry.events import EventLog
+from cloudfoundry.executor import ThreadPool, first_completed, run_in_process
+
+
+class TestReality(unittest.TestCase):
+    def setUp(self):
+        self.status = json.loads(
+            pkg_resources.resource_string(__name__, 'status.json'))
+        self.reality = model.Reality()
+        self.reality.seed(self.status)
+
+    def test_seed(self):
+        self.assertTrue(self.reality.seeded)
+        self.assertEqual(self.reality.status['Services'],
+                         self.status['Services'])
+        # the seed is a copy, not a reference
+        self.reality.services.pop('nats')
+        self.assertIn('nats', self.status['Services'])
+
+    def test_apply_service(self):
+        version = self.reality.version
+        self.reality.apply([
+            ['service', 'change', {'Name': 'dea',
+                                   'CharmURL': 'local:trusty/dea-v1-0',
+                                   'Exposed': False, 'Life': 'alive'}]])
+        self.assertEqual(self.reality.services['dea']['Charm'],
+                         'local:trusty/dea-v1-0')
+        self.assertGreater(self.reality.version, version)
+
+        self.reality.apply([['service', 'remove', {'Name': 'dea'}]])
+        self.assertNotIn('dea', self.reality.services)
+
+    def test_apply_unit(self):
+        self.reality.apply([
+            ['unit', 'change', {'Name': 'nats/1', 'Service': 'nats',
+                                'MachineId': '20', 'Status': 'pending'}]])
+        units = self.reality.services['nats']['Units']
+        self.assertEqual(units['nats/1']['AgentState'], 'pending')
+        self.reality.apply([
+            ['unit', 'remove', {'Name': 'nats/1', 'Service': 'nats'}]])
+        self.assertNotIn('nats/1', units)
+
+    def test_apply_relation(self):
+        self.reality.apply([
+            ['relation', 'change', {'Key': 'uaa:db mysql:db'}]])
+        services = self.reality.services
+        self.assertEqual(services['uaa']['Relations']['db'], ['mysql'])
+        self.assertIn('uaa', services['mysql']['Relations']['db'])
+
+        version = self.reality.version
+        self.assertFalse(self.reality.apply([
+            ['relation', 'change', {'Key': 'uaa:db mysql:db'}]]))
+        self.assertEqual(self.reality.version, version)
+
+        self.reality.apply([
+            ['relation', 'remove', {'Key': 'uaa:db mysql:db'}]])
+        self.assertNotIn('db', services['uaa']['Relations'])
+
+    def test_apply_peer_relation(self):
+        self.reality.apply([
+            ['relation', 'remove', {'Key': 'etcd:cluster'}]])
+        self.assertNotIn('cluster', self.reality.services['etcd']['Relations'])
+        self.reality.apply([
+            ['relation', 'change', {'Key': 'etcd:cluster'}]])
+        self.assertEqual(
+            self.reality.services['etcd']['Relations']['cluster'], ['etcd'])
+
+    def test_ignores_machines(self):
+        version = self.reality.version
+        self.assertFalse(self.reality.apply([
+            ['machine', 'change', {'Id': '1'}]]))
+        self.assertEqual(self.reality.version, version)
+
+
+class SleepTactic(actions.Tactic):
+    name = "Sleep"
+    lock = threading.Lock()
+    active = 0
+    peak = 0
+
+    def _run(self, env, **kwargs):
+        with self.lock:
+            SleepTactic.active += 1
+            SleepTactic.peak = max(SleepTactic.peak, SleepTactic.active)
+        time.sleep(kwargs.get('sleep', 0.05))
+        with self.lock:
+            SleepTactic.active -= 1
+        # fail=True fails every attempt, fail=n the first n
+        fail = kwargs.get('fail')
+        if fail is True or fail and self.attempts <= fail:
+            raise ValueError('failed')
+
+
+class FakeDeploy(SleepTactic):
+    def provides(self):
+        return set([('service', self.kwargs['name'])])
+
+
+class FakeRelate(SleepTactic):
+    def requires(self):
+        return set([('service', n) for n in self.kwargs['names']])
+
+
+class TestStrategy(testing.AsyncTestCase):
+    def setUp(self):
+        super(TestStrategy, self).setUp()
+        SleepTactic.peak = 0
+
+    def test_compile(self):
+        a, b = FakeDeploy(name='a'), FakeDeploy(name='b')
+        rel = FakeRelate(names=['a', 'b'])
+        other = FakeRelate(names=['a', 'c'])
+        strategy = model.Strategy(None)
+        strategy.extend([rel, a, other, b])
+        deps = strategy.compile()
+        self.assertEqual(deps[rel], set([a, b]))
+        self.assertEqual(deps[other], set([a]))
+        self.assertEqual(deps[a], set())
+        self.assertEqual(strategy.ready(), [a, b])
+
+    @testing.gen_test
+    def test_concurrent(self):
+        strategy = model.Strategy(None, ThreadPool(3), concurrency=3)
+        deploys = [FakeDeploy(name=str(i)) for i in range(6)]
+        rel = FakeRelate(names=['0', '5'])
+        strategy.append(rel)
+        strategy.extend(deploys)
+        yield strategy()
+        self.assertEqual(strategy.state, COMPLETE)
+        self.assertEqual(SleepTactic.peak, 3)
+        self.assertTrue(rel.start_time >= max(
+            deploys[0].end_time, deploys[5].end_time))
+        self.assertGreater(strategy.timings()['speedup'], 1.5)
+
+    @testing.gen_test
+    def test_events(self):
+        events = EventLog()
+        strategy = model.Strategy(None, ThreadPool(1), events=events)
+        strategy.extend([FakeDeploy(name='a'), FakeDeploy(name='b')])
+        yield strategy()
+        published = [json.loads(p) for _, p in events.since(0)]
+        self.assertEqual(
+            [(e['type'], e['state'], e.get('index')) for e in published],
+            [('strategy', 'RUNNING', None),
+             ('tactic', 'RUNNING', 0), ('tactic', 'COMPLETE', 0),
+             ('tactic', 'RUNNING', 1), ('tactic', 'COMPLETE', 1),
+             ('strategy', 'COMPLETE', None)])
+        self.assertTrue(published[2]['end_time'])
+
+    @testing.gen_test
+    def test_failure_blocks_dependents_only(self):
+        strategy = model.Strategy(None, ThreadPool(1), concurrency=1)
+        strategy.extend([FakeDeploy(name='a', fail=True),
+                         FakeDeploy(name='b'),
+                         FakeRelate(names=['a', 'b']),
+                         FakeRelate(names=['b'])])
+        yield strategy()
+        self.assertEqual(strategy.state, FAILED)
+        self.assertEqual([t.state for t in strategy],
+                         [FAILED, COMPLETE, PENDING, COMPLETE])
+        self.assertFalse(strategy.runnable)
+
+    @testing.gen_test
+    def test_retry(self):
+        retries = model.TACTIC_RETRIES.value(tactic='FakeDeploy')
+        strategy = model.Strategy(None, ThreadPool(1))
+        deploy = FakeDeploy(name='a', fail=2, sleep=0)
+        deploy.retries, deploy.backoff = 2, 0.01
+        strategy.extend([deploy, FakeRelate(names=['a'], sleep=0)])
+        start = self.io_loop.time()
+        yield strategy()
+        self.assertEqual(strategy.state, COMPLETE)
+        self.assertEqual(deploy.attempts, 3)
+        self.assertIsNone(deploy.failure)
+        # backed off 0.01 then 0.02
+        self.assertGreaterEqual(self.io_loop.time() - start, 0.03)
+        self.assertEqual(model.TACTIC_RETRIES.value(tactic='FakeDeploy'),
+                         retries + 2)
+
+    @testing.gen_test
+    def test_timeout(self):
+        strategy = model.Strategy(None, ThreadPool(2), concurrency=2)
+        slow = FakeDeploy(name='a', sleep=0.2)
+        slow.timeout = 0.05
+        strategy.extend([slow, FakeDeploy(name='b')])
+        yield strategy()
+        self.assertEqual(strategy.state, FAILED)
+        self.assertEqual(slow.state, FAILED)
+        self.assertIn('timed out', str(slow.failure))
+        self.assertEqual(strategy[1].state, COMPLETE)
+        # the abandoned attempt finishing doesn't resurrect it
+        time.sleep(0.2)
+        self.assertEqual(slow.state, FAILED)
+
+    @testing.gen_test
+    def test_due_retry_waits_for_slot(self):
+        # a retry falling due while the only slot is taken
+        # must not spin the loop until the slot frees up
+        strategy = model.Strategy(None, ThreadPool(1), concurrency=1)
+        flaky = FakeDeploy(name='a', fail=1, sleep=0)
+        flaky.retries, flaky.backoff = 1, 0.01
+        strategy.extend([flaky, FakeDeploy(name='b', sleep=0.2)])
+        waits = []
+
+        def counting(futures):
+            waits.append(len(futures))
+            return first_completed(futures)
+        with mock.patch.object(model, 'first_completed', counting):
+            yield strategy()
+        self.assertEqual(strategy.state, COMPLETE)
+        self.assertLessEqual(len(waits), 5)
+
+    @testing.gen_test
+    def test_timed_out_attempt_keeps_slot(self):
+        strategy = model.Strategy(None, ThreadPool(2), concurrency=1)
+        slow = FakeDeploy(name='a', sleep=0.2)
+        slow.timeout, slow.retries, slow.backoff = 0.05, 1, 0.01
+        other = FakeDeploy(name='b', sleep=0)
+        strategy.extend([slow, other])
+        start = time.time()
+        yield strategy()
+        # the retry never overlapped the abandoned attempt, nor
+        # did the other tactic get its slot while that ran
+        self.assertEqual(SleepTactic.peak, 1)
+        self.assertEqual(slow.attempts, 2)
+        self.assertGreaterEqual(
+            other.start_time, datetime.datetime.fromtimestamp(start + 0.2))
+
+    @testing.gen_test
+    def test_metrics(self):
+        durations = model.TACTIC_DURATION.count(
+            environment='prod', tactic='FakeDeploy')
+        failed = model.STRATEGIES.value(environment='prod', result='FAILED')
+        others = model.STRATEGIES.value(environment='staging',
+                                        result='FAILED')
+        strategy = model.Strategy(None, ThreadPool(1), environment='prod')
+        strategy.extend([FakeDeploy(name='a', fail=True)])
+        yield strategy()
+        self.assertEqual(model.TACTIC_DURATION.count(
+            environment='prod', tactic='FakeDeploy'), durations + 1)
+        self.assertEqual(
+            model.STRATEGIES.value(environment='prod', result='FAILED'),
+            failed + 1)
+        # other environments count on their own
+        self.assertEqual(
+            model.STRATEGIES.value(environment='staging', result='FAILED'),
+            others)
+
+
+class TestRetriedTactics(unittest.TestCase):
+    def test_add_relation(self):
+        env = mock.Mock()
+        env.add_relation.side_effect = EnvError(
+            {'Error': 'cannot add relation: relation already exists'})
+        tactic = actions.AddRelationTactic(endpoint_a='a:db',
+                                           endpoint_b='b:db')
+        # a first attempt means it was there before us
+        tactic.run(env)
+        self.assertEqual(tactic.state, FAILED)
+        # on a retry, the lost first attempt made it
+        tactic.reset()
+        tactic.run(env)
+        self.assertEqual(tactic.state, COMPLETE)
+
+    def test_deploy(self):
+        env = mock.Mock()
+        env.deploy.side_effect = EnvError(
+            {'Error': 'service "mysql" already exists'})
+        tactic = actions.DeployTactic(repo='build', service={
+            'service_name': 'mysql', 'charm': 'cs:trusty/mysql',
+            'expose': True})
+        tactic.run(env)
+        self.assertEqual(tactic.state, FAILED)
+        self.assertFalse(env.expose.called)
+        tactic.reset()
+        tactic.run(env)
+        self.assertEqual(tactic.state, COMPLETE)
+        env.expose.assert_called_once_with('mysql')
+
+        env.deploy.side_effect = EnvError({'Error': 'no such charm'})
+        tactic.reset()
+        tactic.run(env)
+        self.assertEqual(tactic.state, FAILED)
+
+
+class TestThreadPool(testing.AsyncTestCase):
+    @testing.gen_test
+    def test_lanes(self):
+        pool = ThreadPool(2)
+        slow, fast = pool.lane('slow', limit=1), pool.lane('fast', limit=1)
+        self.assertIs(pool.lane('slow'), slow)
+        started = []
+        gate = threading.Event()
+
+        def work(name):
+            started.append(name)
+            if name.startswith('slow'):
+                gate.wait(5)
+            return name
+
+        slows = [slow.submit(work, 'slow%d' % i) for i in range(3)]
+        # the slow lane is capped, so the other lane gets a worker
+        result = yield fast.submit(work, 'fast')
+        self.assertEqual(result, 'fast')
+        self.assertEqual(sorted(started), ['fast', 'slow0'])
+        gate.set()
+        results = yield slows
+        self.assertEqual(results, ['slow0', 'slow1', 'slow2'])
+
+
+class TestRunInProcess(unittest.TestCase):
+    def test_result(self):
+        self.assertEqual(run_in_process(sum, [1, 2, 3]), 6)
+
+    def test_error(self):
+        self.assertRaises(ZeroDivisionError, run_in_process, divmod, 1, 0)
+
+
+class TestStateDatabase(testing.AsyncTestCase):
+    def setUp(self):
+        super(TestStateDatabase, self).setUp()
+        self.status = json.loads(
+            pkg_resources.resource_string(__name__, 'status.json'))
+        self.env_patch = mock.patch.object(
+            model.StateDatabase, 'get_env', mock.Mock())
+        self.env_patch.start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = model.StateDatabase({
+            'journal.path': self.tmpdir + '/journal.log',
+            'juju.environment': 'test',
+            'credentials.password': 'secret',
+            'generate.workers': 1,
+            'strategy.concurrency': 2})
+        self.juju = model.StateDatabase.get_env.return_value
+        self.juju.status.return_value = self.status
+
+    def tearDown(self):
+        self.env_patch.stop()
+        shutil.rmtree(self.tmpdir)
+        super(TestStateDatabase, self).tearDown()
+
+    def test_config_defaults(self):
+        self.assertEqual(self.db.config['strategy.concurrency'], 2)
+        self.assertEqual(self.db.config['juju.pool_size'],
+                         model.DEFAULTS['juju.pool_size'])
+
+    @testing.gen_test
+    def test_refresh(self):
+        self.assertIsNone(self.db.real)
+        yield self.db.refresh()
+        self.assertEqual(self.db.real['Services'], self.status['Services'])
+
+    @testing.gen_test
+    def test_watch_restart_replaces_reality(self):
+        nats = ['service', 'change', {'Name': 'nats', 'Life': 'alive',
+                                      'CharmURL': 'local:trusty/nats-v1-0'}]
+        router = ['service', 'change', {'Name': 'router', 'Life': 'alive',
+                                        'CharmURL': 'local:trusty/router-0'}]
+        dea = ['service', 'change', {'Name': 'dea', 'Life': 'alive',
+                                     'CharmURL': 'local:trusty/dea-0'}]
+
+        class FakeWatcher(object):
+            def __init__(self, batches):
+                self.batches = batches
+                self.conn = object()
+                self.released = False
+
+            def __iter__(self):
+                return self
+
+            def next(self):
+                if not self.batches:
+                    raise StopIteration
+                batch = self.batches.pop(0)
+                if batch is None:
+                    # reconnected by itself, on a new connection
+                    self.conn = object()
+                    batch = self.batches.pop(0)
+                return batch
+
+            def release(self):
+                self.released = True
+
+        first = FakeWatcher([
+            [nats, router], [['service', 'remove', {'Name': 'nats'}]],
+            # dea came and router went while disconnected
+            None, [dea], [nats]])
+        # dea went away while nothing watched
+        watchers = [first, FakeWatcher([[nats]])]
+        blocked = threading.Event()
+
+        def get_watch():
+            if watchers:
+                return watchers.pop(0)
+            blocked.wait()
+            return iter(())
+        self.juju.get_watch.side_effect = get_watch
+        seen = []
+        done = tornado.concurrent.Future()
+
+        def changed():
+            seen.append(sorted(self.db.reality.services))
+            if len(seen) == 5:
+                done.set_result(None)
+        # batches before the status call seed reality
+        self.db.watch(changed)
+        yield done
+        self.assertEqual(seen, [['nats', 'router'], ['router'], ['dea'],
+                                ['dea', 'nats'], ['nats']])
+        self.assertTrue(self.db.reality.seeded)
+        # the finished watcher was stopped, not left behind
+        self.assertTrue(first.released)
+
+    def test_encode_expected(self):
+        version = self.db.expected_version
+        self.db.expected = {'services': {'b': {}, 'a': {}}}
+        self.assertEqual(self.db.expected_version, version + 1)
+        encoded = self.db.encode_expected()
+        self.assertEqual(encoded, '{"services":{"a":{},"b":{}}}')
+        # cached until expected changes
+        self.assertIs(self.db.encode_expected(), encoded)
+        compressed = self.db.encode_expected(compress=True)
+        self.assertEqual(gzip.GzipFile(
+            fileobj=StringIO(compressed)).read(), encoded)
+        digest = self.db.expected_hash
+        self.db.expected = {'services': {'a': {}, 'b': {}}}
+        self.assertIsNot(self.db.encode_expected(), encoded)
+        self.assertEqual(self.db.expected_hash, digest)
+        self.db.expected = {}
+        self.assertNotEqual(self.db.expected_hash, digest)
+
+    @testing.gen_test
+    def test_build_strategy_skips_unchanged(self):
+        yield self.db.refresh()
+        self.db.expected = json.loads(
+            pkg_resources.resource_string(__name__, 'state.json'))
+        skipped = model.RECONCILE_PASSES.value(
+            environment='test', result='skipped')
+        self.db.build_strategy()
+        self.assertTrue(self.db.strategy)
+        del self.db.strategy[:]
+        self.db.build_strategy()
+        self.assertFalse(self.db.strategy)
+        self.assertEqual(model.RECONCILE_PASSES.value(
+            environment='test', result='skipped'), skipped + 1)
+        # a real change makes it diff again
+        self.db.reality.apply([
+            ['relation', 'remove', {'Key': 'nats:nats router:nats'}]])
+        self.db.build_strategy()
+        self.assertTrue(self.db.strategy)
+
+    @testing.gen_test
+    def test_failed_removal_retried(self):
+        yield self.db.refresh()
+        services = dict((name, {}) for name in self.status['Services'])
+        self.db.expected = {'services': services}
+        self.db.build_strategy()
+        self.assertFalse(self.db.strategy)
+        self.assertEqual(self.db.previous, self.db.expected)
+
+        # nats is dropped, but removing it fails
+        self.db.expected = {'services': dict(
+            (name, {}) for name in services if name != 'nats')}
+        self.juju.destroy_service.side_effect = EnvError({'Error': 'boom'})
+        with mock.patch.object(actions.RemoveServiceTactic, 'retries', 0):
+            self.db.build_strategy()
+            self.assertEqual([type(t) for t in self.db.strategy],
+                             [actions.RemoveServiceTactic])
+            self.db.execute_strategy()
+            yield self.db.exec_lock.wait()
+        self.assertIn('nats', self.db.previous['services'])
+
+        # the next pass tries again, and only then is it done
+        self.juju.destroy_service.side_effect = None
+        self.db.build_strategy()
+        self.assertEqual([t.kwargs for t in self.db.strategy],
+                         [{'service_name': 'nats'}])
+        self.db.execute_strategy()
+        yield self.db.exec_lock.wait()
+        self.assertEqual(self.db.previous, self.db.expected)
+
+    @testing.gen_test
+    def test_execute_strategy_guard(self):
+        self.db.strategy.extend([FakeDeploy(name='a'), FakeDeploy(name='b')])
+        strategy = self.db.strategy
+        self.db.execute_strategy()
+        self.assertTrue(self.db.exec_lock.locked)
+        # a second call while running is a no-op
+        self.db.execute_strategy()
+        yield self.db.exec_lock.wait()
+        self.assertEqual(strategy.state, COMPLETE)
+        entry = self.db.history.page()[0]
+        self.assertEqual(entry['state'], 'COMPLETE')
+        self.assertEqual([t['args'] for t in entry['tactics']],
+                         [{'name': 'a'}, {'name': 'b'}])
+        self.assertEqual(len(self.db.strategy), 0)
@@ -0,0 +1,58 @@
+import unittest
+
+from cloudfoundry import actions
+from cloudfoundry import plan
+from cloudfoundry.model import Strategy
+
+
+def entry(tactic, seconds, state='COMPLETE'):
+    return {'tactic': tactic, 'state': state,
+            'start_time': '2014-07-01T10:00:00',
+            'end_time': '2014-07-01T10:00:%02d.500000' % seconds}
+
+
+class TestDurations(unittest.TestCase):
+    def test_mean(self):
+        durations = plan.Durations(default=7)
+        durations.record({'tactics': [
+            entry('DeployTactic', 10), entry('DeployTactic', 20),
+            entry('DeployTactic', 50, state='FAILED')]})
+        deploy = actions.DeployTactic(service={'service_name': 'a'},
+                                      repo='build')
+        self.assertEqual(durations.estimate(deploy), 15.5)
+        self.assertEqual(durations.estimate(actions.AddRelationTactic(
+            endpoint_a='a', endpoint_b='b')), 7)
+
+
+class TestEstimate(unittest.TestCase):
+    def strategy(self, concurrency):
+        strategy = Strategy(None, concurrency=concurrency)
+        strategy.extend([
+            actions.AddRelationTactic(endpoint_a='a:db', endpoint_b='b:db'),
+            actions.DeployTactic(service={'service_name': 'a'}, repo='r'),
+            actions.DeployTactic(service={'service_name': 'b'}, repo='r'),
+            actions.SetConfigTactic(service_name='c', config={}),
+        ])
+        return strategy
+
+    def durations(self):
+        durations = plan.Durations()
+        durations.record({'tactics': [entry('DeployTactic', 20),
+                                      entry('AddRelationTactic', 4),
+                                      entry('SetConfigTactic', 1)]})
+        return durations
+
+    def test_parallel(self):
+        result = plan.estimate(self.strategy(4), self.durations())
+        self.assertEqual(result['duration'], 25.0)
+        self.assertEqual(result['serial'], 47.0)
+        self.assertEqual(result['critical_path'], [1, 0])
+        self.assertEqual(result['tactics'][0]['depends'], [1, 2])
+        self.assertEqual(result['tactics'][0]['start'], 20.5)
+
+    def test_concurrency(self):
+        result = plan.estimate(self.strategy(1), self.durations())
+        self.assertEqual(result['duration'], result['serial'])
+        # the relation waits for both deploys, then wins on list order
+        self.assertEqual([t['start'] for t in result['tactics']],
+                         [41.0, 0.0, 20.5, 45.5])
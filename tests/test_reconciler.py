@@ -0,0 +1,230 @@
+import json
+import shutil
+import tempfile
+import unittest
+
+import mock
+from tornado import testing
+
+from cloudfoundry import model
+from cloudfoundry import reconciler
+from cloudfoundry import utils
+from cloudfoundry.events import EventLog
+
+
+class TestStateHandler(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        env_patch = mock.patch.object(model.StateDatabase, 'get_env')
+        env_patch.start()
+        self.addCleanup(env_patch.stop)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.reconciler = reconciler.Reconciler('test', {
+            'credentials.password': 'secret',
+            'generate.workers': 1,
+            'strategy.concurrency': 1,
+            'journal.path': self.tmpdir + '/journal.log'})
+        self.db = self.reconciler.db
+        self.db.expected = {'services': {'nats': {'charm': 'nats-v1'}}}
+        patcher = mock.patch.multiple(
+            reconciler, reconcilers={'test': self.reconciler},
+            default_env='test')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return reconciler.tornado.web.Application(reconciler.routes())
+
+    def test_get(self):
+        response = self.fetch('/api/v1/', use_gzip=False)
+        self.assertEqual(json.loads(response.body), self.db.expected)
+        self.assertEqual(response.headers['Etag'],
+                         '"%s"' % self.db.expected_hash)
+
+    def test_not_modified(self):
+        etag = self.fetch('/api/v1/').headers['Etag']
+        response = self.fetch('/api/v1/', headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+        self.db.expected = {}
+        response = self.fetch('/api/v1/', headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+
+    def test_gzip(self):
+        response = self.fetch('/api/v1/', use_gzip=False,
+                              headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.body, self.db.encode_expected(True))
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        etag = response.headers['Etag']
+        self.assertEqual(etag, '"%s-gz"' % self.db.expected_hash)
+        # the identity representation doesn't match the gzip one
+        response = self.fetch('/api/v1/', use_gzip=False,
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+        response = self.fetch('/api/v1/', use_gzip=False,
+                              headers={'Accept-Encoding': 'gzip',
+                                       'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+
+    def test_history_arguments(self):
+        response = self.fetch('/api/v1/history?offset=0&limit=5')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)['limit'], 5)
+        for query in ('offset=-1', 'offset=abc', 'limit=-5', 'limit=1.5'):
+            response = self.fetch('/api/v1/history?' + query)
+            self.assertEqual(response.code, 400, query)
+
+    def test_scoped(self):
+        response = self.fetch('/api/v1/test/')
+        self.assertEqual(json.loads(response.body), self.db.expected)
+        self.assertEqual(self.fetch('/api/v1/other/').code, 404)
+        response = self.fetch('/api/v1/environments')
+        self.assertEqual(json.loads(response.body),
+                         {'default': 'test', 'environments': ['test']})
+
+    def test_plan(self):
+        body = json.dumps({'services': {'nats': {'charm': 'nats-v1'},
+                                        'uaa': {'charm': 'uaa-v1'}}})
+        response = self.fetch('/api/v1/plan', method='POST', body=body)
+        self.assertEqual(response.code, 503)
+        self.db.reality.seed({'Services': {}})
+        with mock.patch.object(self.reconciler, 'schedule') as schedule:
+            response = self.fetch('/api/v1/test/plan', method='POST',
+                                  body=body)
+        self.assertFalse(schedule.called)
+        result = json.loads(response.body)
+        self.assertEqual([t['tactic'] for t in result['tactics']],
+                         ['GenerateTactic', 'DeployTactic', 'DeployTactic'])
+        # nothing recorded yet, so every tactic costs the
+        # default, one at a time at a concurrency of 1
+        self.assertEqual(result['duration'], 90.0)
+        self.assertEqual(result['critical_path'], [0, 2])
+        self.assertFalse(self.db.strategy)
+
+    def test_post_schedules(self):
+        with mock.patch.object(self.reconciler, 'schedule') as schedule:
+            self.fetch('/api/v1/test/', method='POST', body='{}')
+        self.assertEqual(self.db.expected, {})
+        schedule.assert_called_once_with()
+
+
+class TestEventHandlers(testing.AsyncHTTPTestCase):
+    def get_app(self):
+        self.db = mock.Mock(events=EventLog())
+        patcher = mock.patch.multiple(
+            reconciler, reconcilers={'test': mock.Mock(db=self.db)},
+            default_env='test')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return reconciler.tornado.web.Application([
+            (r"/api/v1/events", reconciler.EventsHandler),
+            (r"/api/v1/events/stream", reconciler.EventStreamHandler),
+        ])
+
+    def test_long_poll(self):
+        self.db.events.publish('tactic', state='RUNNING')
+        self.db.events.publish('tactic', state='COMPLETE')
+        response = self.fetch('/api/v1/events?since=1')
+        body = json.loads(response.body)
+        self.assertEqual(body['last_id'], 2)
+        self.assertEqual([e['state'] for e in body['events']], ['COMPLETE'])
+
+    def test_long_poll_waits(self):
+        self.io_loop.add_timeout(
+            self.io_loop.time() + 0.05,
+            lambda: self.db.events.publish('strategy', state='RUNNING'))
+        response = self.fetch('/api/v1/events?since=0&timeout=5')
+        body = json.loads(response.body)
+        self.assertEqual(body['events'][0]['type'], 'strategy')
+
+    def test_long_poll_timeout(self):
+        response = self.fetch('/api/v1/events?timeout=0.01')
+        self.assertEqual(json.loads(response.body),
+                         {'last_id': 0, 'events': []})
+
+    def test_bad_arguments(self):
+        for query in ('since=abc', 'since=-1', 'timeout=x', 'timeout=-1',
+                      'timeout=nan'):
+            response = self.fetch('/api/v1/events?' + query)
+            self.assertEqual(response.code, 400, query)
+        response = self.fetch('/api/v1/events/stream?since=abc')
+        self.assertEqual(response.code, 400)
+        response = self.fetch('/api/v1/events/stream',
+                              headers={'Last-Event-ID': 'abc'})
+        self.assertEqual(response.code, 400)
+
+    def test_stream(self):
+        chunks = []
+        self.db.events.publish('tactic', state='RUNNING')
+
+        def on_chunk(chunk):
+            chunks.append(chunk)
+            self.stop()
+
+        self.http_client.fetch(self.get_url('/api/v1/events/stream?since=0'),
+                               streaming_callback=on_chunk,
+                               callback=lambda r: None)
+        self.wait()
+        self.assertTrue(chunks[0].startswith('id: 1\ndata: {'))
+
+
+class TestDebouncer(testing.AsyncTestCase):
+    def test_burst(self):
+        calls = []
+        merged = reconciler.TRIGGERS_MERGED.value(environment='test')
+        debounce = reconciler.Debouncer(
+            lambda: (calls.append(1), self.stop()), delay=0.05,
+            io_loop=self.io_loop, environment='test')
+        for i in range(20):
+            debounce()
+        self.wait()
+        self.assertEqual(calls, [1])
+        self.assertEqual(reconciler.TRIGGERS_MERGED.value(environment='test'),
+                         merged + 19)
+
+    def test_max_delay(self):
+        calls = []
+        debounce = reconciler.Debouncer(
+            lambda: calls.append(self.io_loop.time()), delay=0.05,
+            max_delay=0.1, io_loop=self.io_loop)
+        start = self.io_loop.time()
+        # keep re-triggering faster than the debounce window
+        retrigger = reconciler.tornado.ioloop.PeriodicCallback(
+            debounce, 20, io_loop=self.io_loop)
+        debounce()
+        retrigger.start()
+        self.io_loop.add_timeout(start + 0.25, self.stop)
+        self.wait()
+        retrigger.stop()
+        self.assertTrue(calls)
+        self.assertLess(calls[0] - start, 0.15)
+
+
+class TestEnvironmentConfigs(unittest.TestCase):
+    def setUp(self):
+        self.config = utils.NestedDict({
+            'juju.environment': 'local',
+            'journal.path': '/var/log/journal.log',
+            'server.repository': 'build',
+            'strategy.concurrency': 4})
+
+    def test_single(self):
+        configs = reconciler.environment_configs(self.config)
+        self.assertEqual(configs.keys(), ['local'])
+        self.assertEqual(configs['local']['journal.path'],
+                         '/var/log/journal.log')
+
+    def test_several(self):
+        self.config['environments'] = {
+            'staging': {},
+            'prod': {'strategy': {'concurrency': 8},
+                     'juju': {'environment': 'cf-prod'}}}
+        configs = reconciler.environment_configs(self.config)
+        self.assertEqual(sorted(configs), ['prod', 'staging'])
+        self.assertEqual(configs['staging']['journal.path'],
+                         '/var/log/journal-staging.log')
+        self.assertEqual(configs['staging']['server.repository'],
+                         'build/staging')
+        self.assertEqual(configs['staging']['juju.environment'], 'staging')
+        self.assertEqual(configs['prod']['juju.environment'], 'cf-prod')
+        self.assertEqual(configs['prod']['strategy.concurrency'], 8)
+        self.assertEqual(configs['staging']['strategy.concurrency'], 4)
+        self.assertNotIn('environments', configs['prod'])